@@ -1,21 +1,38 @@
 import eventlet
 eventlet.monkey_patch()
+from eventlet import tpool
+from eventlet.semaphore import Semaphore
 
 import os
 
 
-from flask import Flask, request, jsonify, session, send_file, send_from_directory
+from flask import Flask, request, jsonify, session, send_from_directory, g, has_request_context
 from flask_socketio import SocketIO, emit, join_room, leave_room
 from flask_cors import CORS
 from flask_sqlalchemy import SQLAlchemy
 import hashlib
+import hmac
+import base64
+import calendar
 
+import functools
 import json
-from datetime import datetime
-import uuid
-from werkzeug.utils import secure_filename
+import re
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from eventlet.queue import LightQueue, Empty
+from sqlalchemy import event, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import relationship
 
+from photos import PHOTO_SIZES, render_photo_variants
+from static_assets import IMMUTABLE_MAX_AGE, StaticManifest
+import metrics
+import wire
+
 app = Flask(__name__, static_folder='.', static_url_path='')
 app.config['SECRET_KEY'] = 'teletok-secret-key-2024'
 app.config['UPLOAD_FOLDER'] = 'uploads'
@@ -46,21 +63,54 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
     'pool_recycle': 280,
     'pool_pre_ping': True,
-    'connect_args': {
+}
+if database_url.startswith('mysql'):
+    app.config['SQLALCHEMY_ENGINE_OPTIONS']['connect_args'] = {
         'charset': 'utf8mb4',
         # Only use SSL if required by the hosting platform
     }
-}
 
 # Allowed file extensions for profile photos
-ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
+
+# Processed profile photos are stored as <sha256>_<size>.<jpg|webp>; the
+# profile_photo column holds the largest JPEG and clients get URLs for the
+# size they display
+PHOTO_WORKERS = 2
+PROFILE_PHOTO_SIZE = max(PHOTO_SIZES)
+PROCESSED_PHOTO_PATTERN = re.compile(r'^([0-9a-f]{64})_(\d+)\.(jpg|webp)$')
+
+# Pages and images served from memory; see static_assets.py
+STATIC_ASSETS = ('login.html', 'register.html', 'dashboard.html', 'settings.html', 'default.jpg')
+static_manifest = StaticManifest(app.root_path, STATIC_ASSETS)
+
+# Conversation history paging
+MESSAGES_PAGE_SIZE = 50
+MESSAGES_PAGE_SIZE_MAX = 200
+
+# User search
+app.config['SEARCH_CACHE_TTL'] = 5  # seconds to reuse type-ahead results, 0 to disable
+SEARCH_INDEX_REFRESH = 300  # seconds before the index reloads users registered on other workers
+SEARCH_RESULTS_LIMIT = 20
 
 # Create uploads folder if it doesn't exist
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
 # Initialize extensions
 db = SQLAlchemy(app)
-socketio = SocketIO(app, cors_allowed_origins="*", async_mode='eventlet', logger=True, engineio_logger=True)
+
+# Socket.IO message queue. Set SOCKETIO_MESSAGE_QUEUE so emits reach sockets
+# held by other workers/nodes: redis://..., amqp://..., or local://host:port
+# for the broker in local_queue.py
+message_queue = os.environ.get('SOCKETIO_MESSAGE_QUEUE')
+socketio_options = {}
+if message_queue and message_queue.startswith('local://'):
+    from local_queue import LocalQueueManager
+    socketio_options['client_manager'] = LocalQueueManager(message_queue, channel='flask-socketio')
+elif message_queue:
+    socketio_options['message_queue'] = message_queue
+
+socketio = SocketIO(app, cors_allowed_origins="*", async_mode='eventlet', logger=True, engineio_logger=True, **socketio_options)
 CORS(app)
 
 # Database Models
@@ -75,6 +125,9 @@ class User(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     last_seen = db.Column(db.DateTime, default=datetime.utcnow)
     is_online = db.Column(db.Boolean, default=False)
+    # Newest message id pushed to one of the user's sockets; anything sent to
+    # them above it is waiting for their next user_online
+    last_delivered_id = db.Column(db.Integer, nullable=False, default=0)
     
     # Relationships - ensure proper back_populates
     contacts = relationship("Contact", 
@@ -91,15 +144,23 @@ class Message(db.Model):
     __tablename__ = 'messages'
     
     id = db.Column(db.Integer, primary_key=True)
+    conversation_id = db.Column(db.Integer, db.ForeignKey('conversations.id'))
     sender_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     receiver_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     message_text = db.Column(db.Text, nullable=False)
-    is_seen = db.Column(db.Boolean, default=False)
+    is_seen = db.Column(db.Boolean, default=False)  # Superseded by read state on conversations
     sent_at = db.Column(db.DateTime, default=datetime.utcnow)
     
     # Relationships
     sender = relationship("User", foreign_keys=[sender_id], back_populates="sent_messages")
     receiver = relationship("User", foreign_keys=[receiver_id], back_populates="received_messages")
+    
+    # Conversation history is paged by id within a conversation; undelivered
+    # messages are a range of the receiver's
+    __table_args__ = (
+        db.Index('idx_messages_conversation_id', 'conversation_id', 'id'),
+        db.Index('idx_messages_receiver_id', 'receiver_id', 'id'),
+    )
 
 class Contact(db.Model):
     __tablename__ = 'contacts'
@@ -115,59 +176,1968 @@ class Contact(db.Model):
     
     __table_args__ = (db.UniqueConstraint('user_id', 'contact_id', name='unique_contact'),)
 
-# Helper functions
+class Conversation(db.Model):
+    __tablename__ = 'conversations'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    # The pair is stored ordered (user_a_id < user_b_id) so it has one row
+    user_a_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    user_b_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    last_message_id = db.Column(db.Integer)
+    last_sender_id = db.Column(db.Integer)
+    last_text = db.Column(db.String(100))
+    last_sent_at = db.Column(db.DateTime)
+    # Per side: newest message from the other side that has been read, and
+    # how many of the other side's messages are newer than that
+    a_last_read_id = db.Column(db.Integer, nullable=False, default=0)
+    b_last_read_id = db.Column(db.Integer, nullable=False, default=0)
+    a_unread_count = db.Column(db.Integer, nullable=False, default=0)
+    b_unread_count = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        db.UniqueConstraint('user_a_id', 'user_b_id', name='unique_conversation'),
+        db.Index('idx_conversations_a_recent', 'user_a_id', 'last_sent_at'),
+        db.Index('idx_conversations_b_recent', 'user_b_id', 'last_sent_at'),
+    )
+
+class Change(db.Model):
+    __tablename__ = 'changes'
+    
+    # Ids only grow, so a client's sync cursor is the last id it has seen
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    kind = db.Column(db.String(20), nullable=False)
+    payload = db.Column(db.Text, nullable=False)  # JSON
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        db.Index('idx_changes_user_id', 'user_id', 'id'),
+        db.Index('idx_changes_created_at', 'created_at'),
+    )
+
+class ChatGroup(db.Model):
+    __tablename__ = 'chat_groups'  # GROUPS is a reserved word in MySQL 8
+
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False)
+    created_by = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    last_message_id = db.Column(db.Integer)
+    last_sender_id = db.Column(db.Integer)
+    last_text = db.Column(db.String(100))
+    last_sent_at = db.Column(db.DateTime)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class GroupMember(db.Model):
+    __tablename__ = 'group_members'
+
+    id = db.Column(db.Integer, primary_key=True)
+    group_id = db.Column(db.Integer, db.ForeignKey('chat_groups.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    # Newest group message this member has read; their unread messages are
+    # the ones from others above it
+    last_read_id = db.Column(db.Integer, nullable=False, default=0)
+    joined_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.UniqueConstraint('group_id', 'user_id', name='unique_group_member'),
+        db.Index('idx_group_members_user_id', 'user_id'),
+    )
+
+class GroupMessage(db.Model):
+    __tablename__ = 'group_messages'
+
+    # Stored once per group, however many members it has
+    id = db.Column(db.Integer, primary_key=True)
+    group_id = db.Column(db.Integer, db.ForeignKey('chat_groups.id'), nullable=False)
+    sender_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    message_text = db.Column(db.Text, nullable=False)
+    sent_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('idx_group_messages_group_id', 'group_id', 'id'),
+    )
+
+class MessageTerm(db.Model):
+    __tablename__ = 'message_terms'
+
+    # Inverted index over message text: a row per distinct word of each
+    # message, keyed by the conversation (messages) or group (group_messages)
+    # it was sent in, so a search only reads the user's own postings
+    id = db.Column(db.Integer, primary_key=True)
+    term = db.Column(db.String(32), nullable=False)
+    conversation_id = db.Column(db.Integer, db.ForeignKey('conversations.id'))
+    group_id = db.Column(db.Integer, db.ForeignKey('chat_groups.id'))
+    message_id = db.Column(db.Integer, nullable=False)
+    occurrences = db.Column(db.Integer, nullable=False, default=1)
+    sent_at = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('idx_message_terms_conversation', 'term', 'conversation_id', 'message_id'),
+        db.Index('idx_message_terms_group', 'term', 'group_id', 'message_id'),
+        db.Index('idx_message_terms_message_id', 'message_id'),
+    )
+
+# Password hashing
+# Hashes are stored as $scrypt$n=<n>,r=<r>,p=<p>$<salt>$<key>. Older accounts
+# still have an unsalted SHA-256 hex digest and are rehashed on their next
+# login. scrypt is deliberately slow and memory hungry, so it runs on real OS
+# threads through eventlet's tpool and never blocks the hub; the semaphore
+# bounds how many run at once.
+PASSWORD_HASH_WORKERS = 4
+SCRYPT_N = 2 ** 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+SCRYPT_KEY_LENGTH = 32
+password_hash_slots = Semaphore(PASSWORD_HASH_WORKERS)
+
+def run_password_kdf(password, salt, n, r, p):
+    with password_hash_slots:
+        return tpool.execute(
+            hashlib.scrypt, password.encode(), salt=salt, n=n, r=r, p=p,
+            maxmem=256 * r * (n + p + 2), dklen=SCRYPT_KEY_LENGTH
+        )
+
+def b64encode(data):
+    return base64.b64encode(data).decode().rstrip('=')
+
+def b64decode(text):
+    return base64.b64decode(text + '=' * (-len(text) % 4))
+
 def hash_password(password):
-    return hashlib.sha256(password.encode()).hexdigest()
+    salt = os.urandom(16)
+    key = run_password_kdf(password, salt, SCRYPT_N, SCRYPT_R, SCRYPT_P)
+    return f'$scrypt$n={SCRYPT_N},r={SCRYPT_R},p={SCRYPT_P}${b64encode(salt)}${b64encode(key)}'
+
+def verify_password(password, password_hash):
+    """Returns (matches, needs_rehash)"""
+    if password_hash.startswith('$scrypt$'):
+        _, _, params, salt, key = password_hash.split('$')
+        params = dict(param.split('=') for param in params.split(','))
+        n, r, p = int(params['n']), int(params['r']), int(params['p'])
+        candidate = run_password_kdf(password, b64decode(salt), n, r, p)
+        matches = hmac.compare_digest(candidate, b64decode(key))
+        return matches, (n, r, p) != (SCRYPT_N, SCRYPT_R, SCRYPT_P)
+    
+    # Legacy unsalted SHA-256
+    legacy_hash = hashlib.sha256(password.encode()).hexdigest()
+    return hmac.compare_digest(legacy_hash, password_hash), True
+
+# Verified against when the phone is unknown so the response takes as long
+# as a wrong password does
+DUMMY_PASSWORD_HASH = f'$scrypt$n={SCRYPT_N},r={SCRYPT_R},p={SCRYPT_P}${b64encode(bytes(16))}${b64encode(bytes(SCRYPT_KEY_LENGTH))}'
+
+# Metrics: request, socket event and SQL timings plus gauges read at scrape
+# time, served in the Prometheus text format from /metrics
+metrics_registry = metrics.Registry()
+http_request_seconds = metrics_registry.histogram(
+    'teletok_http_request_duration_seconds', 'HTTP request latency by route',
+    ('method', 'route', 'status')
+)
+socket_event_seconds = metrics_registry.histogram(
+    'teletok_socket_event_duration_seconds', 'Socket.IO handler latency by event', ('event', 'status')
+)
+db_statements = metrics_registry.counter(
+    'teletok_db_statements_total', 'SQL statements executed', ('operation',)
+)
+db_statement_seconds = metrics_registry.histogram(
+    'teletok_db_statement_duration_seconds', 'SQL statement latency', ('operation',)
+)
+request_db_statements = metrics_registry.histogram(
+    'teletok_request_db_statements', 'SQL statements per request or socket event',
+    ('handler',), buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100)
+)
+request_db_seconds = metrics_registry.histogram(
+    'teletok_request_db_seconds', 'Time spent in SQL per request or socket event', ('handler',)
+)
+
+SQL_OPERATIONS = {'SELECT', 'INSERT', 'UPDATE', 'DELETE'}
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_statement_timer(conn, cursor, statement, parameters, context, executemany):
+    context.metrics_started = time.perf_counter()
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def record_statement(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - context.metrics_started
+    operation = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else ''
+    if operation not in SQL_OPERATIONS:
+        operation = 'OTHER'
+    db_statements.inc(operation=operation)
+    db_statement_seconds.observe(elapsed, operation=operation)
+    if has_request_context() and 'db_statements' in g:
+        g.db_statements += 1
+        g.db_seconds += elapsed
+
+def start_request_metrics():
+    g.request_started = time.perf_counter()
+    g.db_statements = 0
+    g.db_seconds = 0.0
+
+def finish_request_metrics(handler):
+    request_db_statements.observe(g.db_statements, handler=handler)
+    request_db_seconds.observe(g.db_seconds, handler=handler)
+    return time.perf_counter() - g.request_started
+
+@app.before_request
+def before_request_metrics():
+    start_request_metrics()
+
+@app.after_request
+def after_request_metrics(response):
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    elapsed = finish_request_metrics(route)
+    http_request_seconds.observe(
+        elapsed, method=request.method, route=route, status=response.status_code
+    )
+    return response
+
+def timed_socket_event(handler):
+    """Record latency and SQL use of a Socket.IO handler; apply below @socketio.on"""
+    @functools.wraps(handler)
+    def wrapper(*args):
+        event_name = request.event['message']
+        start_request_metrics()
+        status = 'error'
+        try:
+            result = handler(*args)
+            status = 'ok'
+            return result
+        finally:
+            elapsed = finish_request_metrics(f'socket:{event_name}')
+            socket_event_seconds.observe(elapsed, event=event_name, status=status)
+    return wrapper
+
+def query_budget(statements):
+    """Declare the most SQL statements a route or socket handler may run.
+
+    Not enforced at runtime; query_budget.py checks every handler against
+    its budget at several data sizes.
+    """
+    def decorator(handler):
+        handler.query_budget = statements
+        return handler
+    return decorator
+
+def db_pool_stats():
+    pool = db.engine.pool
+    # SQLite and NullPool have no checkout accounting
+    if not hasattr(pool, 'checkedout'):
+        return {}
+    return {
+        ('size',): pool.size(),
+        ('checked_out',): pool.checkedout(),
+        ('overflow',): pool.overflow(),
+    }
+
+def socket_room_stats():
+    rooms = socketio.server.manager.rooms.get('/', {})
+    sockets = rooms.get(None, {})
+    return {
+        ('sockets',): len(sockets),
+        # Every socket also has a room named after its sid
+        ('rooms',): len([room for room in rooms if room is not None and room not in sockets]),
+    }
+
+def queue_depths():
+    return {
+        ('send_pipeline',): send_queue.qsize(),
+        ('seen_receipts',): len(pending_seen_receipts),
+        ('presence_writes',): len(presence_writer.unflushed),
+    }
+
+metrics_registry.gauge('teletok_db_pool_connections', 'Database connection pool state', ('state',), db_pool_stats)
+metrics_registry.gauge('teletok_socketio_local', 'Sockets and rooms held by this worker', ('kind',), socket_room_stats)
+metrics_registry.gauge(
+    'teletok_online_users', 'Users with at least one connected socket',
+    callback=lambda: len(presence.online_user_ids())
+)
+metrics_registry.gauge('teletok_queue_depth', 'Items waiting in background queues', ('queue',), queue_depths)
+
+@app.route('/metrics')
+@query_budget(0)
+def serve_metrics():
+    return metrics_registry.render(), 200, {'Content-Type': metrics.CONTENT_TYPE}
+
+# Readiness is checked at most every HEALTH_CHECK_TTL seconds so frequent
+# probes don't each run a query
+HEALTH_CHECK_TTL = 5
+health_state = {'checked_at': 0, 'healthy': False, 'error': None, 'timestamp': None}
 
 @app.route('/health')
+@query_budget(1)
 def health_check():
     """Health check endpoint to verify app and database connectivity"""
-    try:
-        with app.app_context():
-            from sqlalchemy import text
-            result = db.session.execute(text("SELECT 1"))
+    if time.monotonic() - health_state['checked_at'] >= HEALTH_CHECK_TTL:
+        try:
+            db.session.execute(text("SELECT 1"))
+            health_state.update(healthy=True, error=None)
+        except Exception as e:
+            db.session.rollback()
+            health_state.update(healthy=False, error=str(e))
+        health_state['checked_at'] = time.monotonic()
+        health_state['timestamp'] = datetime.utcnow().isoformat()
+    
+    if health_state['healthy']:
         return jsonify({
             'status': 'healthy',
             'database': 'connected',
-            'timestamp': datetime.utcnow().isoformat()
+            'timestamp': health_state['timestamp']
         })
-    except Exception as e:
-        return jsonify({
-            'status': 'unhealthy',
-            'database': 'disconnected',
-            'error': str(e),
-            'timestamp': datetime.utcnow().isoformat()
-        }), 500
+    return jsonify({
+        'status': 'unhealthy',
+        'database': 'disconnected',
+        'error': health_state['error'],
+        'timestamp': health_state['timestamp']
+    }), 500
+
+@app.route('/pipeline_stats')
+@query_budget(0)
+def pipeline_stats():
+    """Batch size and flush latency of the write pipelines"""
+    stats = dict(send_pipeline_stats)
+    batches = stats['batches']
+    stats['queue_depth'] = send_queue.qsize()
+    stats['avg_batch_size'] = stats['messages'] / batches if batches else 0
+    stats['avg_flush_seconds'] = stats['total_flush_seconds'] / batches if batches else 0
+    stats['avg_queue_seconds'] = stats['total_queue_seconds'] / batches if batches else 0
+    
+    presence_stats = dict(presence_writer.stats)
+    presence_stats['unflushed'] = len(presence_writer.unflushed)
+    presence_stats['pending_offline'] = len(presence_writer.pending_offline)
+    profile_cache_stats = dict(user_profiles.stats)
+    profile_cache_stats['entries'] = len(user_profiles.entries)
+    typing_stats = dict(typing_relay.stats)
+    typing_stats['suppressed'] = typing_stats['throttled'] + typing_stats['duplicates'] + typing_stats['offline_dropped']
+    typing_stats['active'] = len(typing_relay.typing)
+    return jsonify({
+        'success': True,
+        'send_pipeline': stats,
+        'presence_writer': presence_stats,
+        'user_profiles': profile_cache_stats,
+        'typing_relay': typing_stats
+    })
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-# Store online users {user_id: socket_id}
-online_users = {}
+# Profile photo processing runs on real OS threads through eventlet's tpool;
+# Pillow releases the GIL while decoding, resizing and encoding, so uploads
+# never block the sockets on this worker. The semaphore bounds how many run
+# at once.
+photo_slots = Semaphore(PHOTO_WORKERS)
+
+def render_photo_off_hub(data):
+    with photo_slots:
+        return tpool.execute(render_photo_variants, data)
+
+def store_profile_photo(data):
+    """Resize an upload into every photo size and return the stored filename.
+
+    Files are named by the hash of the upload, so the same photo uploaded
+    twice is processed and stored once.
+    """
+    digest = hashlib.sha256(data).hexdigest()
+    filename = f'{digest}_{PROFILE_PHOTO_SIZE}.jpg'
+    if os.path.exists(os.path.join(app.config['UPLOAD_FOLDER'], filename)):
+        return filename
+    
+    variants = render_photo_off_hub(data)
+    # Write the profile size last; its presence marks the set as complete
+    for variant in sorted(variants, key=lambda name: name == f'{PROFILE_PHOTO_SIZE}.jpg'):
+        filepath = os.path.join(app.config['UPLOAD_FOLDER'], f'{digest}_{variant}')
+        with open(filepath + '.tmp', 'wb') as f:
+            f.write(variants[variant])
+        os.replace(filepath + '.tmp', filepath)
+    return filename
+
+def photo_url(profile_photo, size):
+    """URL of a profile photo at the given display size"""
+    if not profile_photo or profile_photo == 'default.jpg':
+        return static_manifest.url('default.jpg')
+    match = PROCESSED_PHOTO_PATTERN.match(profile_photo)
+    if match:
+        return f'/uploads/{match.group(1)}_{size}.jpg'
+    # Uploads from before photo processing only exist at full size
+    return f'/uploads/{profile_photo}'
+
+def after_commit(callback):
+    """Run callback once the current transaction commits (dropped on rollback)"""
+    db.session.info.setdefault('after_commit', []).append(callback)
+
+@event.listens_for(db.session, 'after_commit')
+def run_after_commit_callbacks(db_session):
+    for callback in db_session.info.pop('after_commit', []):
+        try:
+            callback()
+        except Exception as e:
+            print(f"After commit callback error: {e}")
+
+@event.listens_for(db.session, 'after_rollback')
+def discard_after_commit_callbacks(db_session):
+    db_session.info.pop('after_commit', None)
+
+# Background loops started on first use {name: greenthread}
+background_loops = {}
+
+def start_background_loop(name, interval, func):
+    """Run func every interval seconds inside an app context"""
+    if name in background_loops:
+        return
+    
+    def loop():
+        while True:
+            socketio.sleep(interval)
+            try:
+                with app.app_context():
+                    func()
+            except Exception as e:
+                print(f"Background loop error ({name}): {e}")
+    
+    background_loops[name] = socketio.start_background_task(loop)
+
+def insert_rows(model, rows):
+    """Insert rows in multi-row INSERTs and return their ids, in the order of rows"""
+    if not rows:
+        return []
+    dialect = db.engine.dialect.name
+    if dialect == 'mysql':
+        # No RETURNING. A single INSERT of a known number of rows gets
+        # consecutive auto-increment ids under every innodb_autoinc_lock_mode
+        # (with the default auto_increment_increment of 1), and its lastrowid
+        # is the first of them.
+        first_id = db.session.execute(db.insert(model).values(rows)).lastrowid
+        return list(range(first_id, first_id + len(rows)))
+    if dialect == 'sqlite':
+        # Writers are serialized and rows take rowids in VALUES order; asking
+        # SQLAlchemy to keep the order would insert them one at a time
+        return sorted(db.session.scalars(db.insert(model).returning(model.id), rows).all())
+    return db.session.scalars(
+        db.insert(model).returning(model.id, sort_by_parameter_order=True), rows
+    ).all()
+
+# Change log: new and deleted messages, read state and new contacts are
+# appended for every user they concern, in the transaction that makes them,
+# so a reconnecting client can replay what it missed from /sync instead of
+# reloading everything. Rows older than the retention window are pruned.
+CHANGE_LOG_RETENTION = 3 * 24 * 3600  # seconds
+CHANGE_LOG_PRUNE_INTERVAL = 3600  # seconds
+
+def record_changes(changes):
+    """Append [(user_ids, kind, payload)] to the log in one INSERT"""
+    rows = []
+    for user_ids, kind, payload in changes:
+        payload = json.dumps(payload)
+        rows.extend({'user_id': user_id, 'kind': kind, 'payload': payload} for user_id in user_ids)
+    if rows:
+        db.session.execute(db.insert(Change), rows)
+    start_background_loop('change_log_pruner', CHANGE_LOG_PRUNE_INTERVAL, prune_change_log)
+
+def prune_change_log():
+    cutoff = datetime.utcnow() - timedelta(seconds=CHANGE_LOG_RETENTION)
+    Change.query.filter(Change.created_at < cutoff).delete(synchronize_session=False)
+    db.session.commit()
+
+# Conversations: one row per pair of users (see Conversation). Sending a
+# message updates its conversation's summary and the receiver's unread count
+# in the same transaction, and marking it read is one UPDATE of the reader's
+# side.
+LAST_TEXT_LENGTH = 100
+
+def ordered_pair(user_id, other_id):
+    return (user_id, other_id) if user_id < other_id else (other_id, user_id)
+
+def conversation_side(user_id, other_id):
+    """'a' or 'b': which side of their conversation user_id is on"""
+    return 'a' if user_id < other_id else 'b'
+
+def side_column(user_id, other_id, name):
+    """The user's own column on their conversation with other_id, e.g. unread_count"""
+    return getattr(Conversation, f'{conversation_side(user_id, other_id)}_{name}')
+
+# Conversation ids {ordered pair: id}; a pair's conversation never changes
+conversation_ids = {}
+
+def get_conversation_id(user_id, other_id):
+    """Id of the conversation between two users, or None if they have never talked"""
+    pair = ordered_pair(int(user_id), int(other_id))
+    conversation_id = conversation_ids.get(pair)
+    if conversation_id is None:
+        conversation_id = db.session.query(Conversation.id).filter_by(
+            user_a_id=pair[0], user_b_id=pair[1]
+        ).scalar()
+        if conversation_id is not None:
+            conversation_ids[pair] = conversation_id
+    return conversation_id
+
+def get_or_create_conversation_ids(pairs):
+    """{ordered pair: conversation id} for every pair, creating missing conversations"""
+    pairs = {ordered_pair(user_id, other_id) for user_id, other_id in pairs}
+    result = {pair: conversation_ids[pair] for pair in pairs if pair in conversation_ids}
+    missing = pairs - result.keys()
+    if missing:
+        for conversation_id, user_a_id, user_b_id in db.session.query(
+            Conversation.id, Conversation.user_a_id, Conversation.user_b_id
+        ).filter(db.tuple_(Conversation.user_a_id, Conversation.user_b_id).in_(missing)).all():
+            result[(user_a_id, user_b_id)] = conversation_ids[(user_a_id, user_b_id)] = conversation_id
+    
+    for pair in missing - result.keys():
+        try:
+            with db.session.begin_nested():
+                conversation = Conversation(user_a_id=pair[0], user_b_id=pair[1])
+                db.session.add(conversation)
+            result[pair] = conversation.id
+            # Only cache it once it's durable
+            after_commit(lambda pair=pair, conversation_id=conversation.id: conversation_ids.setdefault(pair, conversation_id))
+        except IntegrityError:
+            # Another worker created it first
+            result[pair] = get_conversation_id(*pair)
+    return result
+
+# Read watermarks {(reader_id, peer_id): last_read_message_id}
+# A message is seen once its id is at or below the receiver's watermark on
+# the conversation, so marking a conversation read is a single monotonic update.
+read_watermark_cache = {}
+
+def get_read_watermark(reader_id, peer_id):
+    key = (reader_id, peer_id)
+    if key not in read_watermark_cache:
+        user_a_id, user_b_id = ordered_pair(reader_id, peer_id)
+        read_watermark_cache[key] = db.session.query(side_column(reader_id, peer_id, 'last_read_id')).filter(
+            Conversation.user_a_id == user_a_id,
+            Conversation.user_b_id == user_b_id
+        ).scalar() or 0
+    return read_watermark_cache[key]
+
+def update_read_watermark_cache(reader_id, peer_id, message_id):
+    key = (reader_id, peer_id)
+    if key in read_watermark_cache:
+        read_watermark_cache[key] = max(read_watermark_cache[key], message_id)
+
+def advance_read_watermark(reader_id, peer_id, message_id):
+    """Move the watermark forward to message_id. Returns False if it was already there."""
+    if read_watermark_cache.get((reader_id, peer_id), 0) >= message_id:
+        return False
+    
+    conversation_id = get_conversation_id(reader_id, peer_id)
+    if conversation_id is None:
+        return False
+    
+    last_read_id = side_column(reader_id, peer_id, 'last_read_id')
+    # Unread count is whatever the peer sent after the new watermark
+    remaining = db.select(db.func.count(Message.id)).where(
+        Message.conversation_id == conversation_id,
+        Message.sender_id == peer_id,
+        Message.id > message_id
+    ).scalar_subquery()
+    # A client can't mark messages read that haven't been sent yet
+    updated = Conversation.query.filter(
+        Conversation.id == conversation_id,
+        last_read_id < message_id,
+        Conversation.last_message_id >= message_id
+    ).update({
+        last_read_id: message_id,
+        side_column(reader_id, peer_id, 'unread_count'): remaining
+    }, synchronize_session=False)
+    if not updated:
+        return False
+    
+    record_changes([((reader_id, peer_id), 'read', {
+        'reader_id': reader_id, 'peer_id': peer_id, 'last_read_id': message_id
+    })])
+    after_commit(lambda: update_read_watermark_cache(reader_id, peer_id, message_id))
+    return True
+
+# Pending read receipts {(sender_id, reader_id): highest seen message id}
+# flushed as one "seen up to" message_status emit per pair per window.
+SEEN_FLUSH_INTERVAL = 0.5
+pending_seen_receipts = {}
+
+def queue_seen_receipt(sender_id, reader_id, message_id):
+    key = (sender_id, reader_id)
+    pending_seen_receipts[key] = max(pending_seen_receipts.get(key, 0), message_id)
+    start_background_loop('seen_receipts', SEEN_FLUSH_INTERVAL, flush_seen_receipts)
+
+def flush_seen_receipts():
+    while pending_seen_receipts:
+        (sender_id, reader_id), message_id = pending_seen_receipts.popitem()
+        socketio.emit('message_status', {
+            'reader_id': reader_id,
+            'seen_up_to': message_id,
+            'is_seen': True
+        }, room=str(sender_id))
+
+# Compact protocol: a client that connects with auth {'protocol': 'compact'}
+# gets messages as msgpack arrays (see wire.py) with integer timestamps and
+# no sender name or photo; it fetches those once per session from the
+# profiles event. Each user's sockets join their user room plus a message
+# room for their protocol, so every message is packed at most once and the
+# same bytes go to every compact socket; message_rooms (below) counts each
+# room's sockets so empty ones are skipped.
+compact_sids = set()  # this worker's sockets using the compact protocol
+PROFILES_REQUEST_MAX = 100
+
+def message_room(user_id, compact):
+    return f'{user_id}:compact' if compact else f'{user_id}:json'
+
+# Groups: a group message is stored once in group_messages and emitted once
+# to the group's room, which every member's sockets join in join_user_room,
+# so a send costs the same for 10 members as for 1000. Read state is one
+# watermark per member on group_members instead of a row per recipient.
+GROUP_MAX_MEMBERS = 1000
+GROUP_NAME_LENGTH = 100
+
+def group_room(group_id):
+    return f'group:{group_id}'
+
+# Group membership {group_id: set of member user ids}, loaded on first use.
+# Members are only ever added, so a cached set can lack a member added
+# through another worker but never holds one too many; a user missing from
+# it is checked against the database before being refused.
+group_member_cache = {}
+
+def get_group_member_ids(group_id):
+    member_ids = group_member_cache.get(group_id)
+    if member_ids is None:
+        member_ids = {
+            user_id for (user_id,) in db.session.query(GroupMember.user_id).filter(
+                GroupMember.group_id == group_id
+            ).all()
+        }
+        group_member_cache[group_id] = member_ids
+    return member_ids
+
+def is_group_member(group_id, user_id):
+    if user_id in group_member_cache.get(group_id, ()):
+        return True
+    # Not loaded yet, or loaded before they joined
+    group_member_cache.pop(group_id, None)
+    return user_id in get_group_member_ids(group_id)
+
+# Group read watermarks {(group_id, user_id): last_read_id}, as with
+# read_watermark_cache for conversations
+group_watermark_cache = {}
+
+def update_group_watermark_cache(group_id, user_id, message_id):
+    key = (group_id, user_id)
+    group_watermark_cache[key] = max(group_watermark_cache.get(key, 0), message_id)
+
+def advance_group_watermark(group_id, user_id, message_id):
+    """Move the member's watermark forward to message_id. Returns False if it was already there."""
+    if group_watermark_cache.get((group_id, user_id), 0) >= message_id:
+        return False
+
+    # Not past the group's newest message, as with advance_read_watermark
+    last_message_id = db.select(ChatGroup.last_message_id).where(ChatGroup.id == group_id).scalar_subquery()
+    updated = GroupMember.query.filter(
+        GroupMember.group_id == group_id,
+        GroupMember.user_id == user_id,
+        GroupMember.last_read_id < message_id,
+        last_message_id >= message_id
+    ).update({GroupMember.last_read_id: message_id}, synchronize_session=False)
+    if not updated:
+        return False
+
+    after_commit(lambda: update_group_watermark_cache(group_id, user_id, message_id))
+    return True
+
+def serialize_group(group, member_count, unread_count=0, last_read_id=0):
+    return {
+        'id': group.id,
+        'name': group.name,
+        'created_by': group.created_by,
+        'member_count': member_count,
+        'unread_count': unread_count,
+        'last_read_id': last_read_id,
+        'last_message': group.last_text,
+        'last_message_id': group.last_message_id,
+        'last_sender_id': group.last_sender_id,
+        'last_message_at': group.last_sent_at.isoformat() if group.last_sent_at else None
+    }
+
+def save_group_messages(items, senders):
+    """Write a send batch's group messages and their groups' summaries; returns [(item, message data)]"""
+    if not items:
+        return []
+
+    # One INSERT, as for direct messages in flush_send_batch
+    rows = [{
+        'group_id': item['group_id'],
+        'sender_id': item['sender_id'],
+        'message_text': item['message_text'],
+        'sent_at': item['sent_at']
+    } for item in items]
+    messages = [
+        (item, GroupMessage(id=message_id, **row))
+        for item, row, message_id in zip(items, rows, insert_rows(GroupMessage, rows))
+    ]
+
+    # Messages are in id order, so the last one per group is its newest
+    summaries = {}
+    for item, message in messages:
+        summaries[message.group_id] = {
+            ChatGroup.last_message_id: message.id,
+            ChatGroup.last_sender_id: message.sender_id,
+            ChatGroup.last_text: message.message_text[:LAST_TEXT_LENGTH],
+            ChatGroup.last_sent_at: message.sent_at
+        }
+    for group_id, values in summaries.items():
+        ChatGroup.query.filter(ChatGroup.id == group_id).update(values, synchronize_session=False)
+
+    deliveries = []
+    for item, message in messages:
+        sender = senders[message.sender_id]
+        deliveries.append((item, {
+            'id': message.id,
+            'group_id': message.group_id,
+            'sender_id': message.sender_id,
+            'message_text': message.message_text,
+            'sent_at': item['sent_at'].isoformat(),
+            'sender_name': sender['username'],
+            'sender_photo': sender['profile_photo'],
+            'sender_photo_url': photo_url(sender['profile_photo'], 48)
+        }))
+    return deliveries
+
+def load_groups(user_id, changed_since=None):
+    """The user's groups for the chat list, optionally only those joined or messaged since a time"""
+    unread_count = db.select(db.func.count(GroupMessage.id)).where(
+        GroupMessage.group_id == ChatGroup.id,
+        GroupMessage.sender_id != user_id,
+        GroupMessage.id > GroupMember.last_read_id
+    ).correlate(ChatGroup, GroupMember).scalar_subquery()
+    others = db.aliased(GroupMember)
+    member_count = db.select(db.func.count(others.id)).where(
+        others.group_id == ChatGroup.id
+    ).correlate(ChatGroup).scalar_subquery()
+
+    query = db.session.query(ChatGroup, GroupMember.last_read_id, unread_count, member_count).join(
+        GroupMember, GroupMember.group_id == ChatGroup.id
+    ).filter(
+        GroupMember.user_id == user_id
+    )
+    if changed_since is not None:
+        query = query.filter((ChatGroup.last_sent_at >= changed_since) | (GroupMember.joined_at >= changed_since))
+    rows = query.order_by(
+        ChatGroup.last_sent_at.is_(None), ChatGroup.last_sent_at.desc(), ChatGroup.name
+    ).all()
+    return [
+        serialize_group(group, members, unread, last_read_id)
+        for group, last_read_id, unread, members in rows
+    ]
+
+# Message search: message_terms (see MessageTerm) is written in the same
+# transaction as the messages it indexes and loses a message's rows when it
+# is deleted. A search ranks the user's messages by how many of its words
+# they contain, then how often, then how recently they were sent.
+# rebuild_search_index.py backfills history from before the index.
+MESSAGE_TERM_PATTERN = re.compile(r'\w+')
+MESSAGE_TERM_LENGTH = 32
+MESSAGE_TERMS_MAX = 200  # distinct words indexed per message
+SEARCH_QUERY_TERMS_MAX = 8
+SEARCH_PAGE_SIZE = 20
+SEARCH_PAGE_SIZE_MAX = 50
+SEARCH_OFFSET_MAX = 500
+
+def text_terms(text, limit=MESSAGE_TERMS_MAX):
+    """{term: occurrences} for the first `limit` distinct words of text, case-folded"""
+    terms = {}
+    for match in MESSAGE_TERM_PATTERN.finditer(text.casefold()):
+        term = match.group()[:MESSAGE_TERM_LENGTH]
+        if term in terms:
+            terms[term] += 1
+        elif len(terms) < limit:
+            terms[term] = 1
+    return terms
+
+def message_term_rows(message_id, message_text, sent_at, conversation_id=None, group_id=None):
+    """message_terms rows for one message, for index_messages"""
+    return [
+        {'term': term, 'conversation_id': conversation_id, 'group_id': group_id,
+         'message_id': message_id, 'occurrences': occurrences, 'sent_at': sent_at}
+        for term, occurrences in text_terms(message_text).items()
+    ]
+
+def index_messages(rows):
+    """Insert the term rows of a batch of messages in one INSERT"""
+    if rows:
+        db.session.execute(db.insert(MessageTerm), rows)
+
+def unindex_message(message_id):
+    MessageTerm.query.filter(
+        MessageTerm.conversation_id.isnot(None),
+        MessageTerm.message_id == message_id
+    ).delete(synchronize_session=False)
+
+def rank_message_matches(user_id, terms, offset, limit, conversation_id=None, group_id=None):
+    """[(conversation_id, group_id, message_id, matched terms)] best first, one more than limit"""
+    if conversation_id is not None:
+        scope = MessageTerm.conversation_id == conversation_id
+    elif group_id is not None:
+        scope = MessageTerm.group_id == group_id
+    else:
+        scope = MessageTerm.conversation_id.in_(
+            db.select(Conversation.id).where(
+                (Conversation.user_a_id == user_id) | (Conversation.user_b_id == user_id)
+            )
+        ) | MessageTerm.group_id.in_(
+            db.select(GroupMember.group_id).where(GroupMember.user_id == user_id)
+        )
+    matched = db.func.count(MessageTerm.id)
+    return db.session.query(
+        MessageTerm.conversation_id, MessageTerm.group_id, MessageTerm.message_id, matched
+    ).filter(
+        MessageTerm.term.in_(terms), scope
+    ).group_by(
+        MessageTerm.conversation_id, MessageTerm.group_id, MessageTerm.message_id
+    ).order_by(
+        matched.desc(), db.func.sum(MessageTerm.occurrences).desc(),
+        db.func.max(MessageTerm.sent_at).desc(), MessageTerm.message_id.desc()
+    ).offset(offset).limit(limit + 1).all()
+
+# Send pipeline: messages from every socket are queued here and written in
+# batches, so a burst of sends costs one transaction instead of one each.
+SEND_BATCH_MAX_SIZE = 100
+SEND_BATCH_MAX_WAIT = 0.01  # seconds to wait for more messages after the first
+send_queue = LightQueue()
+send_pipeline_task = None
+send_pipeline_stats = {
+    'messages': 0,
+    'group_messages': 0,
+    'batches': 0,
+    'failed_batches': 0,
+    'failed_messages': 0,
+    'last_batch_size': 0,
+    'max_batch_size': 0,
+    'total_flush_seconds': 0.0,
+    'last_flush_seconds': 0.0,
+    'max_flush_seconds': 0.0,
+    'total_queue_seconds': 0.0,
+    'max_queue_seconds': 0.0
+}
+
+def queue_outgoing_message(sender_id, receiver_id, message_text, sid, group_id=None):
+    """Queue a message to receiver_id, or to every member of group_id"""
+    global send_pipeline_task
+    if send_pipeline_task is None:
+        send_pipeline_task = socketio.start_background_task(run_send_pipeline)
+    send_queue.put({
+        'sender_id': sender_id,
+        'receiver_id': receiver_id,
+        'group_id': group_id,
+        'message_text': message_text,
+        'sid': sid,
+        'sent_at': datetime.utcnow(),
+        'queued_at': time.monotonic()
+    })
+
+def run_send_pipeline():
+    while True:
+        batch = [send_queue.get()]
+        deadline = time.monotonic() + SEND_BATCH_MAX_WAIT
+        while len(batch) < SEND_BATCH_MAX_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(send_queue.get(timeout=remaining))
+            except Empty:
+                break
+        
+        with app.app_context():
+            flushed = []
+            try:
+                flushed.append(flush_send_batch(batch))
+            except Exception as e:
+                db.session.rollback()
+                send_pipeline_stats['failed_batches'] += 1
+                print(f"Send message error: {e}")
+                # One bad message must not lose the rest of the batch
+                for item in batch:
+                    try:
+                        flushed.append(flush_send_batch([item]))
+                    except Exception as e:
+                        db.session.rollback()
+                        print(f"Send message error: {e}")
+                        report_failed_message(item, 'error')
+            
+            # Committed already, so a failed emit must not write them again
+            for result in flushed:
+                try:
+                    deliver_send_batch(*result)
+                except Exception as e:
+                    print(f"Send delivery error: {e}")
+
+def report_failed_message(item, reason):
+    """Tell the sending socket its message was not stored"""
+    send_pipeline_stats['failed_messages'] += 1
+    socketio.emit('message_failed', {
+        'receiver_id': item['receiver_id'],
+        'group_id': item['group_id'],
+        'message_text': item['message_text'],
+        'reason': reason
+    }, room=item['sid'])
+
+def flush_send_batch(batch):
+    """Write a batch in one transaction; returns the arguments for deliver_send_batch"""
+    started = time.monotonic()
+    
+    # Sender names and photos for the whole batch, mostly from the cache
+    senders = user_profiles.get_many(item['sender_id'] for item in batch)
+    
+    items = [item for item in batch if item['sender_id'] in senders]
+    group_items = [item for item in items if item['group_id'] is not None]
+    items = [item for item in items if item['group_id'] is None]
+    conversations = get_or_create_conversation_ids(
+        (item['sender_id'], item['receiver_id']) for item in items
+    )
+    
+    # Save messages to database in one INSERT; the Message objects only carry
+    # the rows and their new ids, they aren't added to the session
+    rows = [{
+        'conversation_id': conversations[ordered_pair(item['sender_id'], item['receiver_id'])],
+        'sender_id': item['sender_id'],
+        'receiver_id': item['receiver_id'],
+        'message_text': item['message_text'],
+        'sent_at': item['sent_at']
+    } for item in items]
+    messages = [
+        (item, Message(id=message_id, **row))
+        for item, row, message_id in zip(items, rows, insert_rows(Message, rows))
+    ]
+    
+    # One summary and unread update per conversation in the batch; messages
+    # are in id order, so the last one seen for a conversation is its newest
+    summaries = {}
+    unread_increments = {}
+    for item, message in messages:
+        summaries[message.conversation_id] = {
+            Conversation.last_message_id: message.id,
+            Conversation.last_sender_id: message.sender_id,
+            Conversation.last_text: message.message_text[:LAST_TEXT_LENGTH],
+            Conversation.last_sent_at: message.sent_at
+        }
+        increments = unread_increments.setdefault(message.conversation_id, {})
+        unread_count = side_column(message.receiver_id, message.sender_id, 'unread_count')
+        increments[unread_count] = increments.get(unread_count, 0) + 1
+    for conversation_id, values in summaries.items():
+        for unread_count, amount in unread_increments[conversation_id].items():
+            values[unread_count] = unread_count + amount
+        Conversation.query.filter(Conversation.id == conversation_id).update(
+            values, synchronize_session=False
+        )
+    
+    # Serialized before the commit expires the rows; the change log gets the
+    # same payload the sockets do
+    deliveries = []
+    changes = []
+    for item, message in messages:
+        sender = senders[message.sender_id]
+        message_data = {
+            'id': message.id,
+            'sender_id': message.sender_id,
+            'receiver_id': message.receiver_id,
+            'message_text': message.message_text,
+            'is_seen': False,
+            'sent_at': item['sent_at'].isoformat(),
+            'sender_name': sender['username'],
+            'sender_photo': sender['profile_photo'],
+            'sender_photo_url': photo_url(sender['profile_photo'], 48)
+        }
+        changes.append(((message.receiver_id, message.sender_id), 'message', message_data))
+        deliveries.append((item, message_data))
+    record_changes(changes)
+    
+    # Receivers connected now get the batch live, so it counts as delivered
+    online = presence.online_among({message.receiver_id for item, message in messages})
+    advance_delivered_watermarks({
+        message.receiver_id: message.id for item, message in messages if message.receiver_id in online
+    })
+    group_deliveries = save_group_messages(group_items, senders)
+    
+    # Searchable from the same commit that makes them visible
+    term_rows = []
+    for item, message in messages:
+        term_rows += message_term_rows(message.id, message.message_text, message.sent_at,
+                                       conversation_id=message.conversation_id)
+    for item, message_data in group_deliveries:
+        term_rows += message_term_rows(message_data['id'], message_data['message_text'], item['sent_at'],
+                                       group_id=message_data['group_id'])
+    index_messages(term_rows)
+    db.session.commit()
+    return batch, senders, deliveries, group_deliveries, started, time.monotonic()
+
+def deliver_send_batch(batch, senders, deliveries, group_deliveries, started, flushed):
+    """Acknowledge and deliver a committed batch"""
+    flush_seconds = flushed - started
+    queue_seconds = max(started - item['queued_at'] for item in batch)
+    send_pipeline_stats['messages'] += len(deliveries) + len(group_deliveries)
+    send_pipeline_stats['group_messages'] += len(group_deliveries)
+    send_pipeline_stats['batches'] += 1
+    send_pipeline_stats['last_batch_size'] = len(batch)
+    send_pipeline_stats['max_batch_size'] = max(send_pipeline_stats['max_batch_size'], len(batch))
+    send_pipeline_stats['total_flush_seconds'] += flush_seconds
+    send_pipeline_stats['last_flush_seconds'] = flush_seconds
+    send_pipeline_stats['max_flush_seconds'] = max(send_pipeline_stats['max_flush_seconds'], flush_seconds)
+    send_pipeline_stats['total_queue_seconds'] += queue_seconds
+    send_pipeline_stats['max_queue_seconds'] = max(send_pipeline_stats['max_queue_seconds'], queue_seconds)
+    
+    # Each message is packed and emitted only in the formats someone listens in
+    formats = listening_formats(
+        {message_data['receiver_id'] for item, message_data in deliveries} |
+        {message_data['sender_id'] for item, message_data in deliveries}
+    )
+    for item, message_data in deliveries:
+        receiver_formats = formats[message_data['receiver_id']]
+        sender_formats = formats[message_data['sender_id']]
+        compact_sender = item['sid'] in compact_sids
+        packed = None
+        if compact_sender or True in receiver_formats or True in sender_formats:
+            packed = wire.pack_message(
+                message_data['id'], message_data['sender_id'], message_data['receiver_id'],
+                message_data['message_text'], item['sent_at']
+            )
+        
+        # Send to receiver if they have a room
+        for compact in receiver_formats:
+            socketio.emit('new_message', packed if compact else message_data,
+                          room=message_room(message_data['receiver_id'], compact))
+        
+        # Send to sender as confirmation
+        socketio.emit('message_sent', packed if compact_sender else message_data, room=item['sid'])
+        
+        # Update sender's own chat if they're viewing the conversation
+        for compact in sender_formats:
+            socketio.emit('new_message_self', packed if compact else message_data,
+                          room=message_room(message_data['sender_id'], compact))
+    
+    # Reported once the batch is committed, so a retried batch doesn't repeat it
+    for item in batch:
+        if item['sender_id'] not in senders:
+            report_failed_message(item, 'unknown_sender')
+    
+    # One emit per group message, however many members are listening
+    for item, message_data in group_deliveries:
+        socketio.emit('new_group_message', message_data, room=group_room(message_data['group_id']))
+        socketio.emit('group_message_sent', message_data, room=item['sid'])
+
+# Presence registry: which user each connected socket belongs to.
+# A user can have several sockets (one per tab) and stays online until the
+# last one goes. The in-process registry only sees this worker's sockets; set
+# PRESENCE_REGISTRY_URL (redis://...) to share presence between workers.
+class PresenceRegistry(ABC):
+    @abstractmethod
+    def add(self, user_id, sid):
+        """Register a socket. Returns True if this is the user's first socket."""
+    
+    @abstractmethod
+    def remove_sid(self, sid):
+        """Forget a socket. Returns (user_id, went_offline); user_id is None for unknown sockets."""
+    
+    @abstractmethod
+    def remove_user(self, user_id):
+        """Forget all of a user's sockets. Returns True if the user was online."""
+    
+    @abstractmethod
+    def sids_for(self, user_id):
+        """The user's socket ids"""
+    
+    @abstractmethod
+    def is_online(self, user_id):
+        """Whether the user has any socket"""
+    
+    @abstractmethod
+    def online_among(self, user_ids):
+        """The subset of user_ids that are online"""
+    
+    @abstractmethod
+    def online_user_ids(self):
+        """Every online user id"""
+
+class LocalPresenceRegistry(PresenceRegistry):
+    def __init__(self):
+        self.sid_users = {}  # {socket_id: user_id}
+        self.user_sids = {}  # {user_id: set of socket_ids}
+    
+    def add(self, user_id, sid):
+        previous_user_id = self.sid_users.get(sid)
+        if previous_user_id == user_id:
+            return False
+        if previous_user_id is not None:
+            self.remove_sid(sid)
+        self.sid_users[sid] = user_id
+        sids = self.user_sids.setdefault(user_id, set())
+        sids.add(sid)
+        return len(sids) == 1
+    
+    def remove_sid(self, sid):
+        user_id = self.sid_users.pop(sid, None)
+        if user_id is None:
+            return None, False
+        sids = self.user_sids.get(user_id)
+        if sids is not None:
+            sids.discard(sid)
+            if sids:
+                return user_id, False
+            del self.user_sids[user_id]
+        return user_id, True
+    
+    def remove_user(self, user_id):
+        sids = self.user_sids.pop(user_id, None)
+        if not sids:
+            return False
+        for sid in sids:
+            self.sid_users.pop(sid, None)
+        return True
+    
+    def sids_for(self, user_id):
+        return set(self.user_sids.get(user_id, ()))
+    
+    def is_online(self, user_id):
+        return user_id in self.user_sids
+    
+    def online_among(self, user_ids):
+        return {user_id for user_id in user_ids if user_id in self.user_sids}
+    
+    def online_user_ids(self):
+        return set(self.user_sids)
+
+class RedisPresenceRegistry(PresenceRegistry):
+    def __init__(self, url, prefix='teletok:presence'):
+        import redis
+        self.redis = redis.Redis.from_url(url, decode_responses=True)
+        self.prefix = prefix
+        self.sids_key = f'{prefix}:sids'  # hash {socket_id: user_id}
+        self.online_key = f'{prefix}:online'  # set of online user ids
+    
+    def user_key(self, user_id):
+        return f'{self.prefix}:user:{user_id}'  # set of the user's socket ids
+    
+    def add(self, user_id, sid):
+        previous_user_id = self.redis.hget(self.sids_key, sid)
+        if previous_user_id is not None:
+            if int(previous_user_id) == user_id:
+                return False
+            self.remove_sid(sid)
+        pipe = self.redis.pipeline()
+        pipe.hset(self.sids_key, sid, user_id)
+        pipe.sadd(self.user_key(user_id), sid)
+        pipe.sadd(self.online_key, user_id)
+        pipe.scard(self.user_key(user_id))
+        return pipe.execute()[-1] == 1
+    
+    def remove_sid(self, sid):
+        user_id = self.redis.hget(self.sids_key, sid)
+        if user_id is None:
+            return None, False
+        user_id = int(user_id)
+        pipe = self.redis.pipeline()
+        pipe.hdel(self.sids_key, sid)
+        pipe.srem(self.user_key(user_id), sid)
+        pipe.scard(self.user_key(user_id))
+        if pipe.execute()[-1]:
+            return user_id, False
+        self.redis.srem(self.online_key, user_id)
+        return user_id, True
+    
+    def remove_user(self, user_id):
+        sids = self.redis.smembers(self.user_key(user_id))
+        pipe = self.redis.pipeline()
+        if sids:
+            pipe.hdel(self.sids_key, *sids)
+        pipe.delete(self.user_key(user_id))
+        pipe.srem(self.online_key, user_id)
+        pipe.execute()
+        return bool(sids)
+    
+    def sids_for(self, user_id):
+        return self.redis.smembers(self.user_key(user_id))
+    
+    def is_online(self, user_id):
+        return bool(self.redis.sismember(self.online_key, user_id))
+    
+    def online_among(self, user_ids):
+        user_ids = list(user_ids)
+        if not user_ids:
+            return set()
+        return {user_id for user_id, online in zip(user_ids, self.redis.smismember(self.online_key, user_ids)) if online}
+    
+    def online_user_ids(self):
+        return {int(user_id) for user_id in self.redis.smembers(self.online_key)}
+
+presence_registry_url = os.environ.get('PRESENCE_REGISTRY_URL')
+if presence_registry_url:
+    presence = RedisPresenceRegistry(presence_registry_url)
+else:
+    presence = LocalPresenceRegistry()
+
+# Message room registry: how many sockets listen in each format to each
+# user's message rooms (see message_room), so a message is only packed and
+# emitted in the formats someone will receive. It is shared through
+# PRESENCE_REGISTRY_URL like presence. Counts left behind by a worker that
+# died only cost an emit nobody receives.
+class MessageRoomRegistry(ABC):
+    @abstractmethod
+    def join(self, user_id, compact, sid):
+        """Record a socket joining the user's message room for its format"""
+    
+    @abstractmethod
+    def leave(self, sid):
+        """Forget a socket; unknown sockets are ignored"""
+    
+    @abstractmethod
+    def formats_among(self, user_ids):
+        """{user_id: set of compact flags with a socket listening} for every user id"""
+
+class LocalMessageRoomRegistry(MessageRoomRegistry):
+    def __init__(self):
+        self.sid_rooms = {}  # {socket_id: (user_id, compact)}
+        self.room_sizes = {}  # {(user_id, compact): sockets}
+    
+    def join(self, user_id, compact, sid):
+        room = (user_id, compact)
+        previous_room = self.sid_rooms.get(sid)
+        if previous_room == room:
+            return
+        if previous_room is not None:
+            self.leave(sid)
+        self.sid_rooms[sid] = room
+        self.room_sizes[room] = self.room_sizes.get(room, 0) + 1
+    
+    def leave(self, sid):
+        room = self.sid_rooms.pop(sid, None)
+        if room is None:
+            return
+        self.room_sizes[room] -= 1
+        if not self.room_sizes[room]:
+            del self.room_sizes[room]
+    
+    def formats_among(self, user_ids):
+        return {
+            user_id: {compact for compact in (False, True) if (user_id, compact) in self.room_sizes}
+            for user_id in user_ids
+        }
+
+class RedisMessageRoomRegistry(MessageRoomRegistry):
+    def __init__(self, url, prefix='teletok:rooms'):
+        import redis
+        self.redis = redis.Redis.from_url(url, decode_responses=True)
+        self.prefix = prefix
+        self.sids_key = f'{prefix}:sids'  # hash {socket_id: message room}
+    
+    def sizes_key(self, user_id):
+        return f'{self.prefix}:user:{user_id}'  # hash {'json' or 'compact': sockets}
+    
+    def join(self, user_id, compact, sid):
+        room = message_room(user_id, compact)
+        previous_room = self.redis.hget(self.sids_key, sid)
+        if previous_room == room:
+            return
+        if previous_room is not None:
+            self.leave(sid)
+        pipe = self.redis.pipeline()
+        pipe.hset(self.sids_key, sid, room)
+        pipe.hincrby(self.sizes_key(user_id), 'compact' if compact else 'json', 1)
+        pipe.execute()
+    
+    def leave(self, sid):
+        room = self.redis.hget(self.sids_key, sid)
+        if room is None:
+            return
+        user_id, protocol = room.split(':')
+        pipe = self.redis.pipeline()
+        pipe.hdel(self.sids_key, sid)
+        pipe.hincrby(self.sizes_key(user_id), protocol, -1)
+        pipe.execute()
+    
+    def formats_among(self, user_ids):
+        user_ids = list(user_ids)
+        pipe = self.redis.pipeline()
+        for user_id in user_ids:
+            pipe.hgetall(self.sizes_key(user_id))
+        return {
+            user_id: {protocol == 'compact' for protocol, sockets in sizes.items() if int(sockets) > 0}
+            for user_id, sizes in zip(user_ids, pipe.execute())
+        }
+
+if presence_registry_url:
+    message_rooms = RedisMessageRoomRegistry(presence_registry_url)
+elif message_queue:
+    # Other workers' sockets can't be counted, so every format is emitted
+    message_rooms = None
+else:
+    message_rooms = LocalMessageRoomRegistry()
+
+def listening_formats(user_ids):
+    """{user_id: set of compact flags} to emit a user's messages in"""
+    if message_rooms is None:
+        return {user_id: {False, True} for user_id in user_ids}
+    return message_rooms.formats_among(user_ids)
+
+# User profile cache: profile columns by user id, loaded on first use, kept
+# in LRU order up to USER_CACHE_MAX_ENTRIES and reloaded after USER_CACHE_TTL
+# seconds. Code that writes a user row calls invalidate(); with several
+# workers the invalidation is also published on USER_CACHE_INVALIDATION_URL
+# (redis://... or local://..., defaulting to SOCKETIO_MESSAGE_QUEUE) so every
+# worker drops its copy.
+USER_CACHE_MAX_ENTRIES = 10000
+USER_CACHE_TTL = 60
+USER_PROFILE_FIELDS = ('id', 'username', 'phone', 'profile_photo', 'is_online', 'last_seen')
+
+class RedisInvalidationChannel:
+    def __init__(self, url, channel='teletok:user-cache'):
+        import redis
+        self.redis = redis.Redis.from_url(url)
+        self.channel = channel
+    
+    def publish(self, data):
+        self.redis.publish(self.channel, json.dumps(data))
+    
+    def listen(self):
+        pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(self.channel)
+        try:
+            for message in pubsub.listen():
+                if message['type'] == 'message':
+                    yield json.loads(message['data'])
+        finally:
+            pubsub.close()
+
+class UserProfileCache:
+    def __init__(self, max_entries, ttl, channel=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.channel = channel
+        self.listening = False
+        self.entries = OrderedDict()  # {user_id: (expires_at, profile)}
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0,
+            'expirations': 0,
+            'invalidations': 0,
+            'remote_invalidations': 0,
+        }
+    
+    def get(self, user_id):
+        """Profile dict for a user, or None if there is no such user"""
+        return self.get_many([user_id]).get(int(user_id))
+    
+    def get_many(self, user_ids):
+        """{user_id: profile} for the users that exist; misses load in one query"""
+        self.start_listening()
+        now = time.monotonic()
+        profiles = {}
+        missing = []
+        for user_id in {int(user_id) for user_id in user_ids}:
+            entry = self.entries.get(user_id)
+            if entry is not None and entry[0] > now:
+                self.entries.move_to_end(user_id)
+                profiles[user_id] = entry[1]
+                continue
+            if entry is not None:
+                del self.entries[user_id]
+                self.stats['expirations'] += 1
+            missing.append(user_id)
+        self.stats['hits'] += len(profiles)
+        self.stats['misses'] += len(missing)
+        
+        if missing:
+            rows = db.session.query(
+                *[getattr(User, field) for field in USER_PROFILE_FIELDS]
+            ).filter(User.id.in_(missing)).all()
+            for row in rows:
+                profile = dict(zip(USER_PROFILE_FIELDS, row))
+                self.put(profile, now)
+                profiles[profile['id']] = profile
+        return profiles
+    
+    def put(self, profile, now):
+        self.entries[profile['id']] = (now + self.ttl, profile)
+        self.entries.move_to_end(profile['id'])
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.stats['evictions'] += 1
+    
+    def invalidate(self, *user_ids):
+        """Drop users here and on every other worker"""
+        user_ids = [int(user_id) for user_id in user_ids]
+        self.drop(user_ids)
+        if self.channel is not None:
+            try:
+                self.channel.publish({'method': 'invalidate_user_profiles', 'user_ids': user_ids})
+            except Exception as e:
+                # Other workers fall back on the TTL
+                print(f"User cache invalidation publish error: {e}")
+    
+    def drop(self, user_ids):
+        for user_id in user_ids:
+            if self.entries.pop(user_id, None) is not None:
+                self.stats['invalidations'] += 1
+    
+    def start_listening(self):
+        if self.channel is None or self.listening:
+            return
+        self.listening = True
+        socketio.start_background_task(self.listen)
+    
+    def listen(self):
+        while True:
+            try:
+                for message in self.channel.listen():
+                    # A shared local:// broker also carries Socket.IO traffic
+                    if isinstance(message, dict) and message.get('method') == 'invalidate_user_profiles':
+                        self.drop(message['user_ids'])
+                        self.stats['remote_invalidations'] += 1
+            except Exception as e:
+                print(f"User cache invalidation listener error: {e}")
+            # Entries may have changed while disconnected
+            self.entries.clear()
+            socketio.sleep(1)
+
+user_cache_invalidation_url = os.environ.get('USER_CACHE_INVALIDATION_URL', message_queue)
+if user_cache_invalidation_url and user_cache_invalidation_url.startswith('local://'):
+    from local_queue import LocalQueueClient
+    user_profiles = UserProfileCache(USER_CACHE_MAX_ENTRIES, USER_CACHE_TTL, LocalQueueClient(user_cache_invalidation_url))
+elif user_cache_invalidation_url and user_cache_invalidation_url.startswith(('redis://', 'rediss://')):
+    user_profiles = UserProfileCache(USER_CACHE_MAX_ENTRIES, USER_CACHE_TTL, RedisInvalidationChannel(user_cache_invalidation_url))
+else:
+    user_profiles = UserProfileCache(USER_CACHE_MAX_ENTRIES, USER_CACHE_TTL)
+
+# Contact adjacency {user_id: set of contact user ids}, loaded on first use
+# and dropped whenever add_contact changes a user's contacts
+contact_cache = {}
+
+def get_contact_ids(user_id):
+    contact_ids = contact_cache.get(user_id)
+    if contact_ids is None:
+        contact_ids = {
+            contact_id for (contact_id,) in db.session.query(Contact.contact_id).filter(
+                Contact.user_id == user_id
+            ).all()
+        }
+        contact_cache[user_id] = contact_ids
+    return contact_ids
+
+def invalidate_contacts(*user_ids):
+    for user_id in user_ids:
+        contact_cache.pop(user_id, None)
+
+def are_contacts(user_id, other_ids):
+    """Whether every one of other_ids is a contact of user_id"""
+    if other_ids <= get_contact_ids(user_id):
+        return True
+    # The cached set may predate a contact added through another worker
+    invalidate_contacts(user_id)
+    return other_ids <= get_contact_ids(user_id)
+
+def emit_presence(user_id, is_online, last_seen=None):
+    """Send a user_status update to the user's contacts only"""
+    user_id = int(user_id)
+    status = {'user_id': user_id, 'is_online': is_online}
+    if last_seen:
+        status['last_seen'] = last_seen.isoformat()
+    for contact_id in get_contact_ids(user_id):
+        socketio.emit('user_status', status, room=str(contact_id))
+
+# Presence writer: online/offline changes are held in memory and written to
+# users.is_online/last_seen in periodic bulk UPDATEs. A user who disconnects
+# and comes back within the grace period is never marked offline, so neither
+# the database nor their contacts see the flap.
+PRESENCE_GRACE_PERIOD = 10  # seconds
+PRESENCE_FLUSH_INTERVAL = 5  # seconds
+
+class PresenceWriter:
+    def __init__(self, grace_period, flush_interval):
+        self.grace_period = grace_period
+        self.flush_interval = flush_interval
+        self.unflushed = {}  # {user_id: (is_online, last_seen)} not yet in the database
+        self.pending_offline = {}  # {user_id: (deadline, last_seen)} inside the grace period
+        self.last_flush = time.monotonic()
+        self.stats = {
+            'changes': 0,
+            'flaps_suppressed': 0,
+            'flushes': 0,
+            'rows_written': 0,
+            'writes_avoided': 0,
+            'failed_flushes': 0
+        }
+    
+    def came_online(self, user_id):
+        if self.pending_offline.pop(user_id, None):
+            # Back within the grace period; contacts never saw them leave
+            self.stats['flaps_suppressed'] += 1
+            self.stats['writes_avoided'] += 2
+            return
+        self.record(user_id, True, datetime.utcnow())
+        emit_presence(user_id, True)
+    
+    def went_offline(self, user_id):
+        self.pending_offline[user_id] = (time.monotonic() + self.grace_period, datetime.utcnow())
+        self.start()
+    
+    def logged_out(self, user_id, notify):
+        """Explicit logout skips the grace period"""
+        self.pending_offline.pop(user_id, None)
+        last_seen = datetime.utcnow()
+        self.record(user_id, False, last_seen)
+        if notify:
+            emit_presence(user_id, False, last_seen)
+    
+    def record(self, user_id, is_online, last_seen):
+        self.stats['changes'] += 1
+        if user_id in self.unflushed:
+            # Overwrites a change that was never written
+            self.stats['writes_avoided'] += 1
+        self.unflushed[user_id] = (is_online, last_seen)
+        self.start()
+    
+    def resolve(self, user_id, is_online, last_seen):
+        """Current (is_online, last_seen), preferring changes not yet flushed"""
+        return self.unflushed.get(user_id, (is_online, last_seen))
+    
+    def start(self):
+        start_background_loop('presence_writer', 1, self.tick)
+    
+    def tick(self):
+        now = time.monotonic()
+        expired = [
+            (user_id, last_seen) for user_id, (deadline, last_seen) in self.pending_offline.items()
+            if deadline <= now
+        ]
+        for user_id, last_seen in expired:
+            del self.pending_offline[user_id]
+            if presence.is_online(user_id):
+                # Reconnected during the grace period, possibly to another worker
+                self.stats['flaps_suppressed'] += 1
+                self.stats['writes_avoided'] += 2
+                continue
+            self.record(user_id, False, last_seen)
+            emit_presence(user_id, False, last_seen)
+        
+        if self.unflushed and now - self.last_flush >= self.flush_interval:
+            self.flush()
+    
+    def flush(self):
+        batch, self.unflushed = self.unflushed, {}
+        self.last_flush = time.monotonic()
+        try:
+            db.session.execute(db.update(User), [
+                {'id': user_id, 'is_online': is_online, 'last_seen': last_seen}
+                for user_id, (is_online, last_seen) in batch.items()
+            ])
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            self.stats['failed_flushes'] += 1
+            # Keep the batch for the next flush unless it has been superseded
+            for user_id, state in batch.items():
+                self.unflushed.setdefault(user_id, state)
+            print(f"Presence flush error: {e}")
+            return
+        self.stats['flushes'] += 1
+        self.stats['rows_written'] += len(batch)
+        user_profiles.invalidate(*batch)
+
+presence_writer = PresenceWriter(PRESENCE_GRACE_PERIOD, PRESENCE_FLUSH_INTERVAL)
+
+# Offline delivery: messages sent to a user with no socket connected wait
+# above their delivered watermark (users.last_delivered_id). When they come
+# back, user_online pushes them in a few pending_messages emits grouped by
+# sender and moves the watermark in one UPDATE, instead of the client pulling
+# every chat's history.
+PENDING_DELIVERY_MAX = 1000  # newest messages pushed; older ones stay in history
+PENDING_DELIVERY_BATCH = 200  # messages per emit
+
+def advance_delivered_watermarks(watermarks):
+    """Move {user_id: message_id} watermarks forward in one executemany UPDATE"""
+    if not watermarks:
+        return
+    users = User.__table__
+    db.session.execute(
+        users.update().where(
+            users.c.id == db.bindparam('user_id'),
+            users.c.last_delivered_id < db.bindparam('message_id')
+        ).values(last_delivered_id=db.bindparam('message_id')),
+        [{'user_id': user_id, 'message_id': message_id} for user_id, message_id in watermarks.items()]
+    )
+
+def deliver_pending_messages(user_id, sid):
+    # Newest first, so a long absence keeps the most recent messages
+    rows = db.session.query(
+        Message.id, Message.sender_id, Message.message_text, Message.sent_at
+    ).join(
+        User, User.id == Message.receiver_id
+    ).filter(
+        Message.receiver_id == user_id,
+        Message.id > User.last_delivered_id
+    ).order_by(Message.id.desc()).limit(PENDING_DELIVERY_MAX + 1).all()
+    if not rows:
+        return
+    truncated = len(rows) > PENDING_DELIVERY_MAX
+    rows = rows[:PENDING_DELIVERY_MAX]
+    rows.reverse()
+    
+    advance_delivered_watermarks({user_id: rows[-1].id})
+    db.session.commit()
+    
+    # {sender_id: [message]} in order of each sender's first pending message
+    by_sender = {}
+    for message_id, sender_id, message_text, sent_at in rows:
+        by_sender.setdefault(sender_id, []).append({
+            'id': message_id,
+            'message_text': message_text,
+            'sent_at': sent_at.isoformat()
+        })
+    senders = user_profiles.get_many(by_sender)
+    
+    batch = []
+    batch_size = 0
+    for sender_id, messages in by_sender.items():
+        sender = senders.get(sender_id)
+        while messages:
+            room_left = PENDING_DELIVERY_BATCH - batch_size
+            chunk, messages = messages[:room_left], messages[room_left:]
+            batch.append({
+                'sender_id': sender_id,
+                'sender_name': sender['username'] if sender else None,
+                'sender_photo_url': photo_url(sender['profile_photo'], 48) if sender else None,
+                'messages': chunk
+            })
+            batch_size += len(chunk)
+            if batch_size == PENDING_DELIVERY_BATCH:
+                socketio.emit('pending_messages', {'senders': batch, 'truncated': truncated}, room=sid)
+                batch = []
+                batch_size = 0
+    if batch:
+        socketio.emit('pending_messages', {'senders': batch, 'truncated': truncated}, room=sid)
+
+# Typing relay: clients may emit typing on every keystroke, so the server keeps
+# whether each sender is typing to each receiver and forwards only the
+# changes. While typing continues, is_typing is re-sent at most once per
+# refresh interval; a sender who goes quiet without a stop is expired after
+# the timeout. Receivers with no connected socket get nothing.
+TYPING_REFRESH_INTERVAL = 3  # seconds
+TYPING_TIMEOUT = 6  # seconds
+
+class TypingRelay:
+    def __init__(self, refresh_interval, timeout):
+        self.refresh_interval = refresh_interval
+        self.timeout = timeout
+        self.typing = {}  # {(sender_id, receiver_id): (last_forwarded, last_event)} while typing
+        self.stats = {
+            'received': 0,
+            'forwarded': 0,
+            'throttled': 0,
+            'duplicates': 0,
+            'offline_dropped': 0,
+            'expired': 0
+        }
+    
+    def update(self, sender_id, receiver_id, is_typing):
+        self.stats['received'] += 1
+        key = (sender_id, receiver_id)
+        now = time.monotonic()
+        state = self.typing.get(key)
+        
+        if not is_typing:
+            if state is None:
+                # Already stopped
+                self.stats['duplicates'] += 1
+                return
+            del self.typing[key]
+            self.forward(sender_id, receiver_id, False)
+            return
+        
+        if state is not None and now - state[0] < self.refresh_interval:
+            self.typing[key] = (state[0], now)
+            self.stats['throttled'] += 1
+            return
+        if self.forward(sender_id, receiver_id, True):
+            self.typing[key] = (now, now)
+            self.start()
+        else:
+            self.typing.pop(key, None)
+    
+    def forward(self, sender_id, receiver_id, is_typing):
+        if not presence.is_online(receiver_id):
+            self.stats['offline_dropped'] += 1
+            return False
+        socketio.emit('user_typing', {
+            'sender_id': sender_id,
+            'is_typing': is_typing
+        }, room=str(receiver_id))
+        self.stats['forwarded'] += 1
+        return True
+    
+    def start(self):
+        start_background_loop('typing_relay', 1, self.tick)
+    
+    def tick(self):
+        now = time.monotonic()
+        expired = [
+            key for key, (last_forwarded, last_event) in self.typing.items()
+            if now - last_event >= self.timeout
+        ]
+        for sender_id, receiver_id in expired:
+            del self.typing[(sender_id, receiver_id)]
+            self.stats['expired'] += 1
+            self.forward(sender_id, receiver_id, False)
+
+typing_relay = TypingRelay(TYPING_REFRESH_INTERVAL, TYPING_TIMEOUT)
+
+# Rate limits: a token bucket per user and socket event. Each event takes a
+# token and buckets refill at `rate` tokens a second up to `burst`. An event
+# over the limit is not handled; the client gets a rate_limited emit saying
+# how long to wait. The in-process limiter only sees this worker's events;
+# set RATE_LIMIT_STORE_URL (redis://...) to share buckets between workers.
+# SOCKET_RATE_LIMITS overrides the defaults, e.g. "send_message=5/20,typing=off".
+DEFAULT_SOCKET_RATE_LIMITS = {
+    'send_message': (5, 20),
+    'message_seen': (10, 30),
+    'typing': (5, 10),
+    'sync': (1, 5),
+    'profiles': (2, 20),
+    'send_group_message': (5, 20),
+    'group_seen': (10, 30)
+}
+RATE_LIMIT_PRUNE_INTERVAL = 60  # seconds
+# Sends are refused while the pipeline is this far behind
+SEND_QUEUE_MAX_DEPTH = 5000
+
+def parse_rate_limits(spec, defaults):
+    """{event: (tokens per second, burst)} from "event=rate/burst,..." over the defaults"""
+    limits = dict(defaults)
+    for item in (spec or '').split(','):
+        if not item.strip():
+            continue
+        event_name, limit = (part.strip() for part in item.split('='))
+        if limit == 'off':
+            limits.pop(event_name, None)
+            continue
+        rate, burst = limit.split('/')
+        limits[event_name] = (float(rate), float(burst))
+    return limits
+
+class RateLimiter(ABC):
+    def __init__(self, limits):
+        self.limits = limits
+    
+    @abstractmethod
+    def acquire(self, key, event_name):
+        """Take a token. Returns 0 if the event may run, else seconds until it could."""
+    
+    def limited(self, event_name):
+        return event_name in self.limits
+
+class LocalRateLimiter(RateLimiter):
+    def __init__(self, limits):
+        super().__init__(limits)
+        self.buckets = {}  # {(key, event): (tokens, updated)}
+    
+    def acquire(self, key, event_name):
+        rate, burst = self.limits[event_name]
+        now = time.monotonic()
+        tokens, updated = self.buckets.get((key, event_name), (burst, now))
+        tokens = min(burst, tokens + (now - updated) * rate)
+        start_background_loop('rate_limit_prune', RATE_LIMIT_PRUNE_INTERVAL, self.prune)
+        if tokens >= 1:
+            self.buckets[(key, event_name)] = (tokens - 1, now)
+            return 0
+        self.buckets[(key, event_name)] = (tokens, now)
+        return (1 - tokens) / rate
+    
+    def prune(self):
+        """Drop buckets that have refilled; a missing bucket is a full one"""
+        now = time.monotonic()
+        for bucket_key, (tokens, updated) in list(self.buckets.items()):
+            rate, burst = self.limits[bucket_key[1]]
+            if tokens + (now - updated) * rate >= burst:
+                del self.buckets[bucket_key]
+
+class RedisRateLimiter(RateLimiter):
+    # Refill and take in one atomic step, on the Redis clock so workers agree
+    SCRIPT = """
+    redis.replicate_commands()
+    local rate = tonumber(ARGV[1])
+    local burst = tonumber(ARGV[2])
+    local clock = redis.call('TIME')
+    local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+    local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+    local tokens = tonumber(bucket[1]) or burst
+    local updated = tonumber(bucket[2]) or now
+    tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+    local wait = 0
+    if tokens >= 1 then
+        tokens = tokens - 1
+    else
+        wait = (1 - tokens) / rate
+    end
+    redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+    redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+    return tostring(wait)
+    """
+    
+    def __init__(self, limits, url, prefix='teletok:ratelimit'):
+        super().__init__(limits)
+        import redis
+        self.redis = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self.take = self.redis.register_script(self.SCRIPT)
+    
+    def acquire(self, key, event_name):
+        rate, burst = self.limits[event_name]
+        try:
+            return float(self.take(keys=[f'{self.prefix}:{key}:{event_name}'], args=[rate, burst]))
+        except Exception as e:
+            # Better to let events through than to stop chat when Redis is down
+            print(f"Rate limiter error: {e}")
+            return 0
+
+socket_rate_limits = parse_rate_limits(os.environ.get('SOCKET_RATE_LIMITS'), DEFAULT_SOCKET_RATE_LIMITS)
+rate_limit_store_url = os.environ.get('RATE_LIMIT_STORE_URL')
+if rate_limit_store_url:
+    rate_limiter = RedisRateLimiter(socket_rate_limits, rate_limit_store_url)
+else:
+    rate_limiter = LocalRateLimiter(socket_rate_limits)
+
+socket_events_refused = metrics_registry.counter(
+    'teletok_socket_events_refused_total', 'Socket events refused by rate limits or backpressure', ('event', 'reason')
+)
+
+def refuse_socket_event(event_name, reason, retry_after):
+    socket_events_refused.inc(event=event_name, reason=reason)
+    emit('rate_limited', {'event': event_name, 'reason': reason, 'retry_after': round(retry_after, 3)})
+    return {'success': False, 'message': 'Too many requests', 'retry_after': round(retry_after, 3)}
+
+def rate_limited(handler):
+    """Refuse the event when its user is over the limit; apply below @timed_socket_event"""
+    @functools.wraps(handler)
+    def wrapper(*args):
+        event_name = request.event['message']
+        if not rate_limiter.limited(event_name):
+            return handler(*args)
+        # Sockets without a logged-in session are limited on their own
+        wait = rate_limiter.acquire(session.get('user_id') or request.sid, event_name)
+        if wait:
+            return refuse_socket_event(event_name, 'limit', wait)
+        return handler(*args)
+    return wrapper
+
+# User search index: every 2-character slice of each username and phone maps
+# to the users containing it, so a substring search intersects a few small
+# sets instead of running LIKE '%q%' over the whole users table.
+class UserSearchIndex:
+    GRAM_SIZE = 2
+    
+    def __init__(self):
+        self.users = {}  # {user_id: (username_lower, phone)}
+        self.grams = {}  # {gram: set of user_ids}
+        self.loaded_at = None
+    
+    def split(self, text):
+        return {text[i:i + self.GRAM_SIZE] for i in range(len(text) - self.GRAM_SIZE + 1)}
+    
+    def user_grams(self, username, phone):
+        return self.split(username) | self.split(phone)
+    
+    def load(self):
+        users = {
+            user_id: (username.lower(), phone)
+            for user_id, username, phone in db.session.query(User.id, User.username, User.phone).all()
+        }
+        grams = {}
+        for user_id, (username, phone) in users.items():
+            for gram in self.user_grams(username, phone):
+                grams.setdefault(gram, set()).add(user_id)
+        self.users, self.grams = users, grams
+        self.loaded_at = time.monotonic()
+    
+    def ensure_loaded(self):
+        if self.loaded_at is None or time.monotonic() - self.loaded_at > SEARCH_INDEX_REFRESH:
+            self.load()
+    
+    def add(self, user_id, username, phone):
+        if self.loaded_at is None:
+            return
+        self.remove(user_id)
+        username = username.lower()
+        self.users[user_id] = (username, phone)
+        for gram in self.user_grams(username, phone):
+            self.grams.setdefault(gram, set()).add(user_id)
+    
+    def remove(self, user_id):
+        entry = self.users.pop(user_id, None)
+        if entry is None:
+            return
+        for gram in self.user_grams(*entry):
+            user_ids = self.grams.get(gram)
+            if user_ids is not None:
+                user_ids.discard(user_id)
+                if not user_ids:
+                    del self.grams[gram]
+    
+    def search(self, query, exclude_id=None, limit=SEARCH_RESULTS_LIMIT):
+        """Ids of users whose username or phone contains query, lowest id first"""
+        self.ensure_loaded()
+        query = query.lower()
+        postings = sorted((self.grams.get(gram, set()) for gram in self.split(query)), key=len)
+        if not postings or not postings[0]:
+            return []
+        candidates = postings[0].intersection(*postings[1:])
+        
+        results = []
+        for user_id in sorted(candidates):
+            if user_id == exclude_id:
+                continue
+            username, phone = self.users[user_id]
+            # Grams only narrow the candidates; confirm the actual substring
+            if query in username or query in phone:
+                results.append(user_id)
+                if len(results) >= limit:
+                    break
+        return results
+
+user_search_index = UserSearchIndex()
+
+# Search results {(user_id, query): (expires_at, users_data)}, dropped for a
+# user when their contacts change
+search_cache = {}
+SEARCH_CACHE_MAX_ENTRIES = 1000
+
+def invalidate_search_cache(*user_ids):
+    for key in [key for key in search_cache if key[0] in user_ids]:
+        del search_cache[key]
 
 # Serve HTML pages
 @app.route('/')
+@query_budget(0)
 def serve_index():
-    return send_file('login.html')
+    return static_manifest.response('login.html')
 
 @app.route('/login.html')
+@query_budget(0)
 def serve_login():
-    return send_file('login.html')
+    return static_manifest.response('login.html')
 
 @app.route('/register.html')
+@query_budget(0)
 def serve_register():
-    return send_file('register.html')
+    return static_manifest.response('register.html')
 
 @app.route('/dashboard.html')
+@query_budget(0)
 def serve_dashboard():
-    return send_file('dashboard.html')
+    return static_manifest.response('dashboard.html')
 
 @app.route('/settings.html')
+@query_budget(0)
 def serve_settings():
-    return send_file('settings.html')
+    return static_manifest.response('settings.html')
 
 # API Routes
 @app.route('/register', methods=['POST'])
+@query_budget(4)
 def register():
     try:
         data = request.json
@@ -231,6 +2201,9 @@ def register():
             print(f"Database commit error: {e}")
             return jsonify({'success': False, 'message': 'Registration failed due to database error'})
         
+        user_search_index.add(new_user.id, username, phone)
+        user_profiles.invalidate(new_user.id)
+        
         # Create session
         session['user_id'] = new_user.id
         session['username'] = username
@@ -243,6 +2216,7 @@ def register():
             'username': username,
             'phone': phone,
             'profile_photo': 'default.jpg',
+            'profile_photo_url': static_manifest.url('default.jpg'),
             'message': 'Registration successful'
         })
     except Exception as e:
@@ -251,6 +2225,7 @@ def register():
         return jsonify({'success': False, 'message': 'Registration failed'})
 
 @app.route('/login', methods=['POST'])
+@query_budget(3)
 def login():
     try:
         data = request.json
@@ -263,16 +2238,19 @@ def login():
         print(f"Error processing login request: {e}")
         return jsonify({'success': False, 'message': 'Invalid request format'})
     
-    hashed_password = hash_password(password)
-    
     try:
         try:
-            user = User.query.filter_by(phone=phone, password_hash=hashed_password).first()
+            user = User.query.filter_by(phone=phone).first()
         except Exception as db_error:
             print(f"Database query error (login): {db_error}")
             return jsonify({'success': False, 'message': 'Database error occurred'})
         
-        if user:
+        matches, needs_rehash = verify_password(password, user.password_hash if user else DUMMY_PASSWORD_HASH)
+        if user and matches:
+            # Upgrade old hashes now that we have the plain password
+            if needs_rehash:
+                user.password_hash = hash_password(password)
+            
             # Update last seen and online status
             user.last_seen = datetime.utcnow()
             user.is_online = True
@@ -293,7 +2271,8 @@ def login():
                 'user_id': user.id,
                 'username': user.username,
                 'phone': user.phone,
-                'profile_photo': user.profile_photo
+                'profile_photo': user.profile_photo,
+                'profile_photo_url': photo_url(user.profile_photo, 256)
             })
         else:
             return jsonify({'success': False, 'message': 'Invalid phone or password'})
@@ -302,30 +2281,14 @@ def login():
         return jsonify({'success': False, 'message': 'Login failed'})
 
 @app.route('/logout', methods=['POST'])
+@query_budget(0)
 def logout():
     user_id = session.get('user_id')
     if user_id:
         try:
-            user = User.query.get(user_id)
-            if user:
-                user.is_online = False
-                user.last_seen = datetime.utcnow()
-                try:
-                    db.session.commit()
-                except Exception as e:
-                    db.session.rollback()
-                    print(f"Database commit error in logout: {e}")
-                
-                # Remove from online users
-                if user_id in online_users:
-                    del online_users[user_id]
-                    
-                    # Notify all contacts
-                    socketio.emit('user_status', {
-                        'user_id': user_id,
-                        'is_online': False,
-                        'last_seen': datetime.utcnow().isoformat()
-                    })
+            # Remove from online users and notify contacts if they were online
+            was_online = presence.remove_user(user_id)
+            presence_writer.logged_out(user_id, notify=was_online)
         except Exception as e:
             print(f"Logout error: {e}")
 
@@ -333,6 +2296,7 @@ def logout():
     return jsonify({'success': True, 'message': 'Logged out successfully'})
 
 @app.route('/get_profile', methods=['GET'])
+@query_budget(1)
 def get_profile():
     user_id = session.get('user_id')
     
@@ -340,14 +2304,15 @@ def get_profile():
         return jsonify({'success': False, 'message': 'Not authenticated'})
     
     try:
-        user = User.query.get(user_id)
+        user = user_profiles.get(user_id)
         
         if user:
             return jsonify({
                 'success': True,
-                'username': user.username,
-                'phone': user.phone,
-                'profile_photo': user.profile_photo
+                'username': user['username'],
+                'phone': user['phone'],
+                'profile_photo': user['profile_photo'],
+                'profile_photo_url': photo_url(user['profile_photo'], 256)
             })
         else:
             return jsonify({'success': False, 'message': 'User not found'})
@@ -356,6 +2321,7 @@ def get_profile():
         return jsonify({'success': False, 'message': 'Failed to get profile'})
 
 @app.route('/search_users', methods=['GET'])
+@query_budget(3)
 def search_users():
     query = request.args.get('q', '')
     current_user_id = session.get('user_id')
@@ -366,37 +2332,59 @@ def search_users():
     if not query or len(query) < 2:
         return jsonify({'success': False, 'message': 'Query too short'})
     
+    cache_ttl = app.config['SEARCH_CACHE_TTL']
+    cache_key = (current_user_id, query.lower())
+    if cache_ttl:
+        cached = search_cache.get(cache_key)
+        if cached and cached[0] > time.monotonic():
+            return jsonify({'success': True, 'users': cached[1]})
+    
     try:
         # Search by username or phone
-        users = User.query.filter(
-            (User.username.like(f'%{query}%')) | (User.phone.like(f'%{query}%')),
-            User.id != current_user_id
-        ).limit(20).all()
+        user_ids = user_search_index.search(query, exclude_id=current_user_id)
+        if not user_ids:
+            return jsonify({'success': True, 'users': []})
+        
+        users = user_profiles.get_many(user_ids)
+        
+        # Check which results are already connected (either direction) in one query
+        contact_ids = set()
+        for user_id, contact_id in db.session.query(Contact.user_id, Contact.contact_id).filter(
+            ((Contact.user_id == current_user_id) & (Contact.contact_id.in_(user_ids))) |
+            ((Contact.contact_id == current_user_id) & (Contact.user_id.in_(user_ids)))
+        ).all():
+            contact_ids.add(contact_id if user_id == current_user_id else user_id)
         
         users_data = []
-        for user in users:
-            # Check if already connected
-            is_contact = Contact.query.filter(
-                ((Contact.user_id == current_user_id) & (Contact.contact_id == user.id)) |
-                ((Contact.user_id == user.id) & (Contact.contact_id == current_user_id))
-            ).first() is not None
+        for user_id in user_ids:
+            user = users.get(user_id)
+            if not user:
+                continue
+            is_online, last_seen = presence_writer.resolve(user_id, user['is_online'], user['last_seen'])
             
             users_data.append({
-                'id': user.id,
-                'username': user.username,
-                'phone': user.phone,
-                'profile_photo': user.profile_photo,
-                'is_online': user.is_online,
-                'last_seen': user.last_seen.isoformat() if user.last_seen else None,
-                'is_contact': is_contact
+                'id': user_id,
+                'username': user['username'],
+                'phone': user['phone'],
+                'profile_photo': user['profile_photo'],
+                'profile_photo_url': photo_url(user['profile_photo'], 48),
+                'is_online': is_online,
+                'last_seen': last_seen.isoformat() if last_seen else None,
+                'is_contact': user_id in contact_ids
             })
         
+        if cache_ttl:
+            if len(search_cache) >= SEARCH_CACHE_MAX_ENTRIES:
+                search_cache.clear()
+            search_cache[cache_key] = (time.monotonic() + cache_ttl, users_data)
+        
         return jsonify({'success': True, 'users': users_data})
     except Exception as e:
         print(f"Search error: {e}")
         return jsonify({'success': False, 'message': 'Search failed'})
 
 @app.route('/add_contact', methods=['POST'])
+@query_budget(5)
 def add_contact():
     data = request.json
     contact_id = data.get('contact_id')
@@ -421,20 +2409,30 @@ def add_contact():
         
         db.session.add(contact1)
         db.session.add(contact2)
+        record_changes([
+            ((int(current_user_id),), 'contact_added', {'contact_id': int(contact_id)}),
+            ((int(contact_id),), 'contact_added', {'contact_id': int(current_user_id)})
+        ])
         db.session.commit()
+        invalidate_contacts(int(current_user_id), int(contact_id))
+        invalidate_search_cache(int(current_user_id), int(contact_id))
         
         # Get contact info for response
-        contact_user = User.query.get(contact_id)
+        contact_user = user_profiles.get(contact_id)
         if not contact_user:
             return jsonify({'success': False, 'message': 'Contact user not found'})
         
+        is_online, last_seen = presence_writer.resolve(
+            contact_user['id'], contact_user['is_online'], contact_user['last_seen']
+        )
         contact_data = {
-            'id': contact_user.id,
-            'username': contact_user.username,
-            'phone': contact_user.phone,
-            'profile_photo': contact_user.profile_photo,
-            'is_online': contact_user.is_online,
-            'last_seen': contact_user.last_seen.isoformat() if contact_user.last_seen else None,
+            'id': contact_user['id'],
+            'username': contact_user['username'],
+            'phone': contact_user['phone'],
+            'profile_photo': contact_user['profile_photo'],
+            'profile_photo_url': photo_url(contact_user['profile_photo'], 96),
+            'is_online': is_online,
+            'last_seen': last_seen.isoformat() if last_seen else None,
             'unread_count': 0
         }
         
@@ -446,95 +2444,633 @@ def add_contact():
         traceback.print_exc()
         return jsonify({'success': False, 'message': 'Failed to add contact'})
 
-@app.route('/get_contacts', methods=['GET'])
-def get_contacts():
+def load_contacts(current_user_id, contact_ids=None):
+    """Contact entries for the chat list, optionally only the given contacts"""
+    # Contacts with their conversation summaries in one query, most
+    # recent conversation first and contacts never messaged last
+    query = db.session.query(User, Conversation).join(
+        Contact, Contact.contact_id == User.id
+    ).outerjoin(
+        Conversation,
+        ((Conversation.user_a_id == current_user_id) & (Conversation.user_b_id == User.id)) |
+        ((Conversation.user_b_id == current_user_id) & (Conversation.user_a_id == User.id))
+    ).filter(
+        Contact.user_id == current_user_id
+    )
+    if contact_ids is not None:
+        query = query.filter(User.id.in_(contact_ids))
+    rows = query.order_by(
+        Conversation.last_sent_at.is_(None), Conversation.last_sent_at.desc(), User.username
+    ).all()
+    
+    contacts_data = []
+    for user, conversation in rows:
+        is_online, last_seen = presence_writer.resolve(user.id, user.is_online, user.last_seen)
+        contact_data = {
+            'id': user.id,
+            'username': user.username,
+            'phone': user.phone,
+            'profile_photo': user.profile_photo,
+            'profile_photo_url': photo_url(user.profile_photo, 96),
+            'is_online': is_online,
+            'last_seen': last_seen.isoformat() if last_seen else None,
+            'unread_count': 0,
+            'last_message': None,
+            'last_message_id': None,
+            'last_sender_id': None,
+            'last_message_at': None
+        }
+        if conversation is not None:
+            side = conversation_side(current_user_id, user.id)
+            contact_data.update({
+                'unread_count': getattr(conversation, f'{side}_unread_count'),
+                'last_message': conversation.last_text,
+                'last_message_id': conversation.last_message_id,
+                'last_sender_id': conversation.last_sender_id,
+                'last_message_at': conversation.last_sent_at.isoformat() if conversation.last_sent_at else None
+            })
+        contacts_data.append(contact_data)
+    return contacts_data
+
+@app.route('/get_contacts', methods=['GET'])
+@query_budget(1)
+def get_contacts():
+    current_user_id = session.get('user_id')
+    
+    if not current_user_id:
+        return jsonify({'success': False, 'message': 'Not authenticated'})
+    
+    try:
+        contacts_data = load_contacts(current_user_id)
+        
+        return jsonify({'success': True, 'contacts': contacts_data})
+    except Exception as e:
+        print(f"Get contacts error: {e}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({'success': False, 'message': 'Failed to get contacts'})
+        
+@app.route('/presence_snapshot', methods=['GET'])
+@query_budget(2)
+def presence_snapshot():
+    """Online status of all contacts in one query, fetched by clients on connect"""
+    current_user_id = session.get('user_id')
+    
+    if not current_user_id:
+        return jsonify({'success': False, 'message': 'Not authenticated'})
+    
+    try:
+        contact_ids = get_contact_ids(current_user_id)
+        if not contact_ids:
+            return jsonify({'success': True, 'presence': []})
+        
+        users = db.session.query(User.id, User.is_online, User.last_seen).filter(
+            User.id.in_(contact_ids)
+        ).all()
+        
+        statuses = []
+        for user_id, is_online, last_seen in users:
+            is_online, last_seen = presence_writer.resolve(user_id, is_online, last_seen)
+            statuses.append({
+                'user_id': user_id,
+                'is_online': is_online,
+                'last_seen': last_seen.isoformat() if last_seen else None
+            })
+        
+        return jsonify({'success': True, 'presence': statuses})
+    except Exception as e:
+        print(f"Presence snapshot error: {e}")
+        return jsonify({'success': False, 'message': 'Failed to get presence'})
+
+# Delta sync: a reconnecting client sends the cursor from its last sync and
+# gets back only what changed since. The cursor is opaque to clients; it
+# holds the last change id they have seen and when it was issued. A cursor
+# older than the change log retention gets a reset, and the client falls
+# back to a full load.
+#
+# Change ids are allocated when a row is inserted but become visible when its
+# transaction commits, so a newer id can be read while an older one is still
+# in flight. The cursor only moves past changes older than the commit lag;
+# newer ones are returned but replayed by the next sync, and clients apply
+# them idempotently.
+SYNC_MAX_CHANGES = 500
+SYNC_COMMIT_LAG = 5  # seconds
+# Presence reaches users.last_seen up to a grace period and a flush late
+SYNC_PRESENCE_SLACK = PRESENCE_GRACE_PERIOD + PRESENCE_FLUSH_INTERVAL + 5  # seconds
+
+def encode_sync_cursor(change_id, issued_at):
+    return base64.urlsafe_b64encode(f'{change_id}:{int(issued_at)}'.encode()).decode()
+
+def decode_sync_cursor(cursor):
+    """(change id, issued at as unix time), or None if it isn't a cursor"""
+    try:
+        change_id, issued_at = base64.urlsafe_b64decode(cursor.encode()).decode().split(':')
+        return int(change_id), int(issued_at)
+    except ValueError:
+        return None
+
+def change_time(change):
+    return calendar.timegm(change.created_at.utctimetuple())
+
+def build_sync(user_id, cursor):
+    now = time.time()
+    settled_before = now - SYNC_COMMIT_LAG
+    decoded = decode_sync_cursor(cursor) if cursor else None
+    if decoded is None or decoded[1] < now - CHANGE_LOG_RETENTION:
+        # Changes may have been pruned; start over from the newest settled one
+        latest = db.session.query(db.func.max(Change.id)).filter(
+            Change.created_at <= datetime.utcfromtimestamp(settled_before)
+        ).scalar() or 0
+        return {'reset': True, 'cursor': encode_sync_cursor(latest, now)}
+    change_id, issued_at = decoded
+    
+    changes = Change.query.filter(
+        Change.user_id == user_id, Change.id > change_id
+    ).order_by(Change.id.asc()).limit(SYNC_MAX_CHANGES + 1).all()
+    has_more = len(changes) > SYNC_MAX_CHANGES
+    changes = changes[:SYNC_MAX_CHANGES]
+    
+    settled_id = change_id
+    for change in changes:
+        if change_time(change) > settled_before:
+            break
+        settled_id = change.id
+    # A page that isn't settled all the way through is finished by a later sync
+    has_more = has_more and settled_id == changes[-1].id
+    
+    messages = []
+    deleted_ids = []
+    read = []
+    new_contact_ids = []
+    for change in changes:
+        payload = json.loads(change.payload)
+        if change.kind == 'message':
+            messages.append(payload)
+        elif change.kind == 'message_deleted':
+            deleted_ids.append(payload['message_id'])
+        elif change.kind == 'read':
+            read.append(payload)
+        elif change.kind == 'contact_added':
+            new_contact_ids.append(payload['contact_id'])
+    deleted = set(deleted_ids)
+    
+    if has_more:
+        # The next page starts after this one, so it can't have been issued later
+        next_cursor = encode_sync_cursor(settled_id, change_time(changes[-1]))
+    else:
+        next_cursor = encode_sync_cursor(settled_id, now)
+    
+    # Contacts whose presence changed since the cursor, including changes
+    # this worker hasn't written yet
+    since = datetime.utcfromtimestamp(issued_at - SYNC_PRESENCE_SLACK)
+    presence_rows = db.session.query(User.id, User.is_online, User.last_seen).join(
+        Contact, Contact.contact_id == User.id
+    ).filter(
+        Contact.user_id == user_id,
+        (User.last_seen >= since) | User.id.in_(list(presence_writer.unflushed))
+    ).all()
+    presence = []
+    for contact_id, is_online, last_seen in presence_rows:
+        is_online, last_seen = presence_writer.resolve(contact_id, is_online, last_seen)
+        presence.append({
+            'user_id': contact_id,
+            'is_online': is_online,
+            'last_seen': last_seen.isoformat() if last_seen else None
+        })
+    
+    return {
+        'reset': False,
+        'cursor': next_cursor,
+        'has_more': has_more,
+        'messages': [message for message in messages if message['id'] not in deleted],
+        'deleted_message_ids': deleted_ids,
+        'read': read,
+        'contacts': load_contacts(user_id, new_contact_ids) if new_contact_ids else [],
+        # Group messages aren't in the change log; groups with new messages
+        # are, and the client pages them with get_group_messages?after_id=
+        'groups': load_groups(user_id, since),
+        'presence': presence
+    }
+
+@app.route('/sync', methods=['GET'])
+@query_budget(4)
+def sync():
+    """Changes since ?cursor=; without one, just a fresh cursor"""
     current_user_id = session.get('user_id')
     
     if not current_user_id:
         return jsonify({'success': False, 'message': 'Not authenticated'})
     
     try:
-        # Get all contacts for the current user
-        contacts = Contact.query.filter_by(user_id=current_user_id).all()
-        
-        if not contacts:
-            return jsonify({'success': True, 'contacts': []})
-        
-        contacts_data = []
-        for contact in contacts:
-            # Get the contact user details
-            user = User.query.get(contact.contact_id)
-            if not user:
-                continue
-            
-            # Calculate unread message count
-            unread_count = Message.query.filter(
-                Message.sender_id == user.id,
-                Message.receiver_id == current_user_id,
-                Message.is_seen == False
-            ).count()
-            
-            contacts_data.append({
-                'id': user.id,
-                'username': user.username,
-                'phone': user.phone,
-                'profile_photo': user.profile_photo,
-                'is_online': user.is_online,
-                'last_seen': user.last_seen.isoformat() if user.last_seen else None,
-                'unread_count': unread_count
-            })
-        
-        return jsonify({'success': True, 'contacts': contacts_data})
+        result = build_sync(current_user_id, request.args.get('cursor'))
+        return jsonify(dict(result, success=True))
     except Exception as e:
-        print(f"Get contacts error: {e}")
-        import traceback
-        traceback.print_exc()
-        return jsonify({'success': False, 'message': 'Failed to get contacts'})
-        
+        print(f"Sync error: {e}")
+        return jsonify({'success': False, 'message': 'Failed to sync'})
+
 @app.route('/get_messages', methods=['GET'])
+@query_budget(4)
 def get_messages():
     current_user_id = session.get('user_id')
-    other_user_id = request.args.get('user_id')
+    other_user_id = request.args.get('user_id', type=int)
+    before_id = request.args.get('before_id', type=int)
+    after_id = request.args.get('after_id', type=int)
+    limit = request.args.get('limit', MESSAGES_PAGE_SIZE, type=int)
     
     if not current_user_id or not other_user_id:
         return jsonify({'success': False, 'message': 'Invalid request'})
     
+    limit = max(1, min(limit, MESSAGES_PAGE_SIZE_MAX))
+    
     try:
-        # Get messages between two users
-        messages = Message.query.filter(
-            ((Message.sender_id == current_user_id) & (Message.receiver_id == other_user_id)) |
-            ((Message.sender_id == other_user_id) & (Message.receiver_id == current_user_id))
-        ).join(User, Message.sender_id == User.id).add_columns(
-            Message, User.username.label('sender_name'), User.profile_photo.label('sender_photo')
-        ).order_by(Message.sent_at).all()
+        user_a_id, user_b_id = ordered_pair(current_user_id, other_user_id)
+        conversation = Conversation.query.filter_by(user_a_id=user_a_id, user_b_id=user_b_id).first()
+        if conversation is None:
+            return jsonify({
+                'success': True, 'messages': [], 'has_more': False, 'oldest_id': None, 'newest_id': None
+            })
+        conversation_ids.setdefault((user_a_id, user_b_id), conversation.id)
+        
+        # Get one page of the conversation. Paging is keyed on the message id
+        # so each page is a range scan on idx_messages_conversation_id.
+        query = Message.query.filter(Message.conversation_id == conversation.id)
+        
+        if after_id is not None:
+            # Newer messages, oldest first
+            query = query.filter(Message.id > after_id).order_by(Message.id.asc())
+        else:
+            # Newest page (or the page older than before_id), newest first
+            if before_id is not None:
+                query = query.filter(Message.id < before_id)
+            query = query.order_by(Message.id.desc())
+        
+        # Fetch one extra row to know whether another page exists
+        messages = query.join(User, Message.sender_id == User.id).add_columns(
+            User.username.label('sender_name'), User.profile_photo.label('sender_photo')
+        ).limit(limit + 1).all()
+        
+        has_more = len(messages) > limit
+        messages = messages[:limit]
+        if after_id is None:
+            messages.reverse()
+        
+        # Our messages are seen up to the other user's watermark
+        other_watermark = getattr(conversation, f'{conversation_side(other_user_id, current_user_id)}_last_read_id')
+        last_message_id = conversation.last_message_id
         
         messages_data = []
-        for msg, message, sender_name, sender_photo in messages:
+        for message, sender_name, sender_photo in messages:
             messages_data.append({
                 'id': message.id,
                 'sender_id': message.sender_id,
                 'receiver_id': message.receiver_id,
                 'message_text': message.message_text,
-                'is_seen': message.is_seen,
+                'is_seen': message.sender_id == other_user_id or message.id <= other_watermark,
                 'sent_at': message.sent_at.isoformat(),
                 'sender_name': sender_name,
-                'sender_photo': sender_photo
+                'sender_photo': sender_photo,
+                'sender_photo_url': photo_url(sender_photo, 48)
             })
         
-        # Mark messages as seen
-        Message.query.filter(
-            Message.sender_id == other_user_id,
-            Message.receiver_id == current_user_id,
-            Message.is_seen == False
-        ).update({'is_seen': True})
+        # Mark the conversation as read up to its newest message. This commits,
+        # which expires the loaded rows, so it runs after they are read.
+        if last_message_id:
+            advance_read_watermark(current_user_id, other_user_id, last_message_id)
         db.session.commit()
         
-        return jsonify({'success': True, 'messages': messages_data})
+        return jsonify({
+            'success': True,
+            'messages': messages_data,
+            'has_more': has_more,
+            'oldest_id': messages_data[0]['id'] if messages_data else None,
+            'newest_id': messages_data[-1]['id'] if messages_data else None
+        })
     except Exception as e:
         print(f"Get messages error: {e}")
         return jsonify({'success': False, 'message': 'Failed to get messages'})
 
+def parse_member_ids(member_ids):
+    """Set of user ids from a request's member_ids list, or None if it isn't one"""
+    if not isinstance(member_ids, list):
+        return None
+    try:
+        return {int(member_id) for member_id in member_ids}
+    except (TypeError, ValueError):
+        return None
+
+@app.route('/create_group', methods=['POST'])
+@query_budget(3)
+def create_group():
+    data = request.json or {}
+    current_user_id = session.get('user_id')
+    name = (data.get('name') or '').strip()
+    member_ids = parse_member_ids(data.get('member_ids', []))
+
+    if not current_user_id or not name or member_ids is None:
+        return jsonify({'success': False, 'message': 'Invalid request'})
+    if len(name) > GROUP_NAME_LENGTH:
+        return jsonify({'success': False, 'message': f'Group names are at most {GROUP_NAME_LENGTH} characters'})
+
+    member_ids.discard(current_user_id)
+    if len(member_ids) + 1 > GROUP_MAX_MEMBERS:
+        return jsonify({'success': False, 'message': f'Groups have at most {GROUP_MAX_MEMBERS} members'})
+
+    try:
+        # Members are added from the creator's contacts
+        if not are_contacts(current_user_id, member_ids):
+            return jsonify({'success': False, 'message': 'Members must be your contacts'})
+        member_ids.add(current_user_id)
+
+        group = ChatGroup(name=name, created_by=current_user_id)
+        db.session.add(group)
+        db.session.flush()
+        joined_at = datetime.utcnow()
+        db.session.execute(db.insert(GroupMember), [
+            {'group_id': group.id, 'user_id': user_id, 'last_read_id': 0, 'joined_at': joined_at}
+            for user_id in member_ids
+        ])
+        group_data = serialize_group(group, len(member_ids))
+        db.session.commit()
+        group_member_cache[group_data['id']] = member_ids
+
+        # Members' sockets answer with join_group
+        for user_id in member_ids:
+            socketio.emit('group_added', group_data, room=str(user_id))
+
+        return jsonify({'success': True, 'group': group_data})
+    except Exception as e:
+        db.session.rollback()
+        print(f"Create group error: {e}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({'success': False, 'message': 'Failed to create group'})
+
+@app.route('/add_group_members', methods=['POST'])
+@query_budget(4)
+def add_group_members():
+    data = request.json or {}
+    current_user_id = session.get('user_id')
+    group_id = data.get('group_id')
+    member_ids = parse_member_ids(data.get('member_ids'))
+
+    if not current_user_id or not group_id or not member_ids:
+        return jsonify({'success': False, 'message': 'Invalid request'})
+
+    try:
+        group_id = int(group_id)
+        if not is_group_member(group_id, current_user_id):
+            return jsonify({'success': False, 'message': 'Not a member of this group'})
+
+        existing_ids = get_group_member_ids(group_id)
+        new_ids = member_ids - existing_ids
+        if not new_ids:
+            return jsonify({'success': False, 'message': 'Already members'})
+        if len(existing_ids) + len(new_ids) > GROUP_MAX_MEMBERS:
+            return jsonify({'success': False, 'message': f'Groups have at most {GROUP_MAX_MEMBERS} members'})
+        if not are_contacts(current_user_id, new_ids):
+            return jsonify({'success': False, 'message': 'Members must be your contacts'})
+
+        # New members start with the history before they joined already read
+        group = db.session.get(ChatGroup, group_id)
+        last_read_id = group.last_message_id or 0
+        joined_at = datetime.utcnow()
+        db.session.execute(db.insert(GroupMember), [
+            {'group_id': group_id, 'user_id': user_id, 'last_read_id': last_read_id, 'joined_at': joined_at}
+            for user_id in new_ids
+        ])
+        group_data = serialize_group(group, len(existing_ids) + len(new_ids), last_read_id=last_read_id)
+        db.session.commit()
+        group_member_cache.pop(group_id, None)
+
+        for user_id in new_ids:
+            socketio.emit('group_added', group_data, room=str(user_id))
+        socketio.emit('group_members_added', {
+            'group_id': group_id, 'user_ids': sorted(new_ids), 'member_count': group_data['member_count']
+        }, room=group_room(group_id))
+
+        return jsonify({'success': True, 'group': group_data})
+    except IntegrityError:
+        # Added concurrently through another worker
+        db.session.rollback()
+        group_member_cache.pop(group_id, None)
+        return jsonify({'success': False, 'message': 'Already members'})
+    except Exception as e:
+        db.session.rollback()
+        print(f"Add group members error: {e}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({'success': False, 'message': 'Failed to add group members'})
+
+@app.route('/get_groups', methods=['GET'])
+@query_budget(1)
+def get_groups():
+    current_user_id = session.get('user_id')
+
+    if not current_user_id:
+        return jsonify({'success': False, 'message': 'Not authenticated'})
+
+    try:
+        return jsonify({'success': True, 'groups': load_groups(current_user_id)})
+    except Exception as e:
+        print(f"Get groups error: {e}")
+        return jsonify({'success': False, 'message': 'Failed to get groups'})
+
+@app.route('/get_group_members', methods=['GET'])
+@query_budget(2)
+def get_group_members():
+    current_user_id = session.get('user_id')
+    group_id = request.args.get('group_id', type=int)
+
+    if not current_user_id or not group_id:
+        return jsonify({'success': False, 'message': 'Invalid request'})
+
+    try:
+        if not is_group_member(group_id, current_user_id):
+            return jsonify({'success': False, 'message': 'Not a member of this group'})
+
+        rows = db.session.query(User.id, User.username, User.profile_photo, User.is_online,
+                                User.last_seen, GroupMember.last_read_id).join(
+            GroupMember, GroupMember.user_id == User.id
+        ).filter(
+            GroupMember.group_id == group_id
+        ).order_by(User.username).all()
+
+        members = []
+        for user_id, username, profile_photo, is_online, last_seen, last_read_id in rows:
+            is_online, last_seen = presence_writer.resolve(user_id, is_online, last_seen)
+            members.append({
+                'id': user_id,
+                'username': username,
+                'profile_photo_url': photo_url(profile_photo, 48),
+                'is_online': is_online,
+                'last_seen': last_seen.isoformat() if last_seen else None,
+                # Messages up to here have been read by this member
+                'last_read_id': last_read_id
+            })
+
+        return jsonify({'success': True, 'members': members})
+    except Exception as e:
+        print(f"Get group members error: {e}")
+        return jsonify({'success': False, 'message': 'Failed to get group members'})
+
+@app.route('/get_group_messages', methods=['GET'])
+@query_budget(4)
+def get_group_messages():
+    current_user_id = session.get('user_id')
+    group_id = request.args.get('group_id', type=int)
+    before_id = request.args.get('before_id', type=int)
+    after_id = request.args.get('after_id', type=int)
+    limit = request.args.get('limit', MESSAGES_PAGE_SIZE, type=int)
+
+    if not current_user_id or not group_id:
+        return jsonify({'success': False, 'message': 'Invalid request'})
+
+    limit = max(1, min(limit, MESSAGES_PAGE_SIZE_MAX))
+
+    try:
+        if not is_group_member(group_id, current_user_id):
+            return jsonify({'success': False, 'message': 'Not a member of this group'})
+        last_message_id = db.session.query(ChatGroup.last_message_id).filter(ChatGroup.id == group_id).scalar()
+
+        # Paged by id like get_messages, on idx_group_messages_group_id
+        query = GroupMessage.query.filter(GroupMessage.group_id == group_id)
+        if after_id is not None:
+            query = query.filter(GroupMessage.id > after_id).order_by(GroupMessage.id.asc())
+        else:
+            if before_id is not None:
+                query = query.filter(GroupMessage.id < before_id)
+            query = query.order_by(GroupMessage.id.desc())
+
+        messages = query.join(User, GroupMessage.sender_id == User.id).add_columns(
+            User.username.label('sender_name'), User.profile_photo.label('sender_photo')
+        ).limit(limit + 1).all()
+
+        has_more = len(messages) > limit
+        messages = messages[:limit]
+        if after_id is None:
+            messages.reverse()
+
+        messages_data = []
+        for message, sender_name, sender_photo in messages:
+            messages_data.append({
+                'id': message.id,
+                'group_id': message.group_id,
+                'sender_id': message.sender_id,
+                'message_text': message.message_text,
+                'sent_at': message.sent_at.isoformat(),
+                'sender_name': sender_name,
+                'sender_photo': sender_photo,
+                'sender_photo_url': photo_url(sender_photo, 48)
+            })
+
+        # Mark the group as read up to its newest message
+        if last_message_id:
+            advance_group_watermark(group_id, current_user_id, last_message_id)
+        db.session.commit()
+
+        return jsonify({
+            'success': True,
+            'messages': messages_data,
+            'has_more': has_more,
+            'oldest_id': messages_data[0]['id'] if messages_data else None,
+            'newest_id': messages_data[-1]['id'] if messages_data else None
+        })
+    except Exception as e:
+        print(f"Get group messages error: {e}")
+        return jsonify({'success': False, 'message': 'Failed to get group messages'})
+
+@app.route('/search_messages', methods=['GET'])
+@query_budget(3)
+def search_messages():
+    """Messages containing the words of ?q=, in all of the user's chats or one (?user_id= or ?group_id=)"""
+    current_user_id = session.get('user_id')
+    peer_id = request.args.get('user_id', type=int)
+    group_id = request.args.get('group_id', type=int)
+    offset = request.args.get('offset', 0, type=int)
+    limit = request.args.get('limit', SEARCH_PAGE_SIZE, type=int)
+
+    if not current_user_id:
+        return jsonify({'success': False, 'message': 'Not authenticated'})
+
+    terms = list(text_terms(request.args.get('q', ''), SEARCH_QUERY_TERMS_MAX))
+    offset = max(0, min(offset, SEARCH_OFFSET_MAX))
+    limit = max(1, min(limit, SEARCH_PAGE_SIZE_MAX))
+    empty = {'success': True, 'results': [], 'has_more': False, 'next_offset': None}
+    if not terms:
+        return jsonify(empty)
+
+    try:
+        conversation_id = None
+        if peer_id is not None:
+            conversation_id = get_conversation_id(current_user_id, peer_id)
+            if conversation_id is None:
+                return jsonify(empty)
+        elif group_id is not None and not is_group_member(group_id, current_user_id):
+            return jsonify({'success': False, 'message': 'Not a member of this group'})
+
+        matches = rank_message_matches(
+            current_user_id, terms, offset, limit, conversation_id=conversation_id, group_id=group_id
+        )
+        has_more = len(matches) > limit and offset + limit <= SEARCH_OFFSET_MAX
+        matches = matches[:limit]
+
+        # The matched messages themselves, one query per kind
+        direct_ids = [message_id for conversation_id, _, message_id, _ in matches if conversation_id is not None]
+        group_message_ids = [message_id for conversation_id, _, message_id, _ in matches if conversation_id is None]
+        direct = {}
+        if direct_ids:
+            for message, sender_name, sender_photo in Message.query.filter(Message.id.in_(direct_ids)).join(
+                User, Message.sender_id == User.id
+            ).add_columns(User.username, User.profile_photo).all():
+                direct[message.id] = (message, sender_name, sender_photo)
+        grouped = {}
+        if group_message_ids:
+            for message, sender_name, sender_photo in GroupMessage.query.filter(
+                GroupMessage.id.in_(group_message_ids)
+            ).join(
+                User, GroupMessage.sender_id == User.id
+            ).add_columns(User.username, User.profile_photo).all():
+                grouped[message.id] = (message, sender_name, sender_photo)
+
+        results = []
+        for conversation_id, _, message_id, matched in matches:
+            found = (direct if conversation_id is not None else grouped).get(message_id)
+            if found is None:
+                continue
+            message, sender_name, sender_photo = found
+            result = {
+                'id': message.id,
+                'sender_id': message.sender_id,
+                'message_text': message.message_text,
+                'sent_at': message.sent_at.isoformat() if message.sent_at else None,
+                'sender_name': sender_name,
+                'sender_photo_url': photo_url(sender_photo, 48),
+                'matched_terms': matched
+            }
+            if conversation_id is not None:
+                result.update({
+                    'kind': 'direct',
+                    'receiver_id': message.receiver_id,
+                    # The chat it's in, from the searcher's side
+                    'user_id': message.receiver_id if message.sender_id == current_user_id else message.sender_id,
+                    'group_id': None
+                })
+            else:
+                result.update({'kind': 'group', 'user_id': None, 'group_id': message.group_id})
+            results.append(result)
+
+        return jsonify({
+            'success': True,
+            'results': results,
+            'has_more': has_more,
+            'next_offset': offset + limit if has_more else None
+        })
+    except Exception as e:
+        print(f"Search messages error: {e}")
+        return jsonify({'success': False, 'message': 'Search failed'})
+
 @app.route('/update_profile', methods=['POST'])
+@query_budget(3)
 def update_profile():
     current_user_id = session.get('user_id')
     
@@ -563,20 +3099,26 @@ def update_profile():
             session['username'] = username
         
         if profile_photo and allowed_file(profile_photo.filename):
-            filename = secure_filename(profile_photo.filename)
-            unique_filename = f"{uuid.uuid4()}_{filename}"
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-            profile_photo.save(filepath)
+            try:
+                stored_filename = store_profile_photo(profile_photo.read())
+            except Exception as e:
+                print(f"Profile photo processing error: {e}")
+                return jsonify({'success': False, 'message': 'Could not read image file'})
             
-            user.profile_photo = unique_filename
-            session['profile_photo'] = unique_filename
+            user.profile_photo = stored_filename
+            session['profile_photo'] = stored_filename
         
+        # Read the row before committing expires it
+        user_id, username, phone, profile_photo = user.id, user.username, user.phone, user.profile_photo
         db.session.commit()
+        user_search_index.add(user_id, username, phone)
+        user_profiles.invalidate(user_id)
         
         return jsonify({
             'success': True, 
-            'username': user.username,
-            'profile_photo': user.profile_photo
+            'username': username,
+            'profile_photo': profile_photo,
+            'profile_photo_url': photo_url(profile_photo, 256)
         })
     except Exception as e:
         db.session.rollback()
@@ -584,17 +3126,38 @@ def update_profile():
         return jsonify({'success': False, 'message': 'Failed to update profile'})
 
 @app.route('/uploads/<filename>')
+@query_budget(0)
 def serve_upload(filename):
+    # Serve the WebP variant of processed photos to browsers that accept it
+    match = PROCESSED_PHOTO_PATTERN.match(filename)
+    if match and match.group(3) == 'jpg' and 'image/webp' in request.headers.get('Accept', ''):
+        webp_filename = f'{match.group(1)}_{match.group(2)}.webp'
+        if os.path.exists(os.path.join(app.config['UPLOAD_FOLDER'], webp_filename)):
+            filename = webp_filename
+    
     try:
-        return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+        if not match:
+            # Uploads from before photo processing can't be cached forever
+            return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+        # Processed photos are named by content hash, so the name is the ETag
+        # and the URL never changes meaning
+        response = send_from_directory(
+            app.config['UPLOAD_FOLDER'], filename, etag=filename, max_age=IMMUTABLE_MAX_AGE
+        )
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        response.vary.add('Accept')
+        return response
     except:
-        return send_file('default.jpg')
+        return static_manifest.response('default.jpg')
 
 @app.route('/default.jpg')
+@query_budget(0)
 def serve_default():
-    return send_file('default.jpg')
+    return static_manifest.response('default.jpg')
 
 @app.route('/delete_message', methods=['POST'])
+@query_budget(6)
 def delete_message():
     data = request.json
     message_id = data.get('message_id')
@@ -618,7 +3181,36 @@ def delete_message():
         if message.sender_id != user_id:
             return jsonify({'success': False, 'message': 'Unauthorized to delete this message'})
         
+        conversation = db.session.get(Conversation, message.conversation_id) if message.conversation_id else None
         db.session.delete(message)
+        unindex_message(message.id)
+        record_changes([((message.sender_id, message.receiver_id), 'message_deleted', {
+            'message_id': message.id, 'sender_id': message.sender_id, 'receiver_id': message.receiver_id
+        })])
+        
+        if conversation is not None:
+            side = conversation_side(message.receiver_id, message.sender_id)
+            # Still unread by the receiver, so it no longer counts
+            if message.id > getattr(conversation, f'{side}_last_read_id'):
+                unread_count = getattr(Conversation, f'{side}_unread_count')
+                setattr(conversation, f'{side}_unread_count',
+                        db.case((unread_count > 0, unread_count - 1), else_=0))
+            
+            # The chat list preview moves back to the previous message
+            if conversation.last_message_id == message.id:
+                db.session.flush()
+                previous = Message.query.filter(
+                    Message.conversation_id == conversation.id
+                ).order_by(Message.id.desc()).first()
+                if previous is None:
+                    conversation.last_message_id = conversation.last_sender_id = None
+                    conversation.last_text = conversation.last_sent_at = None
+                else:
+                    conversation.last_message_id = previous.id
+                    conversation.last_sender_id = previous.sender_id
+                    conversation.last_text = previous.message_text[:LAST_TEXT_LENGTH]
+                    conversation.last_sent_at = previous.sent_at
+        
         db.session.commit()
         
         return jsonify({'success': True, 'message': 'Message deleted successfully'})
@@ -628,66 +3220,90 @@ def delete_message():
         return jsonify({'success': False, 'message': 'Failed to delete message'})
 
 # SocketIO Events
+def socket_user_id(claimed_id=None):
+    """The socket's logged-in user, or None if it has none or the payload claims another user"""
+    user_id = session.get('user_id')
+    if not user_id:
+        return None
+    if claimed_id is not None:
+        try:
+            if int(claimed_id) != user_id:
+                return None
+        except (TypeError, ValueError):
+            return None
+    return user_id
+
 @socketio.on('connect')
-def handle_connect():
+@timed_socket_event
+@query_budget(0)
+def handle_connect(auth=None):
     print(f"Client connected: {request.sid}")
-    emit('connected', {'status': 'connected'})
+    protocol = 'json'
+    if isinstance(auth, dict) and auth.get('protocol') == 'compact':
+        compact_sids.add(request.sid)
+        protocol = 'compact'
+    emit('connected', {'status': 'connected', 'protocol': protocol})
 
 @socketio.on('disconnect')
+@timed_socket_event
+@query_budget(0)
 def handle_disconnect():
-    user_id = None
-    for uid, sid in online_users.items():
-        if sid == request.sid:
-            user_id = uid
-            break
+    compact_sids.discard(request.sid)
+    if message_rooms is not None:
+        message_rooms.leave(request.sid)
+    user_id, went_offline = presence.remove_sid(request.sid)
     
-    if user_id:
-        del online_users[user_id]
-        
-        try:
-            user = User.query.get(user_id)
-            if user:
-                user.is_online = False
-                user.last_seen = datetime.utcnow()
-                db.session.commit()
-        except Exception as e:
-            print(f"Update online status error: {e}")
-        
-        # Notify all clients about status change
-        emit('user_status', {
-            'user_id': user_id,
-            'is_online': False,
-            'last_seen': datetime.utcnow().isoformat()
-        }, broadcast=True, namespace='/')
+    # Other tabs of the same user keep them online
+    if went_offline:
+        presence_writer.went_offline(user_id)
 
 @socketio.on('user_online')
+@timed_socket_event
+@query_budget(4)
 def handle_user_online(data):
-    user_id = data.get('user_id')
+    user_id = socket_user_id((data or {}).get('user_id'))
     if user_id:
-        online_users[user_id] = request.sid
-        
-        try:
-            user = User.query.get(user_id)
-            if user:
-                user.is_online = True
-                user.last_seen = datetime.utcnow()
-                db.session.commit()
-        except Exception as e:
-            print(f"Update online status error: {e}")
-        
-        # Notify all clients about status change
-        emit('user_status', {
-            'user_id': user_id,
-            'is_online': True
-        }, broadcast=True, namespace='/')
+        # Only the user's first socket brings them online
+        if presence.add(user_id, request.sid):
+            presence_writer.came_online(user_id)
+            deliver_pending_messages(user_id, request.sid)
 
 @socketio.on('join_user_room')
+@timed_socket_event
+@query_budget(1)
 def handle_join_user_room(data):
-    user_id = data.get('user_id')
-    if user_id:
-        join_room(str(user_id))
+    user_id = socket_user_id((data or {}).get('user_id'))
+    if not user_id:
+        return
+    compact = request.sid in compact_sids
+    join_room(str(user_id))
+    join_room(message_room(user_id, compact))
+    if message_rooms is not None:
+        message_rooms.join(user_id, compact, request.sid)
+    for (group_id,) in db.session.query(GroupMember.group_id).filter(
+        GroupMember.user_id == user_id
+    ).all():
+        join_room(group_room(group_id))
+
+@socketio.on('join_group')
+@timed_socket_event
+@query_budget(1)
+def handle_join_group(data):
+    """Join a group's room after being added to it (group_added)"""
+    user_id = session.get('user_id')
+    try:
+        group_id = int((data or {}).get('group_id'))
+    except (TypeError, ValueError):
+        return {'success': False, 'message': 'Invalid request'}
+    if not user_id or not is_group_member(group_id, user_id):
+        return {'success': False, 'message': 'Not a member of this group'}
+    join_room(group_room(group_id))
+    return {'success': True}
 
 @socketio.on('send_message')
+@timed_socket_event
+@rate_limited
+@query_budget(1)
 def handle_send_message(data):
     sender_id = data.get('sender_id')
     receiver_id = data.get('receiver_id')
@@ -696,100 +3312,173 @@ def handle_send_message(data):
     if not sender_id or not receiver_id or not message_text:
         return
     
+    sender_id = socket_user_id(sender_id)
+    if not sender_id:
+        emit('message_failed', {
+            'receiver_id': receiver_id, 'group_id': None, 'message_text': message_text, 'reason': 'not_authenticated'
+        })
+        return
+    
     try:
-        # Save message to database
-        message = Message(
-            sender_id=sender_id,
-            receiver_id=receiver_id,
-            message_text=message_text
-        )
-        db.session.add(message)
-        db.session.commit()
-        
-        # Get message details with sender info
-        message_with_sender = db.session.query(
-            Message, User.username, User.profile_photo
-        ).join(
-            User, Message.sender_id == User.id
-        ).filter(
-            Message.id == message.id
-        ).first()
-        
-        if message_with_sender:
-            msg, sender_name, sender_photo = message_with_sender
-            message_data = {
-                'id': msg.id,
-                'sender_id': msg.sender_id,
-                'receiver_id': msg.receiver_id,
-                'message_text': msg.message_text,
-                'is_seen': msg.is_seen,
-                'sent_at': msg.sent_at.isoformat() if isinstance(msg.sent_at, datetime) else msg.sent_at,
-                'sender_name': sender_name,
-                'sender_photo': sender_photo
-            }
-            
-            # Send to receiver if they have a room
-            emit('new_message', message_data, room=str(receiver_id))
-            
-            # Send to sender as confirmation
-            emit('message_sent', message_data, room=request.sid)
-            
-            # Update sender's own chat if they're viewing the conversation
-            emit('new_message_self', message_data, room=str(sender_id))
-            
-            # If receiver is online, mark message as seen
-            if receiver_id in online_users:
-                msg.is_seen = True
-                db.session.commit()
-                # Notify sender that message was seen
-                emit('message_status', {
-                    'message_id': msg.id,
-                    'is_seen': True
-                }, room=str(sender_id))
-                
-    except Exception as e:
-        db.session.rollback()
-        print(f"Send message error: {e}")
+        receiver_id = int(receiver_id)
+    except (TypeError, ValueError):
+        emit('message_failed', {
+            'receiver_id': receiver_id, 'group_id': None, 'message_text': message_text, 'reason': 'invalid'
+        })
+        return
+    
+    # Checked here, so a bad message can't fail the batch it would join
+    profiles = user_profiles.get_many([sender_id, receiver_id])
+    if sender_id not in profiles or receiver_id not in profiles:
+        emit('message_failed', {
+            'receiver_id': receiver_id, 'group_id': None, 'message_text': message_text, 'reason': 'unknown_user'
+        })
+        return
+    
+    # Backpressure: the pipeline is behind, so don't queue more
+    if send_queue.qsize() >= SEND_QUEUE_MAX_DEPTH:
+        return refuse_socket_event('send_message', 'busy', 1)
+    
+    queue_outgoing_message(sender_id, receiver_id, message_text, request.sid)
+
+@socketio.on('send_group_message')
+@timed_socket_event
+@rate_limited
+@query_budget(1)
+def handle_send_group_message(data):
+    user_id = session.get('user_id')
+    group_id = data.get('group_id')
+    message_text = data.get('message_text')
+    
+    if not user_id or not group_id or not message_text:
+        return
+    
+    try:
+        group_id = int(group_id)
+    except (TypeError, ValueError) as e:
+        print(f"Send group message error: {e}")
+        return
+    
+    if not is_group_member(group_id, user_id):
+        return
+    
+    if send_queue.qsize() >= SEND_QUEUE_MAX_DEPTH:
+        return refuse_socket_event('send_group_message', 'busy', 1)
+    
+    queue_outgoing_message(user_id, None, message_text, request.sid, group_id=group_id)
 
 @socketio.on('message_seen')
+@timed_socket_event
+@rate_limited
+@query_budget(3)
 def handle_message_seen(data):
     message_id = data.get('message_id')
-    user_id = data.get('user_id')
+    user_id = socket_user_id(data.get('user_id'))
+    sender_id = data.get('sender_id')
     
     if not message_id or not user_id:
         return
     
     try:
-        message = Message.query.get(message_id)
-        if not message:
-            return
+        message_id = int(message_id)
         
-        sender_id = message.sender_id
+        # Older clients don't send sender_id, so look it up from the message
+        if sender_id:
+            sender_id = int(sender_id)
+        else:
+            message = Message.query.get(message_id)
+            if not message or message.receiver_id != user_id:
+                return
+            sender_id = message.sender_id
         
-        # Mark message as seen
-        message.is_seen = True
-        db.session.commit()
+        # Only the reader's own conversation with the sender can move
+        if sender_id == user_id or get_conversation_id(user_id, sender_id) is None:
+            return
         
-        # Notify sender
-        emit('message_status', {
-            'message_id': message_id,
-            'is_seen': True
-        }, room=str(sender_id))
+        # Mark everything up to this message as seen
+        if advance_read_watermark(user_id, sender_id, message_id):
+            db.session.commit()
+            # Notify sender
+            queue_seen_receipt(sender_id, user_id, message_id)
             
     except Exception as e:
+        db.session.rollback()
         print(f"Message seen error: {e}")
 
+@socketio.on('group_seen')
+@timed_socket_event
+@rate_limited
+@query_budget(1)
+def handle_group_seen(data):
+    user_id = session.get('user_id')
+    
+    try:
+        group_id = int(data.get('group_id'))
+        message_id = int(data.get('message_id'))
+    except (TypeError, ValueError):
+        return
+    
+    if not user_id:
+        return
+    
+    try:
+        if advance_group_watermark(group_id, user_id, message_id):
+            db.session.commit()
+            # The reader's other tabs clear their unread count
+            socketio.emit('group_read', {'group_id': group_id, 'last_read_id': message_id}, room=str(user_id))
+    except Exception as e:
+        db.session.rollback()
+        print(f"Group seen error: {e}")
+
+@socketio.on('sync')
+@timed_socket_event
+@rate_limited
+@query_budget(4)
+def handle_sync(data):
+    """Same as /sync, answered through the event's acknowledgement"""
+    user_id = session.get('user_id')
+    if not user_id:
+        return {'success': False, 'message': 'Not authenticated'}
+    
+    try:
+        result = build_sync(user_id, (data or {}).get('cursor'))
+        return dict(result, success=True)
+    except Exception as e:
+        print(f"Sync error: {e}")
+        return {'success': False, 'message': 'Failed to sync'}
+
+@socketio.on('profiles')
+@timed_socket_event
+@rate_limited
+@query_budget(1)
+def handle_profiles(data):
+    """Names and photos of message senders for compact clients, as packed [id, username, photo_url] rows"""
+    try:
+        user_ids = [int(user_id) for user_id in (data or {}).get('user_ids', [])[:PROFILES_REQUEST_MAX]]
+    except (TypeError, ValueError):
+        return wire.packb([])
+    profiles = user_profiles.get_many(user_ids)
+    return wire.packb([
+        [profile['id'], profile['username'], photo_url(profile['profile_photo'], 48)]
+        for profile in profiles.values()
+    ])
+
 @socketio.on('typing')
+@timed_socket_event
+@rate_limited
+@query_budget(0)
 def handle_typing(data):
-    sender_id = data.get('sender_id')
+    sender_id = socket_user_id(data.get('sender_id'))
     receiver_id = data.get('receiver_id')
     is_typing = data.get('is_typing')
     
-    if sender_id and receiver_id:
-        emit('user_typing', {
-            'sender_id': sender_id,
-            'is_typing': is_typing
-        }, room=str(receiver_id))
+    if not sender_id or not receiver_id:
+        return
+    
+    try:
+        typing_relay.update(sender_id, int(receiver_id), bool(is_typing))
+    except (TypeError, ValueError) as e:
+        print(f"Typing error: {e}")
 
 with app.app_context():
     try:
@@ -0,0 +1,310 @@
+"""Load test the chat server: message throughput, delivery latency and HTTP latency.
+
+Starts one app worker (on a temporary SQLite database unless --database-url
+is given), registers users, links each user to a few contacts and seeds
+message history, then drives concurrent Socket.IO clients that send to each
+other while timing delivery, and finally times the main HTTP endpoints.
+
+    pip install -r requirements-dev.txt
+    python bench_chat.py --users 100 --clients 20 --messages-per-client 50 --output bench.json
+
+Results are printed and optionally written as JSON, tagged with the git
+commit, so runs can be compared across commits.
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import requests
+from sqlalchemy import create_engine, text
+
+from bench_login import summarize
+from scale_check import connect, free_port, register, start_worker, wait_until_ready
+
+DELIVERY_TIMEOUT = 30
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def contact_pairs(user_count, contacts_per_user):
+    """Each user is linked to the next contacts_per_user users, wrapping around"""
+    pairs = set()
+    for i in range(user_count):
+        for step in range(1, contacts_per_user + 1):
+            j = (i + step) % user_count
+            if i != j:
+                pairs.add((min(i, j), max(i, j)))
+    return sorted(pairs)
+
+
+def seed_users(base_url, user_count, concurrency):
+    def register_user(i):
+        return register(base_url, f'bench{i}', f'09{i:08d}')
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        return list(pool.map(register_user, range(user_count)))
+
+
+def seed_contacts(base_url, sessions, pairs, concurrency):
+    def add_contact(pair):
+        http, _ = sessions[pair[0]]
+        _, contact_id = sessions[pair[1]]
+        data = http.post(f'{base_url}/add_contact', json={'contact_id': contact_id}).json()
+        if not data.get('success'):
+            raise RuntimeError(f"Adding contact failed: {data.get('message')}")
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(add_contact, pairs))
+
+
+def seed_messages(database_url, sessions, pairs, message_count):
+    """Insert conversations and message history directly; the server only has to read them"""
+    engine = create_engine(database_url)
+    conversation_pairs = set()
+    rows = []
+    for n in range(message_count):
+        a, b = pairs[n % len(pairs)]
+        sender, receiver = (a, b) if n % 2 else (b, a)
+        sender_id, receiver_id = sessions[sender][1], sessions[receiver][1]
+        pair = (min(sender_id, receiver_id), max(sender_id, receiver_id))
+        conversation_pairs.add(pair)
+        rows.append({
+            'pair': pair,
+            'sender_id': sender_id,
+            'receiver_id': receiver_id,
+            'message_text': f'seed message {n}',
+            'sent_at': datetime.utcnow(),
+        })
+    with engine.begin() as conn:
+        conn.execute(text(
+            "INSERT INTO conversations (user_a_id, user_b_id, a_last_read_id, b_last_read_id, "
+            "a_unread_count, b_unread_count) VALUES (:user_a_id, :user_b_id, 0, 0, 0, 0)"
+        ), [{'user_a_id': a, 'user_b_id': b} for a, b in sorted(conversation_pairs)])
+        conversation_ids = {
+            (a, b): conversation_id
+            for a, b, conversation_id in conn.execute(text("SELECT user_a_id, user_b_id, id FROM conversations"))
+        }
+        for row in rows:
+            row['conversation_id'] = conversation_ids[row.pop('pair')]
+        for start in range(0, len(rows), 1000):
+            conn.execute(text(
+                "INSERT INTO messages (conversation_id, sender_id, receiver_id, message_text, sent_at, is_seen) "
+                "VALUES (:conversation_id, :sender_id, :receiver_id, :message_text, :sent_at, false)"
+            ), rows[start:start + 1000])
+
+        # Summaries and unread counts as the send pipeline would have left them
+        conn.execute(text(
+            "UPDATE conversations SET "
+            "last_message_id = (SELECT MAX(id) FROM messages WHERE messages.conversation_id = conversations.id), "
+            "a_unread_count = (SELECT COUNT(*) FROM messages WHERE messages.conversation_id = conversations.id "
+            "AND messages.sender_id = conversations.user_b_id), "
+            "b_unread_count = (SELECT COUNT(*) FROM messages WHERE messages.conversation_id = conversations.id "
+            "AND messages.sender_id = conversations.user_a_id)"
+        ))
+        conn.execute(text(
+            "UPDATE conversations SET "
+            "last_sender_id = (SELECT sender_id FROM messages WHERE messages.id = conversations.last_message_id), "
+            "last_text = (SELECT SUBSTR(message_text, 1, 100) FROM messages WHERE messages.id = conversations.last_message_id), "
+            "last_sent_at = (SELECT sent_at FROM messages WHERE messages.id = conversations.last_message_id)"
+        ))
+    engine.dispose()
+
+
+def run_send_phase(base_url, sessions, client_count, messages_per_client, interval):
+    """Client i sends to client i+1; returns (delivery latencies, ack latencies, seconds, lost)"""
+    sent_at = {}
+    acked_at = {}
+    delivered_at = {}
+    lock = threading.Lock()
+    # Acks are emitted after deliveries, so wait for both
+    all_done = threading.Event()
+    expected = client_count * messages_per_client
+    clients = []
+
+    def on_new_message(message):
+        token = message.get('message_text')
+        with lock:
+            if token in sent_at and token not in delivered_at:
+                delivered_at[token] = time.perf_counter()
+                if len(delivered_at) == expected and len(acked_at) == expected:
+                    all_done.set()
+
+    def on_message_sent(message):
+        token = message.get('message_text')
+        with lock:
+            if token in sent_at and token not in acked_at:
+                acked_at[token] = time.perf_counter()
+                if len(delivered_at) == expected and len(acked_at) == expected:
+                    all_done.set()
+
+    try:
+        for http, user_id in sessions[:client_count]:
+            client = connect(base_url, http)
+            client.on('new_message', on_new_message)
+            client.on('message_sent', on_message_sent)
+            client.emit('user_online', {'user_id': user_id})
+            client.emit('join_user_room', {'user_id': user_id})
+            clients.append((client, user_id))
+        time.sleep(1)
+
+        def sender_loop(i):
+            client, user_id = clients[i]
+            _, receiver_id = clients[(i + 1) % client_count]
+            for n in range(messages_per_client):
+                token = f'bench {i}:{n}'
+                with lock:
+                    sent_at[token] = time.perf_counter()
+                client.emit('send_message', {
+                    'sender_id': user_id,
+                    'receiver_id': receiver_id,
+                    'message_text': token
+                })
+                if interval:
+                    time.sleep(interval)
+
+        started = time.perf_counter()
+        threads = [threading.Thread(target=sender_loop, args=(i,)) for i in range(client_count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        all_done.wait(DELIVERY_TIMEOUT)
+        with lock:
+            finished = max(delivered_at.values(), default=time.perf_counter())
+            delivery = [delivered_at[token] - sent_at[token] for token in delivered_at]
+            acks = [acked_at[token] - sent_at[token] for token in acked_at]
+        return delivery, acks, finished - started, expected - len(delivery)
+    finally:
+        for client, _ in clients:
+            client.disconnect()
+
+
+def run_http_phase(base_url, sessions, pairs, requests_per_endpoint, concurrency):
+    def get_contacts(i):
+        http, _ = sessions[i % len(sessions)]
+        return http.get(f'{base_url}/get_contacts')
+
+    def get_messages(i):
+        a, b = pairs[i % len(pairs)]
+        http, _ = sessions[a]
+        return http.get(f'{base_url}/get_messages', params={'user_id': sessions[b][1]})
+
+    def search_users(i):
+        http, _ = sessions[i % len(sessions)]
+        return http.get(f'{base_url}/search_users', params={'q': f'bench{random.randint(1, 9)}'})
+
+    results = {}
+    for name, request_fn in [('get_contacts', get_contacts), ('get_messages', get_messages),
+                             ('search_users', search_users)]:
+        def timed(i):
+            started = time.perf_counter()
+            response = request_fn(i)
+            ok = response.ok and response.json().get('success')
+            return time.perf_counter() - started, ok
+
+        samples = []
+        failures = 0
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            for elapsed, ok in pool.map(timed, range(requests_per_endpoint)):
+                samples.append(elapsed)
+                failures += 0 if ok else 1
+        duration = time.perf_counter() - started
+        results[name] = dict(summarize(samples), failures=failures,
+                             requests_per_second=requests_per_endpoint / duration)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--contacts-per-user', type=int, default=5)
+    parser.add_argument('--seed-messages', type=int, default=10000)
+    parser.add_argument('--clients', type=int, default=20)
+    parser.add_argument('--messages-per-client', type=int, default=50)
+    parser.add_argument('--interval', type=float, default=0,
+                        help='seconds between sends from each client')
+    parser.add_argument('--http-requests', type=int, default=200,
+                        help='requests per HTTP endpoint')
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--database-url',
+                        help='database to use instead of a temporary SQLite file; it should be empty')
+    parser.add_argument('--output', help='write results as JSON to this file')
+    args = parser.parse_args()
+    if args.clients > args.users:
+        parser.error('--clients cannot exceed --users')
+
+    db_file = None
+    database_url = args.database_url
+    if not database_url:
+        db_file = tempfile.NamedTemporaryFile(suffix='.db', delete=False)
+        db_file.close()
+        database_url = f'sqlite:///{db_file.name}'
+    env = dict(os.environ, DATABASE_URL=database_url)
+    env.pop('SOCKETIO_MESSAGE_QUEUE', None)
+    # Clients send as fast as they can; measure throughput, not the limits
+    env.setdefault('SOCKET_RATE_LIMITS', 'send_message=off,message_seen=off,typing=off,sync=off')
+    port = free_port()
+    base_url = f'http://127.0.0.1:{port}'
+    worker = start_worker(port, env)
+    try:
+        wait_until_ready(base_url)
+        started = time.perf_counter()
+        sessions = seed_users(base_url, args.users, args.concurrency)
+        pairs = contact_pairs(args.users, args.contacts_per_user)
+        seed_contacts(base_url, sessions, pairs, args.concurrency)
+        if args.seed_messages:
+            seed_messages(database_url, sessions, pairs, args.seed_messages)
+        print(f"Seeded {args.users} users, {len(pairs)} contact pairs and "
+              f"{args.seed_messages} messages in {time.perf_counter() - started:.1f}s")
+
+        delivery, acks, duration, lost = run_send_phase(
+            base_url, sessions, args.clients, args.messages_per_client, args.interval
+        )
+        print(f"Delivered {len(delivery)} messages in {duration:.2f}s")
+        http_results = run_http_phase(
+            base_url, sessions, pairs, args.http_requests, args.concurrency
+        )
+        server_stats = requests.get(f'{base_url}/pipeline_stats').json()
+
+        results = {
+            'benchmark': 'chat',
+            'commit': git_commit(),
+            'database': database_url.split(':', 1)[0],
+            # The database URL may hold credentials
+            'config': {key: value for key, value in vars(args).items() if key != 'database_url'},
+            'messages_per_second': len(delivery) / duration if duration else None,
+            'messages_lost': lost,
+            'delivery_latency': summarize(delivery),
+            'ack_latency': summarize(acks),
+            'http': http_results,
+            'server': {key: value for key, value in server_stats.items() if key != 'success'},
+        }
+        print(json.dumps(results, indent=2))
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2)
+        return 0 if lost == 0 else 1
+    finally:
+        worker.terminate()
+        worker.wait()
+        if db_file:
+            os.remove(db_file.name)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
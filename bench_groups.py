@@ -0,0 +1,259 @@
+"""Compare group sends with sending the same message to each member.
+
+Starts one app worker (on a temporary SQLite database unless --database-url
+is given) and registers users, all of them contacts of the first. For each
+group size the first user creates a group and sends messages to it, then
+sends the same number of messages the way clients simulated groups before
+groups existed: one send_message per other member. Up to --online members
+are connected and time delivery; the rest are offline. Each message is
+sent once the previous one is acknowledged, as a client would, so the
+fan-out phase isn't refused by the send queue's backpressure.
+
+Each phase reports delivery latency (until every connected member has the
+message), ack latency, and the database rows and SQL statements it took
+per message.
+
+    pip install -r requirements-dev.txt
+    python bench_groups.py --sizes 10 100 1000 --messages 20 --output groups.json
+
+Results are printed and optionally written as JSON, tagged with the git
+commit, so runs can be compared across commits.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+from sqlalchemy import create_engine, text
+
+from bench_chat import git_commit, seed_contacts, seed_users
+from bench_login import summarize
+from scale_check import connect, free_port, start_worker, wait_until_ready
+
+DELIVERY_TIMEOUT = 120
+WRITTEN_TABLES = ('messages', 'group_messages', 'changes')
+
+
+def db_statement_count(base_url):
+    """Total SQL statements the worker has run, from /metrics"""
+    total = 0
+    for line in requests.get(f'{base_url}/metrics').text.splitlines():
+        if line.startswith('teletok_db_statements_total{'):
+            total += float(line.rsplit(' ', 1)[1])
+    return total
+
+
+def written_rows(engine):
+    with engine.connect() as conn:
+        return sum(conn.execute(text(f'SELECT COUNT(*) FROM {table}')).scalar() for table in WRITTEN_TABLES)
+
+
+def create_group(base_url, sessions, size):
+    http, _ = sessions[0]
+    data = http.post(f'{base_url}/create_group', json={
+        'name': f'bench {size}', 'member_ids': [user_id for _, user_id in sessions[1:size]]
+    }).json()
+    if not data.get('success'):
+        raise RuntimeError(f"Creating a group of {size} failed: {data.get('message')}")
+    return data['group']['id']
+
+
+def run_phase(base_url, engine, sessions, online, messages, interval, group_id=None):
+    """Send messages from the first user, to group_id or to every member one by one.
+
+    Returns (delivery latencies, ack latencies, seconds, lost, rows written,
+    SQL statements).
+    """
+    members = [user_id for _, user_id in sessions]
+    # A group message reaches the sender's sockets too; direct ones don't
+    listeners = online if group_id is not None else online - 1
+    acks_per_message = 1 if group_id is not None else len(members) - 1
+    delivery_event = 'new_group_message' if group_id is not None else 'new_message'
+    ack_event = 'group_message_sent' if group_id is not None else 'message_sent'
+
+    sent_at = {}
+    deliveries = {}
+    acks = {}
+    delivered_at = {}
+    acked_at = {}
+    lock = threading.Lock()
+    all_done = threading.Event()
+    acked = threading.Event()
+
+    def check_done():
+        if len(delivered_at) == messages and len(acked_at) == messages:
+            all_done.set()
+
+    def on_delivery(message):
+        token = message.get('message_text')
+        with lock:
+            if token not in sent_at:
+                return
+            deliveries[token] = deliveries.get(token, 0) + 1
+            if deliveries[token] == listeners:
+                delivered_at[token] = time.perf_counter()
+                check_done()
+
+    def on_ack(message):
+        token = message.get('message_text')
+        with lock:
+            if token not in sent_at:
+                return
+            acks[token] = acks.get(token, 0) + 1
+            if acks[token] == acks_per_message:
+                acked_at[token] = time.perf_counter()
+                acked.set()
+                check_done()
+
+    clients = []
+    try:
+        for http, user_id in sessions[:online]:
+            client = connect(base_url, http)
+            client.on(delivery_event, on_delivery)
+            client.on(ack_event, on_ack)
+            client.emit('user_online', {'user_id': user_id})
+            client.emit('join_user_room', {'user_id': user_id})
+            clients.append(client)
+        time.sleep(1)
+
+        rows_before = written_rows(engine)
+        statements_before = db_statement_count(base_url)
+        sender = clients[0]
+        kind = 'group' if group_id is not None else 'fanout'
+        started = time.perf_counter()
+        for n in range(messages):
+            token = f'{kind} {len(members)}:{n}'
+            acked.clear()
+            with lock:
+                sent_at[token] = time.perf_counter()
+            if group_id is not None:
+                sender.emit('send_group_message', {'group_id': group_id, 'message_text': token})
+            else:
+                for receiver_id in members[1:]:
+                    sender.emit('send_message', {
+                        'sender_id': members[0], 'receiver_id': receiver_id, 'message_text': token
+                    })
+            if not acked.wait(DELIVERY_TIMEOUT):
+                break
+            if interval:
+                time.sleep(interval)
+        all_done.wait(DELIVERY_TIMEOUT)
+
+        with lock:
+            finished = max(delivered_at.values(), default=time.perf_counter())
+            delivery = [delivered_at[token] - sent_at[token] for token in delivered_at]
+            ack_latency = [acked_at[token] - sent_at[token] for token in acked_at]
+        rows = written_rows(engine) - rows_before
+        statements = db_statement_count(base_url) - statements_before
+        return delivery, ack_latency, finished - started, messages - len(delivery), rows, statements
+    finally:
+        for client in clients:
+            client.disconnect()
+
+
+def phase_results(messages, delivery, acks, duration, lost, rows, statements):
+    return {
+        'messages_per_second': len(delivery) / duration if duration else None,
+        'messages_lost': lost,
+        'delivery_latency': summarize(delivery),
+        'ack_latency': summarize(acks),
+        'rows_written_per_message': rows / messages,
+        'db_statements_per_message': statements / messages,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000],
+                        help='group sizes, in members')
+    parser.add_argument('--messages', type=int, default=20, help='messages sent per phase')
+    parser.add_argument('--online', type=int, default=50,
+                        help='members connected while messages are sent')
+    parser.add_argument('--interval', type=float, default=0,
+                        help='seconds between messages')
+    parser.add_argument('--skip-fanout', action='store_true',
+                        help='only time group sends')
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--database-url',
+                        help='database to use instead of a temporary SQLite file; it should be empty')
+    parser.add_argument('--output', help='write results as JSON to this file')
+    args = parser.parse_args()
+    if min(args.sizes) < 2:
+        parser.error('--sizes must be at least 2')
+    if args.online < 2:
+        parser.error('--online must be at least 2')
+
+    db_file = None
+    database_url = args.database_url
+    if not database_url:
+        db_file = tempfile.NamedTemporaryFile(suffix='.db', delete=False)
+        db_file.close()
+        database_url = f'sqlite:///{db_file.name}'
+    env = dict(os.environ, DATABASE_URL=database_url)
+    env.pop('SOCKETIO_MESSAGE_QUEUE', None)
+    # One sender emits a message per member; measure fan-out, not the limits
+    env.setdefault('SOCKET_RATE_LIMITS', 'send_message=off,send_group_message=off')
+    port = free_port()
+    base_url = f'http://127.0.0.1:{port}'
+    worker = start_worker(port, env)
+    engine = create_engine(database_url)
+    try:
+        wait_until_ready(base_url)
+        started = time.perf_counter()
+        user_count = max(args.sizes)
+        sessions = seed_users(base_url, user_count, args.concurrency)
+        seed_contacts(base_url, sessions, [(0, i) for i in range(1, user_count)], args.concurrency)
+        # Each session holds an idle keep-alive connection, and a thousand of
+        # them make the worker refuse new websockets. Cookies are kept.
+        for http, _ in sessions:
+            http.close()
+        print(f"Seeded {user_count} users in {time.perf_counter() - started:.1f}s")
+
+        by_size = {}
+        lost = 0
+        for size in args.sizes:
+            members = sessions[:size]
+            online = min(args.online, size)
+            group_id = create_group(base_url, sessions, size)
+            phases = [('group', group_id)] + ([] if args.skip_fanout else [('fanout', None)])
+            by_size[size] = {'online': online}
+            for name, phase_group_id in phases:
+                delivery, acks, duration, phase_lost, rows, statements = run_phase(
+                    base_url, engine, members, online, args.messages, args.interval, phase_group_id
+                )
+                by_size[size][name] = phase_results(args.messages, delivery, acks, duration,
+                                                    phase_lost, rows, statements)
+                lost += phase_lost
+                print(f"{size} members, {name}: delivered {len(delivery)}/{args.messages} "
+                      f"messages in {duration:.2f}s, {rows / args.messages:.0f} rows "
+                      f"and {statements / args.messages:.1f} statements per message")
+        server_stats = requests.get(f'{base_url}/pipeline_stats').json()
+
+        results = {
+            'benchmark': 'groups',
+            'commit': git_commit(),
+            'database': database_url.split(':', 1)[0],
+            # The database URL may hold credentials
+            'config': {key: value for key, value in vars(args).items() if key != 'database_url'},
+            'sizes': by_size,
+            'server': {key: value for key, value in server_stats.items() if key != 'success'},
+        }
+        print(json.dumps(results, indent=2))
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2)
+        return 0 if lost == 0 else 1
+    finally:
+        engine.dispose()
+        worker.terminate()
+        worker.wait()
+        if db_file:
+            os.remove(db_file.name)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,146 @@
+"""Measure login latency and socket responsiveness during a login burst.
+
+Starts one app worker on a temporary SQLite database, registers users,
+keeps some Socket.IO clients pinging the server, then fires concurrent
+logins. Password hashing runs off the eventlet hub, so socket round trips
+should stay fast while the logins are in flight.
+
+    pip install -r requirements-dev.txt
+    python bench_login.py --users 50 --logins 200 --concurrency 20 --sockets 10
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from scale_check import connect, free_port, register, start_worker, wait_until_ready
+
+
+def percentile(samples, pct):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarize(samples):
+    return {
+        'count': len(samples),
+        'mean_ms': statistics.mean(samples) * 1000 if samples else None,
+        'p50_ms': percentile(samples, 50) * 1000 if samples else None,
+        'p95_ms': percentile(samples, 95) * 1000 if samples else None,
+        'p99_ms': percentile(samples, 99) * 1000 if samples else None,
+        'max_ms': max(samples) * 1000 if samples else None,
+    }
+
+
+def ping_loop(client, user_id, samples, stop):
+    while not stop.is_set():
+        started = time.perf_counter()
+        client.call('join_user_room', {'user_id': user_id}, timeout=10)
+        samples.append(time.perf_counter() - started)
+        time.sleep(0.05)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--logins', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--sockets', type=int, default=10)
+    parser.add_argument('--output', help='write results as JSON to this file')
+    args = parser.parse_args()
+
+    db_file = tempfile.NamedTemporaryFile(suffix='.db', delete=False)
+    db_file.close()
+    env = dict(os.environ, DATABASE_URL=f'sqlite:///{db_file.name}')
+    env.pop('SOCKETIO_MESSAGE_QUEUE', None)
+    port = free_port()
+    base_url = f'http://127.0.0.1:{port}'
+    worker = start_worker(port, env)
+    clients = []
+    try:
+        wait_until_ready(base_url)
+        phones = [f'09{i:08d}' for i in range(args.users)]
+        sessions = [register(base_url, f'user{i}', phone) for i, phone in enumerate(phones)]
+        print(f"Registered {args.users} users")
+
+        # Baseline socket latency with no logins running
+        stop = threading.Event()
+        idle_samples = []
+        for http, user_id in sessions[:args.sockets]:
+            client = connect(base_url, http)
+            clients.append((client, user_id))
+        threads = [
+            threading.Thread(target=ping_loop, args=(client, user_id, idle_samples, stop))
+            for client, user_id in clients
+        ]
+        for thread in threads:
+            thread.start()
+        time.sleep(2)
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+        # Socket latency while logins hash passwords
+        stop = threading.Event()
+        busy_samples = []
+        threads = [
+            threading.Thread(target=ping_loop, args=(client, user_id, busy_samples, stop))
+            for client, user_id in clients
+        ]
+        for thread in threads:
+            thread.start()
+
+        login_samples = []
+        failures = 0
+
+        def login(i):
+            started = time.perf_counter()
+            response = requests.post(f'{base_url}/login', json={
+                'phone': phones[i % len(phones)], 'password': 'secret'
+            })
+            return time.perf_counter() - started, response.json().get('success')
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            for elapsed, success in pool.map(login, range(args.logins)):
+                login_samples.append(elapsed)
+                failures += 0 if success else 1
+        duration = time.perf_counter() - started
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+        results = {
+            'benchmark': 'login',
+            'config': vars(args),
+            'logins_per_second': args.logins / duration,
+            'login_failures': failures,
+            'login_latency': summarize(login_samples),
+            'socket_rtt_idle': summarize(idle_samples),
+            'socket_rtt_during_logins': summarize(busy_samples),
+        }
+        print(json.dumps(results, indent=2))
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2)
+        return 0 if failures == 0 else 1
+    finally:
+        for client, _ in clients:
+            client.disconnect()
+        worker.terminate()
+        worker.wait()
+        os.remove(db_file.name)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,142 @@
+"""Local stand-in for a Socket.IO message queue.
+
+A tiny TCP broker that relays every published frame to every connected
+worker, a client that publishes and listens on it, and a python-socketio
+client manager built on that client. It lets several app processes on one
+machine share rooms and other pub/sub traffic without Redis:
+
+    python local_queue.py --port 6390
+    SOCKETIO_MESSAGE_QUEUE=local://127.0.0.1:6390 python app.py
+"""
+import pickle
+import socket
+import struct
+import threading
+from urllib.parse import urlparse
+
+import socketio
+
+HEADER = struct.Struct('!I')
+
+
+def send_frame(sock, payload):
+    sock.sendall(HEADER.pack(len(payload)) + payload)
+
+
+def recv_exact(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError('Connection closed')
+        data += chunk
+    return data
+
+
+def recv_frame(sock):
+    (size,) = HEADER.unpack(recv_exact(sock, HEADER.size))
+    return recv_exact(sock, size)
+
+
+def parse_url(url):
+    parsed = urlparse(url)
+    return parsed.hostname or '127.0.0.1', parsed.port or 6390
+
+
+class LocalQueueBroker:
+    """Relay frames from any connection to all connections"""
+
+    def __init__(self, host='127.0.0.1', port=6390):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind((host, port))
+        self.server.listen()
+        self.address = self.server.getsockname()
+        self.connections = []
+        self.lock = threading.Lock()
+
+    def serve_forever(self):
+        while True:
+            conn, _ = self.server.accept()
+            with self.lock:
+                self.connections.append(conn)
+            threading.Thread(target=self.relay, args=(conn,), daemon=True).start()
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def relay(self, conn):
+        try:
+            while True:
+                payload = recv_frame(conn)
+                with self.lock:
+                    connections = list(self.connections)
+                for other in connections:
+                    try:
+                        send_frame(other, payload)
+                    except OSError:
+                        pass
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            with self.lock:
+                if conn in self.connections:
+                    self.connections.remove(conn)
+            conn.close()
+
+
+class LocalQueueClient:
+    """Publish to and listen on a LocalQueueBroker"""
+
+    def __init__(self, url='local://127.0.0.1:6390'):
+        self.address = parse_url(url)
+        self.publisher = None
+        self.publish_lock = threading.Lock()
+
+    def publish(self, data):
+        payload = pickle.dumps(data)
+        with self.publish_lock:
+            if self.publisher is None:
+                self.publisher = socket.create_connection(self.address)
+            try:
+                send_frame(self.publisher, payload)
+            except OSError:
+                # Reconnect once if the broker connection dropped
+                self.publisher = socket.create_connection(self.address)
+                send_frame(self.publisher, payload)
+
+    def listen(self):
+        listener = socket.create_connection(self.address)
+        try:
+            while True:
+                yield pickle.loads(recv_frame(listener))
+        finally:
+            listener.close()
+
+
+class LocalQueueManager(socketio.PubSubManager):
+    """Client manager that publishes through a LocalQueueBroker"""
+    name = 'local'
+
+    def __init__(self, url='local://127.0.0.1:6390', channel='socketio',
+                 write_only=False, logger=None):
+        self.client = LocalQueueClient(url)
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+
+    def _publish(self, data):
+        self.client.publish(data)
+
+    def _listen(self):
+        yield from self.client.listen()
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Local Socket.IO message queue broker')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=6390)
+    args = parser.parse_args()
+    broker = LocalQueueBroker(args.host, args.port)
+    print(f"Local message queue listening on {args.host}:{args.port}")
+    broker.serve_forever()
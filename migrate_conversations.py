@@ -0,0 +1,89 @@
+from sqlalchemy import inspect, text
+
+from app import app, db, Conversation, Message, LAST_TEXT_LENGTH, conversation_ids, read_watermark_cache
+from rebuild_unread import rebuild_unread_counts
+
+def add_conversation_column():
+    """Add messages.conversation_id to databases created before conversations"""
+    columns = {column['name'] for column in inspect(db.engine).get_columns('messages')}
+    if 'conversation_id' in columns:
+        return
+    print("Adding messages.conversation_id...")
+    with db.engine.begin() as conn:
+        conn.execute(text("ALTER TABLE messages ADD COLUMN conversation_id INTEGER NULL"))
+        conn.execute(text("CREATE INDEX idx_messages_conversation_id ON messages (conversation_id, id)"))
+
+def legacy_watermarks():
+    """{(reader_id, peer_id): last read message id} from read_watermarks and is_seen flags"""
+    watermarks = {}
+    for reader_id, peer_id, message_id in db.session.query(
+        Message.receiver_id, Message.sender_id, db.func.max(Message.id)
+    ).filter(
+        Message.is_seen == True
+    ).group_by(Message.receiver_id, Message.sender_id).all():
+        watermarks[(reader_id, peer_id)] = message_id
+
+    if inspect(db.engine).has_table('read_watermarks'):
+        for reader_id, peer_id, message_id in db.session.execute(text(
+            "SELECT reader_id, peer_id, last_read_message_id FROM read_watermarks"
+        )).all():
+            watermarks[(reader_id, peer_id)] = max(watermarks.get((reader_id, peer_id), 0), message_id)
+    return watermarks
+
+def migrate_conversations():
+    """Create conversations from existing messages and link every message to one"""
+    with app.app_context():
+        try:
+            db.create_all()
+            add_conversation_column()
+
+            print("Creating conversations...")
+            user_a_id = db.case((Message.sender_id < Message.receiver_id, Message.sender_id), else_=Message.receiver_id)
+            user_b_id = db.case((Message.sender_id < Message.receiver_id, Message.receiver_id), else_=Message.sender_id)
+            pairs = set(db.session.query(user_a_id, user_b_id).distinct().all())
+            existing = set(db.session.query(Conversation.user_a_id, Conversation.user_b_id).all())
+            db.session.add_all([
+                Conversation(user_a_id=a, user_b_id=b) for a, b in pairs - existing
+            ])
+            db.session.flush()
+
+            print("Linking messages to conversations...")
+            linked = Message.query.filter(Message.conversation_id.is_(None)).update({
+                Message.conversation_id: db.select(Conversation.id).where(
+                    Conversation.user_a_id == user_a_id,
+                    Conversation.user_b_id == user_b_id
+                ).scalar_subquery()
+            }, synchronize_session=False)
+
+            print("Copying read state and last messages...")
+            watermarks = legacy_watermarks()
+            newest_ids = db.select(db.func.max(Message.id)).group_by(Message.conversation_id)
+            last_messages = {
+                message.conversation_id: message
+                for message in Message.query.filter(Message.id.in_(newest_ids)).all()
+            }
+            conversations = Conversation.query.all()
+            for conversation in conversations:
+                a, b = conversation.user_a_id, conversation.user_b_id
+                conversation.a_last_read_id = max(conversation.a_last_read_id or 0, watermarks.get((a, b), 0))
+                conversation.b_last_read_id = max(conversation.b_last_read_id or 0, watermarks.get((b, a), 0))
+                message = last_messages.get(conversation.id)
+                if message:
+                    conversation.last_message_id = message.id
+                    conversation.last_sender_id = message.sender_id
+                    conversation.last_text = message.message_text[:LAST_TEXT_LENGTH]
+                    conversation.last_sent_at = message.sent_at
+            db.session.commit()
+            conversation_ids.clear()
+            read_watermark_cache.clear()
+            print(f"Migrated {len(conversations)} conversations and linked {linked} messages!")
+        except Exception as e:
+            db.session.rollback()
+            print(f"Error migrating conversations: {e}")
+            import traceback
+            traceback.print_exc()
+            return False
+    return rebuild_unread_counts()
+
+if __name__ == "__main__":
+    migrate_conversations()
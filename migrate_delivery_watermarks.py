@@ -0,0 +1,34 @@
+from sqlalchemy import inspect, text
+
+from app import app, db
+
+def migrate_delivery_watermarks():
+    """Add users.last_delivered_id, counting every existing message as delivered"""
+    with app.app_context():
+        try:
+            db.create_all()
+            columns = {column['name'] for column in inspect(db.engine).get_columns('users')}
+            if 'last_delivered_id' in columns:
+                print("users.last_delivered_id already exists, nothing to do")
+                return True
+            
+            print("Adding users.last_delivered_id...")
+            with db.engine.begin() as conn:
+                conn.execute(text("ALTER TABLE users ADD COLUMN last_delivered_id INTEGER NOT NULL DEFAULT 0"))
+                conn.execute(text("CREATE INDEX idx_messages_receiver_id ON messages (receiver_id, id)"))
+                # Existing history was already available to the client; only
+                # messages sent from now on wait for delivery
+                updated = conn.execute(text(
+                    "UPDATE users SET last_delivered_id = "
+                    "(SELECT COALESCE(MAX(id), 0) FROM messages WHERE messages.receiver_id = users.id)"
+                )).rowcount
+            print(f"Set delivery watermarks for {updated} users!")
+        except Exception as e:
+            print(f"Error migrating delivery watermarks: {e}")
+            import traceback
+            traceback.print_exc()
+            return False
+    return True
+
+if __name__ == "__main__":
+    migrate_delivery_watermarks()
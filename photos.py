@@ -0,0 +1,36 @@
+"""Profile photo processing.
+
+Kept free of app imports so it can run off the eventlet hub: decoding and
+resizing are CPU bound and would otherwise stall every socket.
+"""
+import io
+
+from PIL import Image, ImageOps
+
+# Square sizes generated for every upload, in pixels
+PHOTO_SIZES = (48, 96, 256)
+
+PHOTO_FORMATS = {
+    'jpg': ('JPEG', {'quality': 85, 'optimize': True, 'progressive': True}),
+    'webp': ('WEBP', {'quality': 80, 'method': 4}),
+}
+
+
+def render_photo_variants(data):
+    """Decode an upload and return {'<size>.<ext>': bytes} for every size and format.
+
+    The image is rotated according to its EXIF orientation, then re-encoded
+    from pixels only, so EXIF/GPS and other metadata never reach the output.
+    """
+    with Image.open(io.BytesIO(data)) as image:
+        image = ImageOps.exif_transpose(image)
+        image = image.convert('RGB')
+
+    variants = {}
+    for size in PHOTO_SIZES:
+        resized = ImageOps.fit(image, (size, size), Image.LANCZOS)
+        for ext, (image_format, options) in PHOTO_FORMATS.items():
+            buffer = io.BytesIO()
+            resized.save(buffer, image_format, **options)
+            variants[f'{size}.{ext}'] = buffer.getvalue()
+    return variants
@@ -0,0 +1,341 @@
+"""Check every route and Socket.IO event against its SQL statement budget.
+
+Loads the app in process on a temporary SQLite database, seeds users with
+10, 100 and 1000 contacts and messages, and calls each route and event
+once per size with every cache cleared. While a handler runs, a recorder
+counts its SQL statements, the rows its ORM queries return and any
+statement repeated with the same parameters.
+
+A handler fails if it runs more statements than its @query_budget allows,
+or if its statement count grows with the data size (an N+1 query). A few
+handlers also have their responses checked, so a flat count can't come
+from returning less.
+
+    python query_budget.py
+"""
+import logging
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+DATA_SIZES = (10, 100, 1000)
+PASSWORD = 'secret'
+
+db_file = tempfile.NamedTemporaryFile(suffix='.db', delete=False)
+db_file.close()
+os.environ['DATABASE_URL'] = f'sqlite:///{db_file.name}'
+os.environ.pop('SOCKETIO_MESSAGE_QUEUE', None)
+os.environ.pop('PRESENCE_REGISTRY_URL', None)
+os.environ.pop('USER_CACHE_INVALIDATION_URL', None)
+
+import app as chat
+from flask import has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+
+class SqlRecorder:
+    """Statements and rows run inside a request or socket event"""
+
+    def __init__(self):
+        self.statements = []
+        self.rows = 0
+        event.listen(Engine, 'before_cursor_execute', self.before_cursor_execute)
+        event.listen(Session, 'do_orm_execute', self.do_orm_execute)
+
+    def reset(self):
+        self.statements = []
+        self.rows = 0
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if has_request_context():
+            self.statements.append((statement, repr(parameters)))
+
+    def do_orm_execute(self, state):
+        if not (state.is_select and has_request_context()):
+            return None
+        # Buffer the result to count its rows, then hand back a fresh copy
+        frozen = state.invoke_statement().freeze()
+        self.rows += len(frozen.data)
+        return frozen()
+
+    def duplicates(self):
+        return len(self.statements) - len(set(self.statements))
+
+
+def clear_caches():
+    chat.user_profiles.entries.clear()
+    chat.contact_cache.clear()
+    chat.search_cache.clear()
+    chat.conversation_ids.clear()
+    chat.read_watermark_cache.clear()
+    chat.group_member_cache.clear()
+    chat.group_watermark_cache.clear()
+    chat.user_search_index.loaded_at = None
+    chat.health_state['checked_at'] = 0
+
+
+def seed(size):
+    """A user with size contacts, size messages with the first of them and a group with the rest"""
+    password_hash = chat.hash_password(PASSWORD)
+    subject = chat.User(username=f'subject{size}', phone=f'091{size:07d}', password_hash=password_hash)
+    stranger = chat.User(username=f'stranger{size}', phone=f'092{size:07d}', password_hash=password_hash)
+    peers = [
+        chat.User(username=f'peer{size}x{i}', phone=f'093{size:03d}{i:04d}', password_hash=password_hash)
+        for i in range(size)
+    ]
+    chat.db.session.add_all([subject, stranger] + peers)
+    chat.db.session.flush()
+    for peer in peers:
+        chat.db.session.add(chat.Contact(user_id=subject.id, contact_id=peer.id))
+        chat.db.session.add(chat.Contact(user_id=peer.id, contact_id=subject.id))
+    # Every contact has a conversation, so the chat list joins them all
+    conversations = [
+        chat.Conversation(user_a_id=min(subject.id, peer.id), user_b_id=max(subject.id, peer.id),
+                          last_text='hello', last_sent_at=datetime.utcnow())
+        for peer in peers
+    ]
+    chat.db.session.add_all(conversations)
+    chat.db.session.flush()
+    for n in range(size):
+        sender, receiver = (subject, peers[0]) if n % 2 else (peers[0], subject)
+        message = chat.Message(
+            conversation_id=conversations[0].id, sender_id=sender.id, receiver_id=receiver.id,
+            message_text=f'message {n}', sent_at=datetime.utcnow()
+        )
+        chat.db.session.add(message)
+        chat.db.session.flush()
+        conversations[0].last_message_id = message.id
+    # The first two peers aren't in the group, so it has room to add one
+    group = chat.ChatGroup(name=f'group{size}', created_by=subject.id)
+    chat.db.session.add(group)
+    chat.db.session.flush()
+    chat.db.session.add_all([
+        chat.GroupMember(group_id=group.id, user_id=user.id) for user in [subject] + peers[2:]
+    ])
+    for n in range(size):
+        sender = subject if n % 2 else peers[-1]
+        message = chat.GroupMessage(
+            group_id=group.id, sender_id=sender.id, message_text=f'group message {n}', sent_at=datetime.utcnow()
+        )
+        chat.db.session.add(message)
+        chat.db.session.flush()
+        group.last_message_id = message.id
+        group.last_sent_at = message.sent_at
+    # Index the seeded history the way rebuild_search_index.py would
+    chat.index_messages(
+        [row for message in chat.Message.query.filter_by(conversation_id=conversations[0].id).all()
+         for row in chat.message_term_rows(message.id, message.message_text, message.sent_at,
+                                           conversation_id=message.conversation_id)] +
+        [row for message in chat.GroupMessage.query.filter_by(group_id=group.id).all()
+         for row in chat.message_term_rows(message.id, message.message_text, message.sent_at,
+                                           group_id=message.group_id)]
+    )
+    chat.db.session.commit()
+    last_message = chat.Message.query.filter_by(sender_id=subject.id).order_by(chat.Message.id.desc()).first()
+    last_received = chat.Message.query.filter_by(receiver_id=subject.id).order_by(chat.Message.id.desc()).first()
+    return {
+        'size': size,
+        'subject': subject.id,
+        'subject_phone': subject.phone,
+        'peer': peers[0].id,
+        'stranger': stranger.id,
+        'sent_message': last_message.id,
+        'received_message': last_received.id,
+        'group': group.id,
+        'group_message': group.last_message_id,
+        # Replays every change the subject has
+        'cursor': chat.encode_sync_cursor(0, time.time()),
+    }
+
+
+def login(client, phone):
+    data = client.post('/login', json={'phone': phone, 'password': PASSWORD}).get_json()
+    if not data.get('success'):
+        raise RuntimeError(f"Login failed: {data.get('message')}")
+
+
+def http_scenarios(data):
+    """{endpoint: function(client)} exercising each route for one seeded user"""
+    return {
+        'serve_index': lambda c: c.get('/'),
+        'serve_login': lambda c: c.get('/login.html'),
+        'serve_register': lambda c: c.get('/register.html'),
+        'serve_dashboard': lambda c: c.get('/dashboard.html'),
+        'serve_settings': lambda c: c.get('/settings.html'),
+        'serve_default': lambda c: c.get('/default.jpg'),
+        'serve_upload': lambda c: c.get('/uploads/missing.jpg'),
+        'serve_metrics': lambda c: c.get('/metrics'),
+        'health_check': lambda c: c.get('/health'),
+        'pipeline_stats': lambda c: c.get('/pipeline_stats'),
+        'register': lambda c: c.post('/register', json={
+            'username': f"newcomer{data['size']}", 'phone': f"094{data['size']:07d}", 'password': PASSWORD
+        }),
+        'login': lambda c: c.post('/login', json={'phone': data['subject_phone'], 'password': PASSWORD}),
+        'get_profile': lambda c: c.get('/get_profile'),
+        'search_users': lambda c: c.get('/search_users', query_string={'q': f"peer{data['size']}x"}),
+        'get_contacts': lambda c: c.get('/get_contacts'),
+        'presence_snapshot': lambda c: c.get('/presence_snapshot'),
+        'get_messages': lambda c: c.get('/get_messages', query_string={'user_id': data['peer']}),
+        'add_contact': lambda c: c.post('/add_contact', json={'contact_id': data['stranger']}),
+        'sync': lambda c: c.get('/sync', query_string={'cursor': data['cursor']}),
+        'create_group': lambda c: c.post('/create_group', json={
+            'name': f"new group{data['size']}", 'member_ids': [data['peer']]
+        }),
+        'add_group_members': lambda c: c.post('/add_group_members', json={
+            'group_id': data['group'], 'member_ids': [data['peer']]
+        }),
+        'get_groups': lambda c: c.get('/get_groups'),
+        'get_group_members': lambda c: c.get('/get_group_members', query_string={'group_id': data['group']}),
+        'search_messages': lambda c: c.get('/search_messages', query_string={'q': 'message 1'}),
+        'get_group_messages': lambda c: c.get('/get_group_messages', query_string={'group_id': data['group']}),
+        'update_profile': lambda c: c.post('/update_profile', data={'username': f"renamed{data['size']}"}),
+        'delete_message': lambda c: c.post('/delete_message', json={
+            'message_id': data['sent_message'], 'user_id': data['subject']
+        }),
+        'logout': lambda c: c.post('/logout'),
+    }
+
+
+def socket_scenarios(data):
+    """[(event, function(socket client))] in the order a session produces them"""
+    return [
+        ('user_online', lambda s: s.emit('user_online', {'user_id': data['subject']})),
+        ('join_user_room', lambda s: s.emit('join_user_room', {'user_id': data['subject']})),
+        ('send_message', lambda s: s.emit('send_message', {
+            'sender_id': data['subject'], 'receiver_id': data['peer'], 'message_text': 'hello'
+        })),
+        ('message_seen', lambda s: s.emit('message_seen', {
+            'message_id': data['received_message'], 'user_id': data['subject'], 'sender_id': data['peer']
+        })),
+        ('sync', lambda s: s.emit('sync', {'cursor': data['cursor']}, callback=True)),
+        ('join_group', lambda s: s.emit('join_group', {'group_id': data['group']}, callback=True)),
+        ('send_group_message', lambda s: s.emit('send_group_message', {
+            'group_id': data['group'], 'message_text': 'hello everyone'
+        })),
+        ('group_seen', lambda s: s.emit('group_seen', {
+            'group_id': data['group'], 'message_id': data['group_message']
+        })),
+        ('profiles', lambda s: s.emit('profiles', {'user_ids': [data['peer'], data['stranger']]}, callback=True)),
+        ('typing', lambda s: s.emit('typing', {
+            'sender_id': data['subject'], 'receiver_id': data['peer'], 'is_typing': True
+        })),
+        ('disconnect', lambda s: s.disconnect()),
+    ]
+
+
+def response_checks(data):
+    """{endpoint: function(response) returning a problem or None}"""
+    def every_contact(response):
+        contacts = response.get_json().get('contacts', [])
+        if len(contacts) != data['size']:
+            return f"returned {len(contacts)} of {data['size']} contacts"
+    return {
+        'get_contacts': every_contact,
+    }
+
+
+def measure(recorder, call, check=None):
+    clear_caches()
+    recorder.reset()
+    response = call()
+    return {
+        'statements': len(recorder.statements),
+        'rows': recorder.rows,
+        'duplicates': recorder.duplicates(),
+        'problem': check(response) if check else None,
+    }
+
+
+def run_size(recorder, data):
+    results = {}
+    client = chat.app.test_client()
+    login(client, data['subject_phone'])
+
+    # Socket events first, while the session is logged in
+    socket_client = None
+
+    def connect():
+        nonlocal socket_client
+        socket_client = chat.socketio.test_client(chat.app, flask_test_client=client)
+    results['socket:connect'] = measure(recorder, connect)
+    for name, call in socket_scenarios(data):
+        results[f'socket:{name}'] = measure(recorder, lambda: call(socket_client))
+
+    scenarios = http_scenarios(data)
+    checks = response_checks(data)
+    # Logout ends the session, so it goes last
+    for endpoint in sorted(scenarios, key=lambda name: name == 'logout'):
+        results[endpoint] = measure(recorder, lambda: scenarios[endpoint](client), checks.get(endpoint))
+    return results
+
+
+def declared_budgets():
+    budgets = {}
+    for endpoint, view in chat.app.view_functions.items():
+        if endpoint != 'static':
+            budgets[endpoint] = getattr(view, 'query_budget', None)
+    for event_name, handler in chat.socketio.server.handlers.get('/', {}).items():
+        budgets[f'socket:{event_name}'] = getattr(handler, 'query_budget', None)
+    return budgets
+
+
+def main():
+    logging.getLogger('socketio').setLevel(logging.ERROR)
+    logging.getLogger('engineio').setLevel(logging.ERROR)
+    chat.app.config['TESTING'] = True
+    recorder = SqlRecorder()
+    budgets = declared_budgets()
+
+    by_size = {}
+    with chat.app.app_context():
+        for size in DATA_SIZES:
+            data = seed(size)
+            by_size[size] = run_size(recorder, data)
+
+    failures = []
+    print(f"{'handler':<28} {'budget':>6} " + ' '.join(f'{size:>16}' for size in DATA_SIZES))
+    for handler in sorted(budgets):
+        budget = budgets[handler]
+        counts = [by_size[size].get(handler) for size in DATA_SIZES]
+        cells = ' '.join(
+            f"{'-':>16}" if c is None else f"{c['statements']:>4} st {c['rows']:>5} rows"
+            for c in counts
+        )
+        print(f"{handler:<28} {'-' if budget is None else budget:>6} {cells}")
+
+        if budget is None:
+            failures.append(f'{handler}: no @query_budget declared')
+            continue
+        if None in counts:
+            failures.append(f'{handler}: not exercised by query_budget.py')
+            continue
+        statements = [c['statements'] for c in counts]
+        if max(statements) > budget:
+            failures.append(f'{handler}: {max(statements)} statements, budget is {budget}')
+        if len(set(statements)) > 1:
+            failures.append(f'{handler}: statement count changes with data size {statements}')
+        duplicates = max(c['duplicates'] for c in counts)
+        if duplicates:
+            failures.append(f'{handler}: {duplicates} statements repeated with the same parameters')
+        for size, c in zip(DATA_SIZES, counts):
+            if c['problem']:
+                failures.append(f"{handler}: {c['problem']} at size {size}")
+
+    if failures:
+        print('\nFAIL')
+        for failure in failures:
+            print(f'  {failure}')
+        return 1
+    print('\nPASS: every handler is within budget and flat across data sizes')
+    return 0
+
+
+if __name__ == '__main__':
+    try:
+        sys.exit(main())
+    finally:
+        os.remove(db_file.name)
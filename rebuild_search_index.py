@@ -0,0 +1,60 @@
+from app import app, db, GroupMessage, Message, MessageTerm, index_messages, message_term_rows
+
+REBUILD_BATCH_SIZE = 1000
+
+def reindex_messages(model, scope):
+    """Replace the terms of every message in model, one batch of ids per transaction.
+
+    scope is 'conversation_id' or 'group_id', the column the terms are keyed
+    by. Messages sent after the rebuild starts are indexed by the send
+    pipeline, so only ids up to the current newest one are touched.
+    """
+    scope_column = getattr(model, scope)
+    last_id = db.session.query(db.func.max(model.id)).scalar() or 0
+    after_id = 0
+    indexed = 0
+    while after_id < last_id:
+        messages = db.session.query(model.id, scope_column, model.message_text, model.sent_at).filter(
+            model.id > after_id,
+            model.id <= last_id
+        ).order_by(model.id).limit(REBUILD_BATCH_SIZE).all()
+        upper_id = messages[-1].id if len(messages) == REBUILD_BATCH_SIZE else last_id
+
+        # Also drops terms left behind by messages deleted before the index
+        # kept up with deletions
+        MessageTerm.query.filter(
+            getattr(MessageTerm, scope).isnot(None),
+            MessageTerm.message_id > after_id,
+            MessageTerm.message_id <= upper_id
+        ).delete(synchronize_session=False)
+        rows = []
+        for message_id, scope_id, message_text, sent_at in messages:
+            # Messages not yet linked by migrate_conversations.py can't be scoped
+            if scope_id is not None:
+                rows += message_term_rows(message_id, message_text, sent_at, **{scope: scope_id})
+                indexed += 1
+        index_messages(rows)
+        db.session.commit()
+        after_id = upper_id
+    return indexed
+
+def rebuild_search_index():
+    """Rebuild message_terms from all direct and group messages"""
+    with app.app_context():
+        try:
+            db.create_all()
+            print("Indexing messages...")
+            direct = reindex_messages(Message, 'conversation_id')
+            print("Indexing group messages...")
+            grouped = reindex_messages(GroupMessage, 'group_id')
+            print(f"Indexed {direct} messages and {grouped} group messages!")
+        except Exception as e:
+            db.session.rollback()
+            print(f"Error rebuilding search index: {e}")
+            import traceback
+            traceback.print_exc()
+            return False
+    return True
+
+if __name__ == "__main__":
+    rebuild_search_index()
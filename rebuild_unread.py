@@ -0,0 +1,32 @@
+from app import app, db, Conversation, Message
+
+def unread_subquery(last_read_id, peer_id):
+    """Messages from peer_id after the side's read watermark, correlated to each conversation"""
+    return db.select(db.func.count(Message.id)).where(
+        Message.conversation_id == Conversation.id,
+        Message.sender_id == peer_id,
+        Message.id > last_read_id
+    ).scalar_subquery()
+
+def rebuild_unread_counts():
+    """Recount both sides' unread messages on every conversation"""
+    with app.app_context():
+        try:
+            print("Counting unread messages...")
+            # Unread messages are the ones above the receiver's read watermark
+            updated = Conversation.query.update({
+                Conversation.a_unread_count: unread_subquery(Conversation.a_last_read_id, Conversation.user_b_id),
+                Conversation.b_unread_count: unread_subquery(Conversation.b_last_read_id, Conversation.user_a_id),
+            }, synchronize_session=False)
+            db.session.commit()
+            print(f"Rebuilt unread counts for {updated} conversations!")
+        except Exception as e:
+            db.session.rollback()
+            print(f"Error rebuilding unread counts: {e}")
+            import traceback
+            traceback.print_exc()
+            return False
+    return True
+
+if __name__ == "__main__":
+    rebuild_unread_counts()
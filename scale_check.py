@@ -0,0 +1,131 @@
+"""Check that messages are delivered across workers through the message queue.
+
+Starts a local_queue broker and two app workers that share a SQLite
+database. A receiver connects to worker A, a sender connects to worker B
+and sends it a message, and the check passes if worker A delivers it.
+
+    pip install -r requirements-dev.txt
+    python scale_check.py
+"""
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+import socketio
+
+from local_queue import LocalQueueBroker
+
+DELIVERY_TIMEOUT = 10
+STARTUP_TIMEOUT = 30
+
+
+def start_worker(port, env):
+    worker_env = dict(env, PORT=str(port))
+    return subprocess.Popen(
+        [sys.executable, 'app.py'],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=worker_env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+
+
+def wait_until_ready(base_url):
+    deadline = time.time() + STARTUP_TIMEOUT
+    while time.time() < deadline:
+        try:
+            if requests.get(f'{base_url}/health', timeout=1).ok:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f'Worker at {base_url} did not start')
+
+
+def register(base_url, username, phone):
+    http = requests.Session()
+    data = http.post(f'{base_url}/register', json={
+        'username': username, 'phone': phone, 'password': 'secret'
+    }).json()
+    if not data.get('success'):
+        raise RuntimeError(f"Registering {username} failed: {data.get('message')}")
+    return http, data['user_id']
+
+
+def connect(base_url, http):
+    client = socketio.Client()
+    cookies = '; '.join(f'{name}={value}' for name, value in http.cookies.items())
+    client.connect(base_url, headers={'Cookie': cookies}, transports=['websocket'])
+    return client
+
+
+def free_port():
+    import socket
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def main():
+    broker = LocalQueueBroker('127.0.0.1', 0).start()
+    host, port = broker.address
+    db_file = tempfile.NamedTemporaryFile(suffix='.db', delete=False)
+    db_file.close()
+
+    env = dict(os.environ)
+    env['DATABASE_URL'] = f'sqlite:///{db_file.name}'
+    env['SOCKETIO_MESSAGE_QUEUE'] = f'local://{host}:{port}'
+
+    worker_a = f'http://127.0.0.1:{free_port()}'
+    worker_b = f'http://127.0.0.1:{free_port()}'
+    workers = [start_worker(worker_a.rsplit(':', 1)[1], env)]
+    clients = []
+    try:
+        # Start worker A alone first so only one process creates the tables
+        wait_until_ready(worker_a)
+        workers.append(start_worker(worker_b.rsplit(':', 1)[1], env))
+        wait_until_ready(worker_b)
+
+        receiver_http, receiver_id = register(worker_a, 'receiver', '0911111111')
+        sender_http, sender_id = register(worker_b, 'sender', '0922222222')
+
+        delivered = threading.Event()
+        received = {}
+        receiver = connect(worker_a, receiver_http)
+        clients.append(receiver)
+
+        @receiver.on('new_message')
+        def on_new_message(message):
+            received.update(message)
+            delivered.set()
+
+        receiver.emit('join_user_room', {'user_id': receiver_id})
+        print(f"Worker A: receiver {receiver_id} connected")
+
+        sender = connect(worker_b, sender_http)
+        clients.append(sender)
+        sender.emit('send_message', {
+            'sender_id': sender_id,
+            'receiver_id': receiver_id,
+            'message_text': 'hello from the other worker'
+        })
+        print(f"Worker B: sender {sender_id} sent a message")
+
+        if delivered.wait(DELIVERY_TIMEOUT):
+            print(f"PASS: worker A delivered message {received['id']}: {received['message_text']!r}")
+            return 0
+        print("FAIL: message sent on worker B never reached worker A")
+        return 1
+    finally:
+        for client in clients:
+            client.disconnect()
+        for worker in workers:
+            worker.terminate()
+            worker.wait()
+        os.remove(db_file.name)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -10,20 +10,46 @@ CREATE TABLE IF NOT EXISTS users (
     profile_photo VARCHAR(255) DEFAULT 'default.jpg',
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     last_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    is_online BOOLEAN DEFAULT FALSE
+    is_online BOOLEAN DEFAULT FALSE,
+    last_delivered_id INT NOT NULL DEFAULT 0
+);
+
+-- Conversations: one row per pair of users (user_a_id < user_b_id) with the
+-- last-message summary for the chat list and each side's read state
+CREATE TABLE IF NOT EXISTS conversations (
+    id INT PRIMARY KEY AUTO_INCREMENT,
+    user_a_id INT NOT NULL,
+    user_b_id INT NOT NULL,
+    last_message_id INT NULL,
+    last_sender_id INT NULL,
+    last_text VARCHAR(100) NULL,
+    last_sent_at TIMESTAMP NULL,
+    a_last_read_id INT NOT NULL DEFAULT 0,
+    b_last_read_id INT NOT NULL DEFAULT 0,
+    a_unread_count INT NOT NULL DEFAULT 0,
+    b_unread_count INT NOT NULL DEFAULT 0,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE KEY unique_conversation (user_a_id, user_b_id),
+    FOREIGN KEY (user_a_id) REFERENCES users(id) ON DELETE CASCADE,
+    FOREIGN KEY (user_b_id) REFERENCES users(id) ON DELETE CASCADE,
+    INDEX idx_conversations_a_recent (user_a_id, last_sent_at),
+    INDEX idx_conversations_b_recent (user_b_id, last_sent_at)
 );
 
 -- Messages table
 CREATE TABLE IF NOT EXISTS messages (
     id INT PRIMARY KEY AUTO_INCREMENT,
+    conversation_id INT NULL,
     sender_id INT NOT NULL,
     receiver_id INT NOT NULL,
     message_text TEXT NOT NULL,
     is_seen BOOLEAN DEFAULT FALSE,
     sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (conversation_id) REFERENCES conversations(id) ON DELETE CASCADE,
     FOREIGN KEY (sender_id) REFERENCES users(id) ON DELETE CASCADE,
     FOREIGN KEY (receiver_id) REFERENCES users(id) ON DELETE CASCADE,
-    INDEX idx_sender_receiver (sender_id, receiver_id),
+    INDEX idx_messages_conversation_id (conversation_id, id),
+    INDEX idx_messages_receiver_id (receiver_id, id),
     INDEX idx_receiver_sender (receiver_id, sender_id)
 );
 
@@ -38,3 +64,68 @@ CREATE TABLE IF NOT EXISTS contacts (
     FOREIGN KEY (contact_id) REFERENCES users(id) ON DELETE CASCADE
 );
 
+-- Change log replayed by /sync; rows past the retention window are pruned
+CREATE TABLE IF NOT EXISTS changes (
+    id INT PRIMARY KEY AUTO_INCREMENT,
+    user_id INT NOT NULL,
+    kind VARCHAR(20) NOT NULL,
+    payload TEXT NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE,
+    INDEX idx_changes_user_id (user_id, id),
+    INDEX idx_changes_created_at (created_at)
+);
+
+-- Groups ("groups" is reserved in MySQL 8). A group message is stored once;
+-- each member's read state is the last_read_id watermark on group_members
+CREATE TABLE IF NOT EXISTS chat_groups (
+    id INT PRIMARY KEY AUTO_INCREMENT,
+    name VARCHAR(100) NOT NULL,
+    created_by INT NOT NULL,
+    last_message_id INT NULL,
+    last_sender_id INT NULL,
+    last_text VARCHAR(100) NULL,
+    last_sent_at TIMESTAMP NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (created_by) REFERENCES users(id) ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS group_members (
+    id INT PRIMARY KEY AUTO_INCREMENT,
+    group_id INT NOT NULL,
+    user_id INT NOT NULL,
+    last_read_id INT NOT NULL DEFAULT 0,
+    joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE KEY unique_group_member (group_id, user_id),
+    FOREIGN KEY (group_id) REFERENCES chat_groups(id) ON DELETE CASCADE,
+    FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE,
+    INDEX idx_group_members_user_id (user_id)
+);
+
+CREATE TABLE IF NOT EXISTS group_messages (
+    id INT PRIMARY KEY AUTO_INCREMENT,
+    group_id INT NOT NULL,
+    sender_id INT NOT NULL,
+    message_text TEXT NOT NULL,
+    sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (group_id) REFERENCES chat_groups(id) ON DELETE CASCADE,
+    FOREIGN KEY (sender_id) REFERENCES users(id) ON DELETE CASCADE,
+    INDEX idx_group_messages_group_id (group_id, id)
+);
+
+-- Inverted index for message search: a row per distinct word of each
+-- message, keyed by its conversation (messages) or group (group_messages)
+CREATE TABLE IF NOT EXISTS message_terms (
+    id INT PRIMARY KEY AUTO_INCREMENT,
+    term VARCHAR(32) NOT NULL,
+    conversation_id INT NULL,
+    group_id INT NULL,
+    message_id INT NOT NULL,
+    occurrences INT NOT NULL DEFAULT 1,
+    sent_at TIMESTAMP NULL,
+    FOREIGN KEY (conversation_id) REFERENCES conversations(id) ON DELETE CASCADE,
+    FOREIGN KEY (group_id) REFERENCES chat_groups(id) ON DELETE CASCADE,
+    INDEX idx_message_terms_conversation (term, conversation_id, message_id),
+    INDEX idx_message_terms_group (term, group_id, message_id),
+    INDEX idx_message_terms_message_id (message_id)
+);
@@ -0,0 +1,88 @@
+"""In-memory static assets with strong ETags and precompressed variants.
+
+Pages and images are read once when the manifest is built. Each asset gets
+a content hash, used as its ETag and as a version for cache-busting URLs,
+plus gzip and (when the brotli package is installed) brotli variants, so
+serving a request only picks a variant and compares ETags. Edited files are
+picked up on the next restart.
+"""
+import gzip
+import hashlib
+import mimetypes
+import os
+
+from flask import Response, request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Content encodings in order of preference
+COMPRESSORS = {'gzip': lambda data: gzip.compress(data, compresslevel=9, mtime=0)}
+if brotli is not None:
+    COMPRESSORS = {'br': lambda data: brotli.compress(data, quality=11), **COMPRESSORS}
+
+COMPRESSIBLE_TYPES = ('text/', 'application/javascript', 'application/json', 'image/svg+xml')
+
+# Versioned URLs never change content, so caches may keep them for a year
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+
+class StaticAsset:
+    def __init__(self, path, data):
+        self.path = path
+        self.mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        self.digest = hashlib.sha256(data).hexdigest()
+        self.version = self.digest[:12]
+        self.variants = {'identity': data}
+        if self.mimetype.startswith(COMPRESSIBLE_TYPES):
+            for encoding, compress in COMPRESSORS.items():
+                compressed = compress(data)
+                if len(compressed) < len(data):
+                    self.variants[encoding] = compressed
+
+    def etag(self, encoding):
+        # Each encoding is a different representation and needs its own tag
+        if encoding == 'identity':
+            return self.digest[:32]
+        return f'{self.digest[:32]}-{encoding}'
+
+
+class StaticManifest:
+    """Assets under root, keyed by their path relative to it"""
+
+    def __init__(self, root, paths):
+        self.assets = {}
+        for path in paths:
+            with open(os.path.join(root, path), 'rb') as f:
+                self.assets[path] = StaticAsset(path, f.read())
+
+    def url(self, path):
+        """Versioned URL for an asset, safe to cache forever"""
+        return f'/{path}?v={self.assets[path].version}'
+
+    def choose_encoding(self, asset):
+        for encoding in COMPRESSORS:
+            if encoding in asset.variants and request.accept_encodings[encoding]:
+                return encoding
+        return 'identity'
+
+    def response(self, path):
+        asset = self.assets[path]
+        encoding = self.choose_encoding(asset)
+        response = Response(asset.variants[encoding], mimetype=asset.mimetype)
+        response.set_etag(asset.etag(encoding))
+        if encoding != 'identity':
+            response.content_encoding = encoding
+        if len(asset.variants) > 1:
+            response.vary.add('Accept-Encoding')
+
+        if request.args.get('v') == asset.version:
+            response.cache_control.public = True
+            response.cache_control.max_age = IMMUTABLE_MAX_AGE
+            response.cache_control.immutable = True
+        else:
+            # Unversioned URLs may change on deploy; revalidate every time
+            response.cache_control.no_cache = True
+        return response.make_conditional(request)
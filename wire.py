@@ -0,0 +1,165 @@
+"""Compact wire format for Socket.IO payloads.
+
+A msgpack encoder and decoder for the types the app sends (None, bools,
+ints, floats, strings, bytes, lists and dicts), so compact mode needs no
+extra dependency. The output is standard msgpack and any msgpack library
+can read it.
+
+Compact clients get messages as arrays in MESSAGE_FIELDS order with
+sent_at as integer epoch milliseconds, and look sender names and photos up
+once per session instead of receiving them with every message.
+"""
+import calendar
+import struct
+
+MESSAGE_FIELDS = ('id', 'sender_id', 'receiver_id', 'message_text', 'sent_at', 'is_seen')
+PROFILE_FIELDS = ('id', 'username', 'photo_url')
+
+
+def epoch_millis(moment):
+    """Naive UTC datetime to integer epoch milliseconds"""
+    return calendar.timegm(moment.utctimetuple()) * 1000 + moment.microsecond // 1000
+
+
+def pack_int(value, out):
+    if 0 <= value < 0x80:
+        out.append(value)
+    elif -0x20 <= value < 0:
+        out.append(value & 0xff)
+    elif value >= 0:
+        for marker, fmt, limit in ((0xcc, '>B', 0xff), (0xcd, '>H', 0xffff),
+                                   (0xce, '>I', 0xffffffff), (0xcf, '>Q', 0xffffffffffffffff)):
+            if value <= limit:
+                out.append(marker)
+                out += struct.pack(fmt, value)
+                return
+        raise ValueError(f'{value} is too large for msgpack')
+    else:
+        for marker, fmt, limit in ((0xd0, '>b', 0x80), (0xd1, '>h', 0x8000),
+                                   (0xd2, '>i', 0x80000000), (0xd3, '>q', 0x8000000000000000)):
+            if value >= -limit:
+                out.append(marker)
+                out += struct.pack(fmt, value)
+                return
+        raise ValueError(f'{value} is too small for msgpack')
+
+
+def pack_length(length, fix_marker, fix_limit, markers, out):
+    """Write a str/bin/array/map header; markers are the 8, 16 and 32-bit forms"""
+    if fix_marker is not None and length < fix_limit:
+        out.append(fix_marker | length)
+        return
+    for marker, fmt, limit in zip(markers, ('>B', '>H', '>I'), (0xff, 0xffff, 0xffffffff)):
+        if marker is not None and length <= limit:
+            out.append(marker)
+            out += struct.pack(fmt, length)
+            return
+    raise ValueError(f'Length {length} is too large for msgpack')
+
+
+def pack_into(value, out):
+    if value is None:
+        out.append(0xc0)
+    elif value is True:
+        out.append(0xc3)
+    elif value is False:
+        out.append(0xc2)
+    elif isinstance(value, int):
+        pack_int(value, out)
+    elif isinstance(value, float):
+        out.append(0xcb)
+        out += struct.pack('>d', value)
+    elif isinstance(value, str):
+        data = value.encode('utf-8')
+        pack_length(len(data), 0xa0, 32, (0xd9, 0xda, 0xdb), out)
+        out += data
+    elif isinstance(value, (bytes, bytearray)):
+        pack_length(len(value), None, 0, (0xc4, 0xc5, 0xc6), out)
+        out += value
+    elif isinstance(value, (list, tuple)):
+        pack_length(len(value), 0x90, 16, (None, 0xdc, 0xdd), out)
+        for item in value:
+            pack_into(item, out)
+    elif isinstance(value, dict):
+        pack_length(len(value), 0x80, 16, (None, 0xde, 0xdf), out)
+        for key, item in value.items():
+            pack_into(key, out)
+            pack_into(item, out)
+    else:
+        raise TypeError(f'Cannot pack {type(value).__name__}')
+
+
+def packb(value):
+    out = bytearray()
+    pack_into(value, out)
+    return bytes(out)
+
+
+class Unpacker:
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def take(self, size):
+        if self.pos + size > len(self.data):
+            raise ValueError('Truncated msgpack data')
+        chunk = self.data[self.pos:self.pos + size]
+        self.pos += size
+        return chunk
+
+    def read(self, fmt):
+        return struct.unpack(fmt, self.take(struct.calcsize(fmt)))[0]
+
+    def unpack(self):
+        marker = self.take(1)[0]
+        if marker < 0x80:
+            return marker
+        if marker >= 0xe0:
+            return marker - 0x100
+        if 0x80 <= marker <= 0x8f:
+            return self.unpack_map(marker & 0x0f)
+        if 0x90 <= marker <= 0x9f:
+            return self.unpack_array(marker & 0x0f)
+        if 0xa0 <= marker <= 0xbf:
+            return self.take(marker & 0x1f).decode('utf-8')
+        simple = {0xc0: None, 0xc2: False, 0xc3: True}
+        if marker in simple:
+            return simple[marker]
+        numbers = {0xca: '>f', 0xcb: '>d', 0xcc: '>B', 0xcd: '>H', 0xce: '>I', 0xcf: '>Q',
+                   0xd0: '>b', 0xd1: '>h', 0xd2: '>i', 0xd3: '>q'}
+        if marker in numbers:
+            return self.read(numbers[marker])
+        lengths = {0xd9: '>B', 0xda: '>H', 0xdb: '>I'}
+        if marker in lengths:
+            return self.take(self.read(lengths[marker])).decode('utf-8')
+        lengths = {0xc4: '>B', 0xc5: '>H', 0xc6: '>I'}
+        if marker in lengths:
+            return bytes(self.take(self.read(lengths[marker])))
+        if marker in (0xdc, 0xdd):
+            return self.unpack_array(self.read('>H' if marker == 0xdc else '>I'))
+        if marker in (0xde, 0xdf):
+            return self.unpack_map(self.read('>H' if marker == 0xde else '>I'))
+        raise ValueError(f'Unsupported msgpack marker 0x{marker:02x}')
+
+    def unpack_array(self, length):
+        return [self.unpack() for _ in range(length)]
+
+    def unpack_map(self, length):
+        result = {}
+        for _ in range(length):
+            key = self.unpack()
+            result[key] = self.unpack()
+        return result
+
+
+def unpackb(data):
+    unpacker = Unpacker(data)
+    value = unpacker.unpack()
+    if unpacker.pos != len(data):
+        raise ValueError('Extra data after msgpack value')
+    return value
+
+
+def pack_message(message_id, sender_id, receiver_id, message_text, sent_at, is_seen=False):
+    """One message as a compact payload, ready to emit to any number of rooms"""
+    return packb([message_id, sender_id, receiver_id, message_text, epoch_millis(sent_at), is_seen])